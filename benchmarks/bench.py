@@ -0,0 +1,175 @@
+# NOTE: run from the repository root with python -m benchmarks.bench
+import torch
+
+import json
+import platform
+import resource
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.torch         import ftype
+from utils.common        import Resolution, Timer
+
+from raytracing.tracer   import PathTracer
+from raytracing.denoiser import Denoiser
+
+from interfaces.viewport import Viewport
+
+from scenes.orrery       import orreryScene
+
+# Settings =====================================================================
+seed  = 1234
+sizes = {'10': 10, '1k': 1000, '100k': 100000}
+
+# NOTE: 1 if higher is better, -1 if lower is better
+metrics = {
+    'build_s':           -1,
+    'primary_mrays_s':    1,
+    'secondary_mrays_s':  1,
+    'render_s':          -1,
+    'peak_rss_mb':       -1,
+    'denoise_s':         -1
+}
+
+# Measurements =================================================================
+def _bestOf(repeat, func, *args):
+    elaps = []
+    for _ in range(repeat):
+        with Timer() as t:
+            func(*args)
+        elaps.append(t.elap)
+
+    return(min(elaps))
+
+def _runCase(n_spheres, res_v, samples, repeat, threads):
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    # The orrery always has the Sun, Earth and Moon, the ground is a plane
+    # NOTE: unbounded objects are kept out of obj_list, it only has spheres
+    scene  = orreryScene(n_rand = n_spheres - 3, seed = seed)
+    vport  = Viewport(Resolution(res_v))
+    result = {'spheres': len(scene.obj_list)}
+
+    result['build_s'] = _bestOf(repeat, scene.build)
+
+    rays_prim = vport.getRays(rand = False)
+    result['primary_mrays_s'] = len(rays_prim) / _bestOf(repeat, scene.intersect, rays_prim) / 1e6
+
+    torch.manual_seed(seed)
+    rays_sec = scene.traverse(rays_prim).generateRays()
+    result['secondary_mrays_s'] = len(rays_sec) / _bestOf(repeat, scene.intersect, rays_sec) / 1e6
+
+    torch.manual_seed(seed)
+    result['render_s'] = _bestOf(1, PathTracer(samples = samples).render, scene, vport)
+
+    # NOTE: ru_maxrss is in kilobytes on Linux, every case runs in a fresh process
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return(result)
+
+def _runDenoise(res_v, repeat, threads):
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    # NOTE: the filter cost only depends on the resolution, the buffers are noise
+    res = Resolution(res_v)
+    gen = torch.Generator().manual_seed(seed)
+
+    cols  = torch.rand((res.v * res.h, 3), generator = gen, dtype = ftype) * 255
+    feats = torch.rand((res.v * res.h, 7), generator = gen, dtype = ftype)
+
+    return({'res': res_v, 'denoise_s': _bestOf(repeat, Denoiser(), cols, feats, res)})
+
+# Comparison ===================================================================
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    for case, result in results['cases'].items():
+        if case not in baseline['cases']:
+            continue
+
+        for name, sign in metrics.items():
+            # NOTE: the denoiser case only has its own metric
+            if name not in result or name not in baseline['cases'][case]:
+                continue
+
+            old = baseline['cases'][case][name]
+            new = result[name]
+
+            # NOTE: zero baselines have no relative change, only the absolute one is shown
+            if old == 0:
+                print(f'{case:>6}', f'{name:<18}', f'{old:12.4f}', f'{new:12.4f}', f'{new - old:+9.4f}')
+                continue
+
+            change = sign * (new - old) / old
+            flag   = 'REGRESSION' if change < -tolerance else ''
+            print(f'{case:>6}', f'{name:<18}', f'{old:12.4f}', f'{new:12.4f}', f'{change * 100:+8.2f}%', flag)
+
+            if flag:
+                regressions.append((case, name))
+
+    return(regressions)
+
+# Calls ========================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'CPU benchmarks of BVH builds, traversal and renders')
+    parser.add_argument('--sizes',     nargs = '+', default = list(sizes.keys()), choices = list(sizes.keys()))
+    parser.add_argument('--res',       type = int, default = 180, help = 'vertical resolution')
+    parser.add_argument('--samples',   type = int, default = 2)
+    parser.add_argument('--denoise',   type = int, default = 1440, help = 'vertical resolution of the denoiser case, 0 skips it')
+    parser.add_argument('--repeat',    type = int, default = 3)
+    parser.add_argument('--threads',   type = int, default = None)
+    parser.add_argument('--out',       default = 'bench_results.json')
+    parser.add_argument('--compare',   default = None, help = 'baseline JSON to compare against')
+    parser.add_argument('--tolerance', type = float, default = 0.1)
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'torch':    torch.__version__,
+            'python':   platform.python_version(),
+            'machine':  platform.machine(),
+            'threads':  args.threads if args.threads is not None else torch.get_num_threads(),
+            'res':      args.res,
+            'samples':  args.samples,
+            'denoise':  args.denoise,
+            'seed':     seed
+        },
+        'cases': {}
+    }
+
+    ctx = mp.get_context('spawn')
+    for size in args.sizes:
+        print(f'Benchmarking {size} spheres...')
+
+        with ProcessPoolExecutor(max_workers = 1, mp_context = ctx) as executor:
+            results['cases'][size] = executor.submit(
+                _runCase, sizes[size], args.res, args.samples, args.repeat, args.threads
+            ).result()
+
+        print(json.dumps(results['cases'][size], indent = 4))
+
+    if args.denoise > 0:
+        print(f'Benchmarking the denoiser at {args.denoise}p...')
+
+        with ProcessPoolExecutor(max_workers = 1, mp_context = ctx) as executor:
+            results['cases']['denoise'] = executor.submit(
+                _runDenoise, args.denoise, args.repeat, args.threads
+            ).result()
+
+        print(json.dumps(results['cases']['denoise'], indent = 4))
+
+    with open(args.out, 'w') as out_file:
+        json.dump(results, out_file, indent = 4)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as in_file:
+            baseline = json.load(in_file)
+
+        if baseline['meta']['res'] != args.res or baseline['meta']['samples'] != args.samples:
+            print('WARNING: the baseline was made with different settings!')
+
+        if compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
@@ -1,6 +1,6 @@
 import sys
 
-from PyQt5.QtCore    import QSize, QTimer
+from PyQt5.QtCore    import QSize, QTimer, Qt
 from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel
 from PyQt5.QtGui     import QImage, QPixmap
 
@@ -8,12 +8,13 @@ from utils.common    import Timer
 
 class GUI():
     def __init__(self, viewport, res, r_rate = 60):
-        self.vport  = viewport
-        self.res    = res
-        self.r_rate = r_rate
+        self.vport   = viewport
+        self.res     = res
+        self.r_rate  = r_rate
+        self.version = None
 
         self.app = QApplication([])
-        self.win = _MainWindow(res)
+        self.win = _MainWindow(res, viewport)
 
         self.refresh_timer = QTimer()
         self.refresh_timer.setSingleShot(True)
@@ -21,11 +22,17 @@ class GUI():
 
     def _refreshLoop(self):
         with Timer() as t:
-            img = self.vport.getBuffer()
-            img = QImage(img.data, img.shape[1], img.shape[0], img.strides[0], QImage.Format_RGB888)
+            # Only upload frames the renderer has pushed since the last refresh
+            version = self.vport.getVersion()
 
-            pix = QPixmap.fromImage(img).scaled(self.res.h, self.res.v)
-            self.win.lab.setPixmap(pix)
+            if version != self.version:
+                self.version = version
+
+                img = self.vport.getBuffer().numpy()
+                img = QImage(img.data, img.shape[1], img.shape[0], img.strides[0], QImage.Format_RGB888)
+
+                pix = QPixmap.fromImage(img).scaled(self.res.h, self.res.v)
+                self.win.lab.setPixmap(pix)
 
         # Compensate for the elapsed time in rendering, schedule next refresh
         next_time = (1000 // self.r_rate) - int(t.elap * 1000)
@@ -39,11 +46,21 @@ class GUI():
         sys.exit(self.app.exec())
 
 class _MainWindow(QMainWindow):
-    def __init__(self, res):
+    def __init__(self, res, viewport):
         super().__init__()
 
-        self.lab = QLabel()
+        self.vport = viewport
+        self.lab   = QLabel()
 
-        self.setWindowTitle("Orrery")
+        self.setWindowTitle("Orrery - Esc to stop rendering")
         self.setFixedSize(QSize(res.h, res.v))
-        self.setCentralWidget(self.lab)
\ No newline at end of file
+        self.setCentralWidget(self.lab)
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.vport.requestStop()
+            self.setWindowTitle("Orrery")
+
+    def closeEvent(self, event):
+        self.vport.requestStop()
+        event.accept()
@@ -0,0 +1,99 @@
+import torch
+
+from collections        import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy               import deepcopy
+from math               import cos, sin
+from pathlib            import Path
+
+from utils.common       import Timer
+from utils.consts       import pi
+
+class FrameState():
+    def __init__(self, params = None, obj_ids = None, **updates):
+        self.params  = params  # Camera of the frame, None keeps the last one
+        self.obj_ids = obj_ids # Objects moved before the frame, None moves nothing
+        self.updates = updates # Per object parameters, e.g. cent [k, 3] and rad [k,]
+
+def turntable(params, n_frames):
+    # The camera circles the target at its current height and distance
+    frames = []
+    for i in range(n_frames):
+        theta  = 2 * pi * i / n_frames
+        offset = params.cam_pos - params.cam_target
+        rot    = torch.tensor([
+            [cos(theta), -sin(theta), 0],
+            [sin(theta),  cos(theta), 0],
+            [0,           0,          1]
+        ], dtype = offset.dtype)
+
+        frame_params = deepcopy(params)
+        frame_params.cam_pos = params.cam_target + rot @ offset
+
+        frames.append(FrameState(params = frame_params))
+
+    return(frames)
+
+def writePNG(img, path):
+    from PIL import Image
+
+    Image.fromarray(img.numpy(), mode = 'RGB').save(path)
+
+def writePFM(img, path):
+    # NOTE: little-endian floats, rows are stored from the bottom up
+    with open(path, 'wb') as out_file:
+        out_file.write(f'PF\n{img.shape[1]} {img.shape[0]}\n-1.0\n'.encode('ascii'))
+        out_file.write(torch.flip(img, [0]).contiguous().numpy().astype('<f4').tobytes())
+
+image_writers = {'png': writePNG, 'pfm': writePFM}
+
+class SequenceRenderer():
+    def __init__(self, out_dir = './frames', formats = ('png', 'pfm'), writers = 2, max_pending = 4):
+        if any(fmt not in image_writers for fmt in formats) or max_pending < 1:
+            raise Exception("Invalid sequence parameters!")
+
+        self.out_dir     = Path(out_dir)
+        self.formats     = formats
+        self.writers     = writers
+        self.max_pending = max_pending # Frames queued for writing before tracing blocks
+
+    def _writeFrame(self, index, ldr, hdr):
+        for fmt in self.formats:
+            img = ldr if fmt == 'png' else hdr
+            image_writers[fmt](img, self.out_dir / f'frame_{index:05}.{fmt}')
+
+    def render(self, tracer, scene, vport, frames):
+        self.out_dir.mkdir(parents = True, exist_ok = True)
+
+        pending = deque()
+
+        # Frames are traced while the earlier ones are encoded in the background
+        with ThreadPoolExecutor(max_workers = self.writers) as pool:
+            for index, frame in enumerate(frames):
+                if vport.stopRequested():
+                    break
+
+                with Timer() as t:
+                    if frame.obj_ids is not None:
+                        scene.update(frame.obj_ids, **frame.updates)
+
+                    if frame.params is not None:
+                        vport.setParams(frame.params)
+
+                    tracer.render(scene, vport)
+
+                    # NOTE: copies, the buffers are reused by the next frame
+                    ldr = vport.getBuffer().clone()
+                    hdr = tracer.getHDR(vport).clone()
+
+                print(f'Frame {index:05}', t, f'{len(pending)} pending', sep = " - ")
+
+                # Backpressure, tracing waits for the oldest write
+                while len(pending) >= self.max_pending:
+                    pending.popleft().result()
+
+                pending.append(pool.submit(self._writeFrame, index, ldr, hdr))
+
+            # NOTE: raises errors of the writers
+            while len(pending) > 0:
+                pending.popleft().result()
@@ -4,6 +4,7 @@ from torch.nn.functional import normalize
 from utils.consts    import pi
 from utils.torch     import DmModule, ftype
 from utils.rand      import randInCircle, randInSquare
+from utils.profiler  import prof
 
 from raytracing.rays import Rays
 
@@ -34,6 +35,7 @@ class Viewport(DmModule):
         self.setParams(params)
 
         self._initBuffer()
+        self._initState()
 
         super().__init__(**kwargs)
 
@@ -90,12 +92,39 @@ class Viewport(DmModule):
     def __len__(self):
         return(self.res.v * self.res.h)
 
-    def getRays(self, rand = True):
+    def getTileCorners(self, tile_size = None):
+        if tile_size is None:
+            return([(0, 0)])
+
+        return([(v, h) for v in range(0, self.res.v, tile_size) for h in range(0, self.res.h, tile_size)])
+
+    def getTile(self, v, h, tile_size = None):
+        v_end = self.res.v if tile_size is None else min(v + tile_size, self.res.v)
+        h_end = self.res.h if tile_size is None else min(h + tile_size, self.res.h)
+
+        rows = torch.arange(v, v_end, dtype = torch.long, device = self.device).view(-1, 1)
+        cols = torch.arange(h, h_end, dtype = torch.long, device = self.device).view(1, -1)
+
+        return((rows * self.res.h + cols).view(-1))
+
+    def getTiles(self, tile_size = None):
+        for v, h in self.getTileCorners(tile_size):
+            yield(self.getTile(v, h, tile_size))
+
+    @prof.timed('getRays')
+    def getRays(self, rand = True, pix_ids = None):
         orig, pixs, h_norm, v_norm, h_step, v_step, r_lens = self._getParams()
 
+        # NOTE: pixels are subset before moving them, tiles only copy their own
+        pixs = pixs.view(-1, 3)
+        if pix_ids is not None:
+            pixs = pixs[pix_ids.cpu()]
+        else:
+            pix_ids = torch.arange(len(pixs), dtype = torch.long, device = self.device)
+
         # NOTE: [:3] subsets because of a bug in pytorch
-        orig = orig.to(self.device)[:3].view(1, 3).repeat(len(self), 1)
-        pixs = pixs.to(self.device).view(-1, 3)
+        pixs = pixs.to(self.device)
+        orig = orig.to(self.device)[:3].view(1, 3).repeat(len(pixs), 1)
 
         if rand:
             h_norm = h_norm[:3].to(self.device).view(1, 3)
@@ -106,15 +135,16 @@ class Viewport(DmModule):
 
             r_lens = r_lens[:1].to(self.device)
 
-            orig_rh, orig_rv = randInCircle(len(self), self.device)
+            orig_rh, orig_rv = randInCircle(len(pixs), self.device, pix_ids, offset = 0)
             orig = orig + (orig_rh * h_norm * r_lens) + (orig_rv * v_norm * r_lens)
 
-            pixs_rh, pixs_rv = randInSquare(len(self), self.device)
+            pixs_rh, pixs_rv = randInSquare(len(pixs), self.device, pix_ids, offset = 2)
             pixs = pixs + (pixs_rh * h_step) + (pixs_rv * v_step)
 
         rays = Rays(
             origins    = orig,
-            directions = normalize(pixs - orig, dim = 1)
+            directions = normalize(pixs - orig, dim = 1),
+            pix_ids    = pix_ids
         )
 
         return(rays)
@@ -125,4 +155,27 @@ class Viewport(DmModule):
         self.getBuffer().copy_(buff_tmp)
 
     def getBuffer(self):
-        return(torch.frombuffer(self.buff_shm.buf, dtype = torch.uint8).view(self.res.v, self.res.h, 3))
\ No newline at end of file
+        return(torch.frombuffer(self.buff_shm.buf, dtype = torch.uint8).view(self.res.v, self.res.h, 3))
+
+    def setBuffer(self, buffer):
+        self.getBuffer().copy_(buffer)
+
+        # NOTE: readers only pick up frames with a new version
+        self._getState()[0] += 1
+
+    def _initState(self):
+        state_tmp      = torch.zeros([2], dtype = torch.long) # Frame version, stop flag
+        self.state_shm = shared_memory.SharedMemory(create = True, size = state_tmp.element_size() * state_tmp.numel())
+        self._getState().copy_(state_tmp)
+
+    def _getState(self):
+        return(torch.frombuffer(self.state_shm.buf, dtype = torch.long)[:2])
+
+    def getVersion(self):
+        return(self._getState()[0].item())
+
+    def requestStop(self):
+        self._getState()[1] = 1
+
+    def stopRequested(self):
+        return(self._getState()[1].item() > 0)
\ No newline at end of file
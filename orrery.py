@@ -1,165 +1,127 @@
 # NOTE: torch version > 1.12.0
 import torch
 
-import pickle
 from pathlib import Path
 
-from utils.torch            import ftype
 from utils.common           import Resolution, Timer
-from utils.rand             import randInCircle
+from utils.profiler         import prof
+from utils.rand             import SobolSampler
 
-from raytracing.scene       import Scene
-import raytracing.geometry  as geom
-import raytracing.materials as mat
-from raytracing.tracer      import SimpleTracer, PathTracer
+from raytracing.tracer      import SimpleTracer, PathTracer, HeatmapTracer
+from raytracing.pool        import RenderPool
+from raytracing.sceneio     import saveScene, loadScene
+from raytracing.cache       import BVHCache
+from raytracing.denoiser    import Denoiser
 
 from interfaces.viewport    import Viewport, ViewportParams
 from interfaces.gui         import GUI
+from interfaces.sequence    import SequenceRenderer, turntable
 
-# import multiprocessing as mp
+from scenes.orrery          import orreryScene
 
-# if __name__ == '__main__':
-#     mp.set_start_method('spawn')
+import multiprocessing as mp
 
 # Notes ========================================================================
 # To profile call:
 # python -m cProfile -o ./prof/orrery.prof orrery.py
 # snakeviz ./prof/orrery.prof
+#
+# For per-stage times and counters set profile = True, the Chrome trace opens
+# in chrome://tracing or ui.perfetto.dev
 
 # Settings =====================================================================
-res = Resolution(1440)
-dev = 'cuda:0'
-
-# Scene ========================================================================
-class Ground(geom.Sphere, mat.Metal):
-    def __init__(self):
-        super().__init__(
-            center = torch.tensor([0, 0, -1000], dtype = ftype),
-            radius = 1000,
-            albedo = torch.tensor([0.35, 0.78, 0.52], dtype = ftype),
-            fuzz   = 0.7
-        )
-
-class Sun(geom.Sphere, mat.Shiny):
-    def __init__(self):
-        super().__init__(
-            center = torch.tensor([-4.5, 0, 2], dtype = ftype),
-            radius = 2,
-            albedo = torch.tensor([0.9, 0.7, 0.0], dtype = ftype)
-        )
-
-class Earth(geom.Sphere, mat.Glass):
-    def __init__(self):
-        super().__init__(
-            center = torch.tensor([0, 0, 2], dtype = ftype),
-            radius = 2,
-            albedo = torch.tensor([0.2, 0.5, 0.8], dtype = ftype),
-            eta    = 1.5
-        )
-
-class Moon(geom.Sphere, mat.Metal):
-    def __init__(self):
-        super().__init__(
-            center = torch.tensor([4.5, 0, 2], dtype = ftype),
-            radius = 2,
-            albedo = torch.tensor([0.3, 0.3, 0.3], dtype = ftype),
-            fuzz   = 0.2
-        )
-
-class RandDiffuse(geom.Sphere, mat.Diffuse):
-    def __init__(self, center):
-        super().__init__(
-            center   = center,
-            radius   = 0.5,
-            albedo   = torch.rand([3], dtype = ftype)
-        )
-
-class RandShiny(geom.Sphere, mat.Shiny):
-    def __init__(self, center):
-        super().__init__(
-            center   = center,
-            radius   = 0.5,
-            albedo   = torch.rand([3], dtype = ftype)
-        )
-
-class RandGlowing(geom.Sphere, mat.Glowing):
-    def __init__(self, center):
-        super().__init__(
-            center   = center,
-            radius   = 0.5,
-            albedo   = torch.rand([3], dtype = ftype),
-            glow_min = 1.2,
-            glow_max = 3.0
-        )
-
-class RandGlass(geom.Sphere, mat.Glass):
-    def __init__(self, center):
-        super().__init__(
-            center   = center,
-            radius   = 0.5,
-            albedo   = torch.rand([3], dtype = ftype),
-            eta      = 1.5
-        )
-
-scene = Scene() + Sun() + Earth() + Moon()
-
-def testObj(candidate):
-    for obj in scene.obj_list:
-        if torch.norm(obj.cent[:2] - candidate.cent[:2]) < (obj.rad + candidate.rad):
-            return(False)
-    return(True)
-
-for i in range(20):
-    for type in [RandDiffuse, RandShiny, RandGlowing, RandGlass]:
-        while True:
-            rand_loc = torch.tensor(list(randInCircle(1, dev)) + [0.0]) * 10
-            rand_loc[2] = 0.5 
-
-            candidate = type(rand_loc)
-            
-            if testObj(candidate):
-                scene += candidate
-                break
-
-scene += Ground()
-
-# Save and load for reproducability
-scene_path = Path.cwd() / 'scene.pkl'
-
-with open(scene_path, 'wb') as out_file:
-    pickle.dump(scene, out_file)
-
-with open(scene_path, 'rb') as in_file:
-    scene = pickle.load(in_file)
-
-# Instantiation ================================================================
-# tracer = SimpleTracer()
-tracer = PathTracer(samples = 10)
-vport  = Viewport(res)
-
-# Move to GPU ==================================================================
-tracer.to(dev)
-
-# Calls =======================================================================
-print('Building the BVH...')
-with Timer() as t:
-    scene.build()
-print('Build complete', t, sep = " - ")
-
-# if __name__ == '__main__':
-#     vport = Viewport(res)
-#     vport.to(dev)
-
-print('Rendering...')
-with Timer() as t:
-    tracer.render(scene, vport)
-
-    # p = mp.Process(target = tracer.render, args = (vport,))
-    # p.start()
-    # p.join()
-print('Render complete', t, sep = " - ")
-
-from PIL import Image
-img = Image.fromarray(vport.getBuffer().numpy(), mode = 'RGB')
-img.show()
-# img.save("rt_image_014.png")
+res      = Resolution(1440)
+dev      = 'cuda:0'
+workers  = 1     # NOTE: more than one renders tiles in a pool of processes
+gui      = False # NOTE: shows progressive snapshots while rendering
+profile  = False # NOTE: only the tracer of this process is profiled, not the pool
+diagnose = None  # NOTE: 'nodes' or 'prims' renders a traversal cost heatmap
+frames   = None  # NOTE: a number renders a turntable sequence into ./frames
+compiled = None  # NOTE: a torch.compile backend, e.g. 'inductor', fuses the kernels, cached in ./kernel_cache
+denoise  = True  # NOTE: filters the image guided by first-hit albedo, normals and depth
+mesh     = None  # NOTE: path of an OBJ file, placed in the scene as a statue
+
+# Rendering ====================================================================
+def render(tracer, scene_path, vport):
+    # NOTE: stages sync the device so async kernels are billed correctly
+    prof.enabled = profile
+    prof.sync    = profile
+
+    if workers > 1:
+        RenderPool(workers = workers).render(tracer, scene_path, vport)
+    else:
+        tracer.render(loadScene(scene_path), vport)
+
+    if profile:
+        print(prof)
+
+        Path('./prof').mkdir(exist_ok = True)
+        prof.dumpReport('./prof/orrery_stages.json')
+        prof.dumpChromeTrace('./prof/orrery_trace.json')
+
+if __name__ == '__main__':
+    # NOTE: render workers re-import this file, everything below runs only once
+    mp.set_start_method('spawn')
+
+    # Scene ====================================================================
+    scene = orreryScene(n_rand = 80, mesh_path = mesh)
+
+    # NOTE: unchanged scenes reuse the hierarchy of an earlier launch
+    cache = BVHCache()
+
+    print('Building the BVH...')
+    with Timer() as t:
+        scene.build(cache = cache)
+    print('Build complete', t, f'SAH cost {scene.flat_bvh.sahCost():.2f}', f'cache {cache.stats()}', sep = " - ")
+
+    # Save and load for reproducability, the file holds the BVH as well
+    # NOTE: renders map the file, workers of the pool each map their own view
+    scene_path = Path.cwd() / 'scene.orrs'
+    saveScene(scene, scene_path)
+
+    with Timer() as t:
+        scene = loadScene(scene_path)
+    print('Scene loaded', t, sep = " - ")
+
+    # Instantiation ============================================================
+    # tracer = SimpleTracer()
+    tracer = PathTracer(
+        samples     = 10,
+        progressive = gui,
+        nee         = True,
+        sampler     = SobolSampler(),
+        compiled    = compiled,
+        denoiser    = Denoiser() if denoise else None
+    )
+    if diagnose is not None:
+        tracer = HeatmapTracer(mode = diagnose)
+    vport  = Viewport(res)
+
+    # Move to GPU ==============================================================
+    tracer.to(dev)
+
+    # Calls ===================================================================
+    if diagnose is not None:
+        for name, value in scene.flat_bvh.report().items():
+            print(f'{name:<18}', value)
+
+    print('Rendering...')
+    if frames is not None:
+        with Timer() as t:
+            SequenceRenderer().render(tracer, scene, vport, turntable(vport.getParams(), frames))
+        print('Sequence complete', t, sep = " - ")
+    elif gui:
+        # NOTE: the window can stop the render early, closing it exits
+        p = mp.Process(target = render, args = (tracer, scene_path, vport))
+        p.start()
+
+        GUI(vport, res).start()
+    else:
+        with Timer() as t:
+            render(tracer, scene_path, vport)
+        print('Render complete', t, sep = " - ")
+
+        from PIL import Image
+        img = Image.fromarray(vport.getBuffer().numpy(), mode = 'RGB')
+        img.show()
+        # img.save("rt_image_014.png")
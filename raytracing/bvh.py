@@ -0,0 +1,319 @@
+from math import inf
+import torch
+
+from utils.torch    import DmModule, ftype
+from utils.consts   import t_min
+from utils.profiler import prof
+from utils.kernels  import kernel
+
+def boxAreas(mins, maxes):
+    ranges = maxes - mins
+
+    # NOTE: half of the surface area, only ever used in ratios
+    return(ranges[..., 0] * ranges[..., 1] + ranges[..., 1] * ranges[..., 2] + ranges[..., 2] * ranges[..., 0])
+
+@kernel
+def slabTest(mins, maxes, orig, dirs_inv, ts_max):
+    t_0 = (mins - orig) * dirs_inv
+    t_1 = (maxes - orig) * dirs_inv
+
+    t_smalls, _ = torch.max(torch.minimum(t_0, t_1), dim = 1)
+    t_bigs, _   = torch.min(torch.maximum(t_0, t_1), dim = 1)
+
+    # Boxes starting behind the closest hit found so far can be skipped
+    return((t_smalls <= t_bigs) & (t_bigs >= t_min) & (t_smalls < ts_max))
+
+class FlatBVH(DmModule):
+    def __init__(self, mins, maxes, left, right, first, count, prim_ids, **kwargs):
+        self.mins     = mins     # Node bounding box minimums             [m, 3]
+        self.maxes    = maxes    # Node bounding box maximums             [m, 3]
+        self.left     = left     # Left child node ids, -1 for leaves     [m,]
+        self.right    = right    # Right child node ids, -1 for leaves    [m,]
+        self.first    = first    # Leaf range starts in prim_ids          [m,]
+        self.count    = count    # Leaf range lengths, 0 for inner nodes  [m,]
+        self.prim_ids = prim_ids # Object ids ordered by leaf             [p,]
+
+        super().__init__(device = mins.device, **kwargs)
+
+    def __len__(self):
+        return(self.mins.shape[0])
+
+    def sahCost(self, c_trav = 1.0, c_isect = 1.0):
+        areas = boxAreas(self.mins, self.maxes)
+        inner = self.count == 0
+
+        cost  = c_trav * torch.sum(areas[inner]) + c_isect * torch.sum(areas[~inner] * self.count[~inner])
+
+        return((cost / areas[0]).item())
+
+    def parents(self):
+        parents = torch.full((len(self),), -1, dtype = torch.long, device = self.device)
+        inner   = torch.nonzero(self.count == 0).view(-1)
+
+        parents[self.left[inner]]  = inner
+        parents[self.right[inner]] = inner
+
+        return(parents)
+
+    def depths(self):
+        depths = torch.zeros((len(self),), dtype = torch.long, device = self.device)
+        nodes  = torch.zeros((1,), dtype = torch.long, device = self.device)
+        depth  = 0
+
+        while len(nodes) > 0:
+            depths[nodes] = depth
+            inner  = nodes[self.count[nodes] == 0]
+            nodes  = torch.cat([self.left[inner], self.right[inner]])
+            depth += 1
+
+        return(depths)
+
+    def siblingOverlaps(self):
+        # Area of the box shared by the two children, relative to the parent area
+        inner = torch.nonzero(self.count == 0).view(-1)
+        left  = self.left[inner]
+        right = self.right[inner]
+
+        o_mins  = torch.maximum(self.mins[left], self.mins[right])
+        o_maxes = torch.minimum(self.maxes[left], self.maxes[right])
+
+        # NOTE: children apart on any axis share nothing, touching ones share a face
+        disjoint = torch.any(o_maxes < o_mins, dim = 1)
+        overlaps = boxAreas(o_mins, torch.maximum(o_maxes, o_mins)) / boxAreas(self.mins[inner], self.maxes[inner])
+
+        return(inner, overlaps.masked_fill(disjoint, 0))
+
+    def report(self):
+        depths = self.depths()
+        leaves = self.count > 0
+
+        inner, overlaps = self.siblingOverlaps()
+        overlap_sums    = torch.zeros((int(depths.max()) + 1,), dtype = ftype, device = self.device)
+        overlap_sums.index_add_(0, depths[inner], overlaps)
+        overlap_cnts    = torch.bincount(depths[inner], minlength = len(overlap_sums))
+
+        report = {
+            'sah_cost':         self.sahCost(),
+            'nodes':            len(self),
+            'leaves':           int(leaves.sum()),
+            'max_depth':        int(depths.max()),
+            'leaf_depths':      torch.bincount(depths[leaves]).tolist(),
+            'leaf_sizes':       torch.bincount(self.count[leaves]).tolist(),
+            'overlap_mean':     overlaps.mean().item() if len(inner) > 0 else 0.0,
+            'overlap_max':      overlaps.max().item() if len(inner) > 0 else 0.0,
+            'overlap_by_depth': (overlap_sums / torch.clamp_min(overlap_cnts, 1)).tolist()
+        }
+
+        return(report)
+
+    def _leafBounds(self, node_ids, mins, maxes):
+        counts  = self.count[node_ids]
+        offsets = torch.cumsum(counts, dim = 0) - counts
+        slots   = torch.arange(int(counts.sum()), dtype = torch.long, device = self.device)
+        slots  += torch.repeat_interleave(self.first[node_ids] - offsets, counts)
+
+        prims = self.prim_ids[slots]
+        locs  = torch.repeat_interleave(torch.arange(len(node_ids), dtype = torch.long, device = self.device), counts)
+        locs  = locs.view(-1, 1).expand(-1, 3)
+
+        l_mins  = torch.full((len(node_ids), 3), inf, dtype = ftype, device = self.device).scatter_reduce_(0, locs, mins[prims], 'amin')
+        l_maxes = torch.full((len(node_ids), 3), -inf, dtype = ftype, device = self.device).scatter_reduce_(0, locs, maxes[prims], 'amax')
+
+        return(l_mins, l_maxes)
+
+    def refit(self, mins, maxes, prim_ids = None):
+        # Leaves of the moved prims are refit first, None refits every leaf
+        if prim_ids is None:
+            nodes = torch.nonzero(self.count > 0).view(-1)
+        else:
+            # NOTE: prims outside of the tree, e.g. unbounded ones, have no slot
+            n_ids      = int(torch.max(torch.cat([self.prim_ids, prim_ids]))) + 1
+            prim_slots = torch.full((n_ids,), -1, dtype = torch.long, device = self.device)
+            prim_slots[self.prim_ids] = torch.arange(len(self.prim_ids), dtype = torch.long, device = self.device)
+
+            slots      = prim_slots[prim_ids]
+            slot_nodes = torch.repeat_interleave(torch.arange(len(self), dtype = torch.long, device = self.device), self.count)
+            nodes      = torch.unique(slot_nodes[slots[slots >= 0]])
+
+        self.mins[nodes], self.maxes[nodes] = self._leafBounds(nodes, mins, maxes)
+
+        # NOTE: ancestors are refit again when a deeper path reaches them, the
+        # last update of a node always comes after all of its descendants
+        parents = self.parents()
+        nodes   = torch.unique(parents[nodes])
+        nodes   = nodes[nodes >= 0]
+
+        while len(nodes) > 0:
+            self.mins[nodes]  = torch.minimum(self.mins[self.left[nodes]], self.mins[self.right[nodes]])
+            self.maxes[nodes] = torch.maximum(self.maxes[self.left[nodes]], self.maxes[self.right[nodes]])
+
+            nodes = torch.unique(parents[nodes])
+            nodes = nodes[nodes >= 0]
+
+        return(self)
+
+    @prof.timed('box_tests')
+    def intersect(self, node_ids, orig, dirs_inv, ts_max):
+        # NOTE: one row per (ray, node) pair, rays already gathered by the caller
+        return(slabTest(self.mins[node_ids], self.maxes[node_ids], orig, dirs_inv, ts_max))
+
+    def traverse(self, orig, dirs_inv, ts_max, leaves, node_ids = None, visit = None):
+        # Every active (ray, node) pair is processed at once, level by level
+        # NOTE: leaves(ray_ids, node_ids) lowers ts_max in place, which culls
+        # the boxes of the next levels. Rays may start at any node, e.g. roots
+        ray_ids  = torch.arange(len(orig), dtype = torch.long, device = orig.device)
+        node_ids = torch.zeros_like(ray_ids) if node_ids is None else node_ids
+
+        while len(ray_ids) > 0:
+            if visit is not None:
+                visit(ray_ids)
+
+            hit_mask = self.intersect(node_ids, orig[ray_ids], dirs_inv[ray_ids], ts_max[ray_ids])
+            ray_ids  = ray_ids[hit_mask]
+            node_ids = node_ids[hit_mask]
+
+            leaf_mask = self.count[node_ids] > 0
+            if torch.any(leaf_mask):
+                leaves(ray_ids[leaf_mask], node_ids[leaf_mask])
+
+            node_ids = node_ids[~leaf_mask]
+            ray_ids  = ray_ids[~leaf_mask].repeat(2)
+            node_ids = torch.cat([self.left[node_ids], self.right[node_ids]])
+
+    def leafPrims(self, ray_ids, node_ids):
+        # Expand (ray, leaf) pairs into (ray, prim) pairs over the leaf ranges
+        counts  = self.count[node_ids]
+        offsets = torch.cumsum(counts, dim = 0) - counts
+        slots   = torch.arange(int(counts.sum()), dtype = torch.long, device = ray_ids.device)
+        slots  += torch.repeat_interleave(self.first[node_ids] - offsets, counts)
+
+        return(torch.repeat_interleave(ray_ids, counts), self.prim_ids[slots])
+
+# ==============================================================================
+class BinnedBuilder():
+    def __init__(self, bins = 16, leaf_size = 4):
+        if bins < 2 or leaf_size < 1:
+            raise Exception("Invalid BVH builder parameters!")
+
+        self.bins      = bins
+        self.leaf_size = leaf_size
+
+    def _splitCosts(self, p_mins, p_maxes, bins, locs, counts):
+        n_nodes = len(counts)
+        n_bins  = self.bins
+
+        # Every prim lands in one bin per axis, slots index (node, axis, bin)
+        slots = (locs.view(-1, 1) * 3 + torch.arange(3, device = locs.device).view(1, 3)) * n_bins + bins
+        slots = slots.view(-1)
+
+        b_cnts  = torch.bincount(slots, minlength = n_nodes * 3 * n_bins).view(n_nodes, 3, n_bins)
+        b_mins  = torch.full((n_nodes * 3 * n_bins, 3), inf, dtype = ftype, device = locs.device)
+        b_maxes = torch.full((n_nodes * 3 * n_bins, 3), -inf, dtype = ftype, device = locs.device)
+
+        slots = slots.view(-1, 1).expand(-1, 3)
+        b_mins.scatter_reduce_(0, slots, p_mins.repeat_interleave(3, dim = 0), 'amin')
+        b_maxes.scatter_reduce_(0, slots, p_maxes.repeat_interleave(3, dim = 0), 'amax')
+
+        b_mins  = b_mins.view(n_nodes, 3, n_bins, 3)
+        b_maxes = b_maxes.view(n_nodes, 3, n_bins, 3)
+
+        # Prefix scans from the left and from the right over the bins
+        l_mins  = torch.cummin(b_mins, dim = 2).values
+        l_maxes = torch.cummax(b_maxes, dim = 2).values
+        r_mins  = torch.flip(torch.cummin(torch.flip(b_mins, [2]), dim = 2).values, [2])
+        r_maxes = torch.flip(torch.cummax(torch.flip(b_maxes, [2]), dim = 2).values, [2])
+
+        l_cnts = torch.cumsum(b_cnts, dim = 2)[:, :, :-1]
+        r_cnts = counts.view(-1, 1, 1) - l_cnts
+
+        # Split i puts bins [0, i] to the left and bins [i + 1, n_bins) to the right
+        costs = boxAreas(l_mins[:, :, :-1], l_maxes[:, :, :-1]) * l_cnts + \
+                boxAreas(r_mins[:, :, 1:], r_maxes[:, :, 1:]) * r_cnts
+
+        costs = torch.where((l_cnts > 0) & (r_cnts > 0), costs, torch.full_like(costs, inf))
+
+        best_costs, best = torch.min(costs.view(n_nodes, -1), dim = 1)
+
+        return(best_costs, best // (n_bins - 1), best % (n_bins - 1))
+
+    def build(self, mins, maxes):
+        n_prims = mins.shape[0]
+        device  = mins.device
+
+        if n_prims == 0:
+            raise Exception("Cannot build a BVH without objects!")
+
+        cents = (mins + maxes) / 2
+
+        # A binary tree with at least one prim per leaf has at most 2n - 1 nodes
+        n_max      = 2 * n_prims - 1
+        node_mins  = torch.zeros((n_max, 3), dtype = ftype, device = device)
+        node_maxes = torch.zeros((n_max, 3), dtype = ftype, device = device)
+        left       = torch.full((n_max,), -1, dtype = torch.long, device = device)
+        right      = torch.full((n_max,), -1, dtype = torch.long, device = device)
+        leaf_ids   = torch.zeros((n_prims,), dtype = torch.long, device = device)
+
+        # Active prims and the id of the node they currently belong to
+        prims   = torch.arange(n_prims, dtype = torch.long, device = device)
+        segs    = torch.zeros((n_prims,), dtype = torch.long, device = device)
+        n_nodes = 1
+
+        # Every node of a level is binned and split at once
+        while len(prims) > 0:
+            nodes, locs = torch.unique(segs, return_inverse = True)
+            counts      = torch.bincount(locs, minlength = len(nodes))
+
+            p_mins  = mins[prims]
+            p_maxes = maxes[prims]
+            p_cents = cents[prims]
+
+            locs_3  = locs.view(-1, 1).expand(-1, 3)
+            n_mins  = torch.full((len(nodes), 3), inf, dtype = ftype, device = device).scatter_reduce_(0, locs_3, p_mins, 'amin')
+            n_maxes = torch.full((len(nodes), 3), -inf, dtype = ftype, device = device).scatter_reduce_(0, locs_3, p_maxes, 'amax')
+            c_mins  = torch.full((len(nodes), 3), inf, dtype = ftype, device = device).scatter_reduce_(0, locs_3, p_cents, 'amin')
+            c_maxes = torch.full((len(nodes), 3), -inf, dtype = ftype, device = device).scatter_reduce_(0, locs_3, p_cents, 'amax')
+
+            node_mins[nodes]  = n_mins
+            node_maxes[nodes] = n_maxes
+
+            # Bin the centroids inside the centroid bounds of their node
+            c_ranges = c_maxes - c_mins
+            c_scales = torch.where(c_ranges > 0, self.bins / c_ranges, torch.zeros_like(c_ranges))
+            bins     = ((p_cents - c_mins[locs]) * c_scales[locs]).long().clamp_(0, self.bins - 1)
+
+            best_costs, axes, splits = self._splitCosts(p_mins, p_maxes, bins, locs, counts)
+
+            # NOTE: nodes with coincident centroids cannot be split, they stay leaves
+            split_mask = (counts > self.leaf_size) & torch.isfinite(best_costs)
+            prim_split = split_mask[locs]
+
+            leaf_ids[prims[~prim_split]] = segs[~prim_split]
+
+            n_split = int(split_mask.sum())
+            if n_split == 0:
+                break
+
+            children = n_nodes + 2 * torch.arange(n_split, dtype = torch.long, device = device)
+            left[nodes[split_mask]]  = children
+            right[nodes[split_mask]] = children + 1
+            n_nodes += 2 * n_split
+
+            # Move the prims of split nodes into their children
+            ranks = torch.cumsum(split_mask.long(), dim = 0) - 1
+            locs  = locs[prim_split]
+            bins  = bins[prim_split].gather(1, axes[locs].view(-1, 1)).view(-1)
+
+            prims = prims[prim_split]
+            segs  = children[ranks[locs]] + (bins > splits[locs]).long()
+
+        count = torch.bincount(leaf_ids, minlength = n_nodes)
+
+        return(FlatBVH(
+            mins     = node_mins[:n_nodes],
+            maxes    = node_maxes[:n_nodes],
+            left     = left[:n_nodes],
+            right    = right[:n_nodes],
+            first    = torch.cumsum(count, dim = 0) - count,
+            count    = count,
+            prim_ids = torch.sort(leaf_ids, stable = True).indices
+        ))
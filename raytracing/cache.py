@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+
+from raytracing.sceneio import saveBVH, loadBVH, version
+
+class BVHCache():
+    def __init__(self, path = './bvh_cache', max_bytes = 1 << 30):
+        self.path      = Path(path)
+        self.max_bytes = max_bytes
+
+        self.path.mkdir(parents = True, exist_ok = True)
+
+    def key(self, mins, maxes, *params):
+        # NOTE: the builders only see the prim bounds, they decide the tree
+        digest = hashlib.sha256()
+        digest.update(json.dumps([version, *params]).encode('utf-8'))
+        digest.update(mins.detach().cpu().contiguous().numpy().tobytes())
+        digest.update(maxes.detach().cpu().contiguous().numpy().tobytes())
+
+        return(digest.hexdigest())
+
+    def _entry(self, key):
+        return(self.path / f'{key}.bvh')
+
+    def _entries(self):
+        return(list(self.path.glob('*.bvh')))
+
+    def stats(self):
+        stats_path = self.path / 'stats.json'
+        if not stats_path.exists():
+            return({'hits': 0, 'misses': 0, 'evictions': 0})
+
+        with open(stats_path, 'r') as in_file:
+            return(json.load(in_file))
+
+    def _count(self, name, value = 1):
+        # NOTE: kept next to the entries so the counts survive between launches
+        stats = self.stats()
+        stats[name] += value
+
+        with open(self.path / 'stats.json', 'w') as out_file:
+            json.dump(stats, out_file)
+
+    def get(self, key):
+        entry = self._entry(key)
+
+        if not entry.exists():
+            self._count('misses')
+            return(None)
+
+        # The modification time doubles as the last access time of the LRU
+        os.utime(entry)
+        self._count('hits')
+
+        return(loadBVH(entry))
+
+    def put(self, key, flat_bvh):
+        # NOTE: written under a temporary name, readers never see partial files
+        entry = self._entry(key)
+        tmp   = entry.with_suffix(f'.tmp{os.getpid()}')
+
+        saveBVH(flat_bvh, tmp)
+        os.replace(tmp, entry)
+
+        self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries(), key = lambda entry: entry.stat().st_mtime)
+        size    = sum(entry.stat().st_size for entry in entries)
+        evicted = 0
+
+        # Least recently used entries go first, the newest one always stays
+        for entry in entries[:-1]:
+            if size <= self.max_bytes:
+                break
+
+            size    -= entry.stat().st_size
+            evicted += 1
+            entry.unlink()
+
+        if evicted > 0:
+            self._count('evictions', evicted)
+
+    def size(self):
+        return(sum(entry.stat().st_size for entry in self._entries()))
+
+    def clear(self):
+        for entry in self._entries():
+            entry.unlink()
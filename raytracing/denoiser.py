@@ -0,0 +1,123 @@
+import torch
+from torch.nn.functional import pad
+
+from utils.torch    import ftype
+from utils.profiler import prof
+
+# Edge-avoiding à-trous wavelet filter ([Dammertz et al. 2010]), a joint
+# bilateral filter guided by the first-hit albedo, normal and depth buffers
+class Denoiser():
+    # B3 spline, the 5x5 kernel is its outer product
+    taps = (1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16)
+
+    def __init__(self,
+        iterations = 5,
+        sigma_col  = 0.3, # Color distance, in gamma corrected [0, 1] units
+        sigma_alb  = 0.1, # Albedo distance
+        sigma_nrm  = 0.3, # Normal distance
+        sigma_dpt  = 0.1  # Depth distance, relative to the depth of the pair
+    ):
+        if iterations < 1:
+            raise Exception("Invalid denoiser parameters!")
+
+        self.iterations = iterations
+        self.sigma_col  = sigma_col
+        self.sigma_alb  = sigma_alb
+        self.sigma_nrm  = sigma_nrm
+        self.sigma_dpt  = sigma_dpt
+
+    @staticmethod
+    def _pad(img, pad_size):
+        # NOTE: [c, v, h] images, replicated borders keep the weights finite
+        return(pad(img.unsqueeze(0), (pad_size,) * 4, mode = 'replicate').squeeze(0))
+
+    @staticmethod
+    def _window(img_pad, pad_size, off_v, off_h, res):
+        # View of a padded image, shifted by the offset of a tap
+        return(img_pad[:, (pad_size + off_v):(pad_size + off_v + res.v), (pad_size + off_h):(pad_size + off_h + res.h)])
+
+    def _guides(self, guides_pad, pad_size, off_v, off_h, res, bufs):
+        # Albedo, normal and depth terms of the weight exponent of one offset [1, v, h]
+        # NOTE: they do not depend on the colors, only the offset changes between iterations
+        guides   = self._window(guides_pad, pad_size, 0, 0, res)
+        guides_q = self._window(guides_pad, pad_size, off_v, off_h, res)
+        buf_6, buf_d, buf_m, terms = bufs
+
+        # Albedo and normals are pre-scaled by their sigmas
+        torch.sub(guides_q[0:6], guides[0:6], out = buf_6)
+        torch.sum(buf_6.square_(), dim = 0, keepdim = True, out = terms)
+
+        # Depth differences are relative to the farther of the pair
+        torch.sub(guides_q[6:7], guides[6:7], out = buf_d)
+        torch.maximum(guides_q[6:7], guides[6:7], out = buf_m)
+        terms.add_(buf_d.div_(buf_m.clamp_min_(1e-6)).square_(), alpha = 1 / (self.sigma_dpt ** 2))
+
+        return(terms)
+
+    @prof.timed('denoise')
+    def __call__(self, cols, feats, res):
+        # cols: linear radiance [n, 3], feats: albedo, normal and depth [n, 7]
+        # NOTE: images are [c, v, h], the taps slice contiguous rows
+        cols   = cols.view(res.v, res.h, 3).permute(2, 0, 1).contiguous()
+        feats  = feats.reshape(res.v, res.h, 7).permute(2, 0, 1)
+        guides = torch.cat([feats[0:3] / self.sigma_alb, feats[3:6] / self.sigma_nrm, feats[6:7]], dim = 0)
+
+        # Guides are padded once for the widest footprint
+        max_pad    = 2 * 2 ** (self.iterations - 1)
+        guides_pad = self._pad(guides, max_pad)
+
+        # Scratch buffers, reused by every tap of every iteration
+        bufs  = tuple(torch.empty((c, res.v, res.h), dtype = ftype, device = cols.device) for c in (6, 1, 1, 1))
+        buf_3 = torch.empty((3, res.v, res.h), dtype = ftype, device = cols.device)
+        ws    = torch.empty((1, res.v, res.h), dtype = ftype, device = cols.device)
+        acc   = torch.empty_like(cols)
+        wsum  = torch.empty_like(ws)
+
+        # Guide terms of the outer taps are the inner taps of the next iteration,
+        # e.g. offset 2 at step 1 is offset 1 at step 2, they are kept until then
+        cache = {}
+
+        for it in range(self.iterations):
+            # NOTE: the holes of the kernel grow, its footprint doubles every iteration
+            step      = 2 ** it
+            sigma_col = self.sigma_col * 2 ** -it
+
+            # Colors are compared after gamma correction, like they are displayed
+            tones = torch.sqrt(torch.clamp_min(cols, 0) / 255)
+
+            cols_pad = self._pad(torch.cat([cols, tones], dim = 0), 2 * step)
+
+            # NOTE: the center tap always has a weight of 9 / 64
+            center = self.taps[2] * self.taps[2]
+            torch.mul(cols, center, out = acc)
+            wsum.fill_(center)
+
+            for i, tap_v in enumerate(self.taps):
+                for j, tap_h in enumerate(self.taps):
+                    if i == 2 and j == 2:
+                        continue
+
+                    off_v = (i - 2) * step
+                    off_h = (j - 2) * step
+
+                    terms = cache.pop((off_v, off_h), None)
+                    if terms is None:
+                        terms = self._guides(guides_pad, max_pad, off_v, off_h, res, bufs)
+
+                        if i % 2 == 0 and j % 2 == 0 and it + 1 < self.iterations:
+                            terms = terms.clone()
+                            cache[(off_v, off_h)] = terms
+
+                    cols_q = self._window(cols_pad, 2 * step, off_v, off_h, res)
+
+                    # ws = tap * exp(-(color distance / sigma_col^2 + guide terms))
+                    torch.sub(cols_q[3:6], tones, out = buf_3)
+                    torch.sum(buf_3.square_(), dim = 0, keepdim = True, out = ws)
+                    ws.mul_(1 / (sigma_col ** 2)).add_(terms).neg_().exp_().mul_(tap_v * tap_h)
+
+                    acc.addcmul_(ws, cols_q[0:3])
+                    wsum.add_(ws)
+
+            cols = acc / wsum
+
+        return(cols.permute(1, 2, 0).reshape(-1, 3))
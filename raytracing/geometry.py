@@ -1,13 +1,333 @@
 import torch
 from torch.nn.functional import normalize
 
-from utils.torch      import ftype
-from utils.consts     import t_min
+from math             import inf
 
-from raytracing.rays  import RayHits
+from utils.torch      import DmModule, ftype
+from utils.consts     import t_min, pi
+from utils.kernels    import kernel
+from utils.profiler   import prof
+
+from raytracing.rays  import Rays, RayHits, RayHitAggr
+from raytracing.bvh   import FlatBVH, BinnedBuilder
 from raytracing.scene import Object, AlignedBox
 
+@kernel
+def intersectSpheres(cents, rads, orig, dirs):
+    oc   = cents - orig
+    # NOTE: dot product on the last axis
+    d_oc = torch.sum(dirs * oc, dim = 1)
+    oc_2 = torch.sum(torch.pow(oc, 2), dim = 1)
+    r_2  = torch.pow(rads, 2)
+    disc = torch.pow(d_oc, 2) - oc_2 + r_2
+
+    hit_mask = disc >= 0
+
+    ts_p = d_oc + torch.sqrt(disc.clamp(0))
+    ts_n = d_oc - torch.sqrt(disc.clamp(0))
+    face = ts_n > t_min
+    ts   = torch.where(face, ts_n, ts_p)
+
+    hit_mask &= ts >= t_min
+
+    return(ts.masked_fill(~hit_mask, inf), face)
+
+@kernel
+def intersectTriangles(v_0, v_1, v_2, orig, dirs):
+    # Möller-Trumbore, barycentric coordinates from Cramer's rule
+    e_1  = v_1 - v_0
+    e_2  = v_2 - v_0
+    pvec = torch.cross(dirs, e_2, dim = 1)
+    det  = torch.sum(e_1 * pvec, dim = 1)
+    inv  = 1 / det
+
+    tvec = orig - v_0
+    us   = torch.sum(tvec * pvec, dim = 1) * inv
+    qvec = torch.cross(tvec, e_1, dim = 1)
+    vs   = torch.sum(dirs * qvec, dim = 1) * inv
+    ts   = torch.sum(e_2 * qvec, dim = 1) * inv
+
+    # NOTE: rays parallel to the plane have no hit, the face follows the winding
+    hit_mask = (torch.abs(det) > 1e-12) & (us >= 0) & (vs >= 0) & (us + vs <= 1) & (ts >= t_min)
+
+    return(ts.masked_fill(~hit_mask, inf), det > 0)
+
+@kernel
+def intersectPlanes(points, norms, orig, dirs):
+    denom = torch.sum(dirs * norms, dim = 1)
+    ts    = torch.sum((points - orig) * norms, dim = 1) / denom
+
+    # NOTE: rays parallel to the plane have no hit, front faces look at the normal
+    hit_mask = (torch.abs(denom) > 1e-12) & (ts >= t_min)
+
+    return(ts.masked_fill(~hit_mask, inf), denom < 0)
+
+class SphereStore(DmModule):
+    # NOTE: spheres are their own prims, nested stores have prims inside theirs
+    nested    = False
+    unbounded = False
+
+    def __init__(self, cents, rads, mat_ids, obj_ids, **kwargs):
+        self.cents   = cents   # Sphere centers                   [n, 3]
+        self.rads    = rads    # Sphere radii                     [n,]
+        self.mat_ids = mat_ids # Material ids                     [n,]
+        self.obj_ids = obj_ids # Object ids in the scene          [n,]
+
+        super().__init__(device = cents.device, **kwargs)
+
+    @staticmethod
+    def pack(spheres, obj_ids, **kwargs):
+        # NOTE: build parameters only matter to stores with hierarchies of their own
+        obj_ids = torch.tensor(obj_ids, dtype = torch.long, device = spheres[0].device)
+
+        # NOTE: every object is its own material, material ids are object ids
+        return(SphereStore(
+            cents   = torch.cat([sph.cent for sph in spheres], dim = 0),
+            rads    = torch.tensor([sph.rad for sph in spheres], dtype = ftype, device = obj_ids.device),
+            mat_ids = obj_ids.clone(),
+            obj_ids = obj_ids
+        ))
+
+    def __len__(self):
+        return(self.cents.shape[0])
+
+    def bounds(self):
+        rads = self.rads.view(-1, 1)
+
+        return(self.cents - rads, self.cents + rads)
+
+    def update(self, sph_ids, cent = None, rad = None):
+        if cent is not None:
+            self.cents[sph_ids] = cent.view(-1, 3)
+        if rad is not None:
+            self.rads[sph_ids] = rad.view(-1)
+
+    def intersect(self, orig, dirs, sph_ids):
+        # NOTE: one row per (ray, sphere) pair, e.g. every sphere of a leaf range
+        return(intersectSpheres(self.cents[sph_ids], self.rads[sph_ids], orig, dirs))
+
+    def normals(self, rays, ps, sph_ids):
+        return(normalize(ps - self.cents[sph_ids], dim = 1))
+
+    def _coneCos(self, ps, sph_ids):
+        # Cosine of the half angle of the cone the sphere fills, seen from ps
+        dists = torch.norm(self.cents[sph_ids] - ps, dim = 1)
+
+        return(torch.sqrt(torch.clamp_min(1 - torch.pow(self.rads[sph_ids] / dists, 2), 0)))
+
+    def solidAngles(self, ps, sph_ids):
+        return(2 * pi * (1 - self._coneCos(ps, sph_ids)))
+
+    def sampleDirs(self, ps, sph_ids):
+        # Directions uniform in the solid angle of the spheres
+        axes    = normalize(self.cents[sph_ids] - ps, dim = 1)
+        cos_max = self._coneCos(ps, sph_ids)
+
+        cos_t = 1 - torch.rand_like(cos_max) * (1 - cos_max)
+        sin_t = torch.sqrt(torch.clamp_min(1 - torch.pow(cos_t, 2), 0))
+        phi   = torch.rand_like(cos_max) * (2 * pi)
+
+        helps = torch.zeros_like(axes)
+        helps[:, 0] = (torch.abs(axes[:, 0]) < 0.9).type(ftype)
+        helps[:, 1] = 1 - helps[:, 0]
+
+        tans  = normalize(torch.cross(helps, axes, dim = 1), dim = 1)
+        bitns = torch.cross(axes, tans, dim = 1)
+
+        dirs = (tans * torch.cos(phi).view(-1, 1) + bitns * torch.sin(phi).view(-1, 1)) * sin_t.view(-1, 1) + axes * cos_t.view(-1, 1)
+
+        return(dirs, 2 * pi * (1 - cos_max))
+
+class MeshStore(DmModule):
+    nested    = True
+    unbounded = False
+
+    def __init__(self, verts, faces, roots, node_mins, node_maxes, node_left, node_right, node_first, node_count, tri_ids, mat_ids, obj_ids, **kwargs):
+        self.verts      = verts      # Vertices of every mesh                [v, 3]
+        self.faces      = faces      # Vertex ids of every triangle          [t, 3]
+        self.roots      = roots      # Root node of every mesh               [n,]
+        self.node_mins  = node_mins  # Nodes of the per-mesh BVHs, one array [m, 3]
+        self.node_maxes = node_maxes #                                       [m, 3]
+        self.node_left  = node_left  #                                       [m,]
+        self.node_right = node_right #                                       [m,]
+        self.node_first = node_first #                                       [m,]
+        self.node_count = node_count #                                       [m,]
+        self.tri_ids    = tri_ids    # Triangle ids ordered by leaf          [t,]
+        self.mat_ids    = mat_ids    # Material ids                          [n,]
+        self.obj_ids    = obj_ids    # Object ids in the scene               [n,]
+
+        super().__init__(device = verts.device, **kwargs)
+
+    @staticmethod
+    def pack(meshes, obj_ids, bins = 16, leaf_size = 4, cache = None):
+        obj_ids = torch.tensor(obj_ids, dtype = torch.long, device = meshes[0].device)
+        parts   = {name: [] for name in ('verts', 'faces', 'roots', 'mins', 'maxes', 'left', 'right', 'first', 'count', 'tri_ids')}
+
+        # NOTE: every mesh gets its own BVH over its triangles, the node arrays
+        # are concatenated and every mesh is traversed from its own root
+        n_verts = n_tris = n_nodes = 0
+        for mesh in meshes:
+            bvh = mesh.genBVH(bins, leaf_size, cache)
+
+            parts['verts'].append(mesh.verts)
+            parts['faces'].append(mesh.faces + n_verts)
+            parts['roots'].append(n_nodes)
+            parts['mins'].append(bvh.mins)
+            parts['maxes'].append(bvh.maxes)
+            parts['left'].append(torch.where(bvh.left >= 0, bvh.left + n_nodes, bvh.left))
+            parts['right'].append(torch.where(bvh.right >= 0, bvh.right + n_nodes, bvh.right))
+            parts['first'].append(bvh.first + n_tris)
+            parts['count'].append(bvh.count)
+            parts['tri_ids'].append(bvh.prim_ids + n_tris)
+
+            n_verts += len(mesh.verts)
+            n_tris  += len(mesh.faces)
+            n_nodes += len(bvh)
+
+        return(MeshStore(
+            verts      = torch.cat(parts['verts'], dim = 0),
+            faces      = torch.cat(parts['faces'], dim = 0),
+            roots      = torch.tensor(parts['roots'], dtype = torch.long, device = obj_ids.device),
+            node_mins  = torch.cat(parts['mins'], dim = 0),
+            node_maxes = torch.cat(parts['maxes'], dim = 0),
+            node_left  = torch.cat(parts['left']),
+            node_right = torch.cat(parts['right']),
+            node_first = torch.cat(parts['first']),
+            node_count = torch.cat(parts['count']),
+            tri_ids    = torch.cat(parts['tri_ids']),
+            mat_ids    = obj_ids.clone(),
+            obj_ids    = obj_ids
+        ))
+
+    def __len__(self):
+        return(self.roots.shape[0])
+
+    def bvh(self):
+        # NOTE: a view of the node arrays, kept as plain tensors for scene files
+        return(FlatBVH(
+            mins     = self.node_mins,
+            maxes    = self.node_maxes,
+            left     = self.node_left,
+            right    = self.node_right,
+            first    = self.node_first,
+            count    = self.node_count,
+            prim_ids = self.tri_ids
+        ))
+
+    def bounds(self):
+        return(self.node_mins[self.roots], self.node_maxes[self.roots])
+
+    def update(self, mesh_ids, **params):
+        raise Exception("Meshes cannot be updated, use an Instance transform!")
+
+    def _triVerts(self, tri_ids):
+        verts = self.verts[self.faces[tri_ids]]
+
+        return(verts[:, 0, :], verts[:, 1, :], verts[:, 2, :])
+
+    def intersect(self, orig, dirs, mesh_ids):
+        # NOTE: one row per (ray, mesh) pair, returns the triangles hit as well
+        hit_aggr = RayHitAggr(Rays(origins = orig, directions = dirs))
+        bvh      = self.bvh()
+
+        def leaves(ray_ids, node_ids):
+            ray_ids, tri_ids = bvh.leafPrims(ray_ids, node_ids)
+            prof.count('tri_tests', len(ray_ids))
+
+            ts, face = intersectTriangles(*self._triVerts(tri_ids), orig[ray_ids], dirs[ray_ids])
+            hit_aggr.aggregate(ray_ids, tri_ids, ts, face)
+
+        bvh.traverse(orig, 1 / dirs, hit_aggr.ts, leaves, node_ids = self.roots[mesh_ids])
+
+        return(hit_aggr.ts, hit_aggr.face, hit_aggr.prim_ids)
+
+    def normals(self, rays, ps, mesh_ids, tri_ids):
+        v_0, v_1, v_2 = self._triVerts(tri_ids)
+
+        # NOTE: geometric normals, counter-clockwise triangles face outwards
+        return(normalize(torch.cross(v_1 - v_0, v_2 - v_0, dim = 1), dim = 1))
+
+class TriangleMesh(Object):
+    store_type = MeshStore
+
+    def __init__(self, vertices, faces, **kwargs):
+        if vertices.dim() != 2 or vertices.shape[1] != 3 or \
+        vertices.dtype != ftype or \
+        faces.dim() != 2 or faces.shape[1] != 3 or \
+        faces.dtype != torch.long or len(faces) == 0 or \
+        faces.min() < 0 or faces.max() >= len(vertices):
+            raise Exception("Invalid mesh parameters!")
+
+        self.verts      = vertices
+        self.faces      = faces
+        self.bvh        = None # BVH over the triangles, kept between packs
+        self.bvh_params = None
+        self.store      = None # Single mesh store of the recursive engine
+
+        super().__init__(**kwargs)
+
+    def genBVH(self, bins = 16, leaf_size = 4, cache = None):
+        # NOTE: built once per mesh and parameters, or loaded from the cache
+        if self.bvh is not None and self.bvh_params == (bins, leaf_size):
+            return(self.bvh)
+
+        tris  = self.verts[self.faces]
+        mins  = torch.min(tris, dim = 1).values
+        maxes = torch.max(tris, dim = 1).values
+
+        bvh = None
+        if cache is not None:
+            key = cache.key(mins, maxes, 'mesh', bins, leaf_size)
+            bvh = cache.get(key)
+
+        if bvh is not None:
+            bvh = bvh.to(self.device)
+        else:
+            bvh = BinnedBuilder(bins, leaf_size).build(mins, maxes)
+
+            if cache is not None:
+                cache.put(key, bvh)
+
+        self.bvh        = bvh
+        self.bvh_params = (bins, leaf_size)
+
+        return(self.bvh)
+
+    def genAlignedBox(self):
+        return(AlignedBox(
+            torch.max(self.verts, dim = 0).values,
+            torch.min(self.verts, dim = 0).values,
+            self
+        ))
+
+    def intersect(self, rays):
+        if self.store is None or self.store.verts.device != rays.device:
+            self.store = MeshStore.pack([self], [0])
+
+        mesh_ids = torch.zeros((len(rays),), dtype = torch.long, device = rays.device)
+
+        ts, face, tri_ids = self.store.intersect(rays.orig, rays.dirs, mesh_ids)
+        hit_mask = torch.isfinite(ts)
+
+        if not torch.any(hit_mask):
+            return(None)
+
+        ps = rays[hit_mask](ts[hit_mask])
+
+        hits = RayHits(
+            rays     = rays,
+            hit_mask = hit_mask,
+            ts       = ts,
+            ps       = ps,
+            ns       = self.store.normals(rays[hit_mask], ps, mesh_ids[hit_mask], tri_ids[hit_mask]),
+            face     = face[hit_mask]
+        )
+
+        return(hits)
+
 class Sphere(Object):
+    store_type = SphereStore
+
     def __init__(self, center, radius, **kwargs):
         if center.shape != torch.Size([3]) or \
         center.dtype != ftype or \
@@ -19,6 +339,12 @@ class Sphere(Object):
 
         super().__init__(**kwargs)
 
+    def update(self, cent = None, rad = None):
+        if cent is not None:
+            self.cent = cent.view(1, 3).to(self.device)
+        if rad is not None:
+            self.rad = float(rad)
+
     def genAlignedBox(self):
         rads = torch.full([3], self.rad, dtype = ftype, device = self.device)
 
@@ -29,27 +355,12 @@ class Sphere(Object):
         ))
 
     def intersect(self, rays):
-        oc   = self.cent - rays.orig
-        # NOTE: dot product on the last axis
-        d_oc = torch.einsum('ij,ij->i', rays.dirs, oc)
-        oc_2 = torch.sum(torch.pow(oc, 2), dim = 1)
-        r_2  = pow(self.rad, 2)
-        disc = torch.pow(d_oc, 2) - oc_2 + r_2
-
-        hit_mask = disc >= 0
-
-        ts_p = d_oc + torch.sqrt(disc.clamp(0))
-        ts_n = d_oc - torch.sqrt(disc.clamp(0))
-        face = ts_n > t_min
-        ts   = torch.where(face, ts_n, ts_p)
-
-        hit_mask[ts < t_min] = False
+        ts, face = intersectSpheres(self.cent, torch.full((1,), self.rad, dtype = ftype, device = self.device), rays.orig, rays.dirs)
+        hit_mask = torch.isfinite(ts)
 
         if not torch.any(hit_mask):
             return(None)
 
-        ts[~hit_mask] = torch.inf
-
         ps   = rays[hit_mask](ts[hit_mask])
         ns   = normalize(ps - self.cent, dim = 1)
         face = face[hit_mask]
@@ -63,4 +374,89 @@ class Sphere(Object):
             face     = face
         )
 
-        return(hits)    
\ No newline at end of file
+        return(hits)
+
+# ==============================================================================
+class PlaneStore(DmModule):
+    # NOTE: infinite prims, scenes keep them out of the BVH
+    nested    = False
+    unbounded = True
+
+    def __init__(self, points, norms, mat_ids, obj_ids, **kwargs):
+        self.points  = points  # A point of every plane           [n, 3]
+        self.norms   = norms   # Plane normals, front faces       [n, 3]
+        self.mat_ids = mat_ids # Material ids                     [n,]
+        self.obj_ids = obj_ids # Object ids in the scene          [n,]
+
+        super().__init__(device = points.device, **kwargs)
+
+    @staticmethod
+    def pack(planes, obj_ids, **kwargs):
+        obj_ids = torch.tensor(obj_ids, dtype = torch.long, device = planes[0].device)
+
+        return(PlaneStore(
+            points  = torch.cat([plane.point for plane in planes], dim = 0),
+            norms   = torch.cat([plane.norm for plane in planes], dim = 0),
+            mat_ids = obj_ids.clone(),
+            obj_ids = obj_ids
+        ))
+
+    def __len__(self):
+        return(self.points.shape[0])
+
+    def bounds(self):
+        return(torch.full_like(self.points, -inf), torch.full_like(self.points, inf))
+
+    def update(self, plane_ids, point = None, norm = None):
+        if point is not None:
+            self.points[plane_ids] = point.view(-1, 3)
+        if norm is not None:
+            self.norms[plane_ids] = normalize(norm.view(-1, 3), dim = 1)
+
+    def intersect(self, orig, dirs, plane_ids):
+        return(intersectPlanes(self.points[plane_ids], self.norms[plane_ids], orig, dirs))
+
+    def normals(self, rays, ps, plane_ids):
+        return(self.norms[plane_ids])
+
+class Plane(Object):
+    store_type = PlaneStore
+
+    def __init__(self, point, normal, **kwargs):
+        if point.shape != torch.Size([3]) or \
+        normal.shape != torch.Size([3]) or \
+        point.dtype != ftype or \
+        normal.dtype != ftype or \
+        torch.norm(normal) == 0:
+            raise Exception("Invalid plane parameters!")
+
+        self.point = point.view(1, 3)
+        self.norm  = normalize(normal, dim = 0).view(1, 3)
+
+        super().__init__(**kwargs)
+
+    def update(self, point = None, norm = None):
+        if point is not None:
+            self.point = point.view(1, 3).to(self.device)
+        if norm is not None:
+            self.norm = normalize(norm.view(1, 3), dim = 1).to(self.device)
+
+    def intersect(self, rays):
+        ts, face = intersectPlanes(self.point, self.norm, rays.orig, rays.dirs)
+        hit_mask = torch.isfinite(ts)
+
+        if not torch.any(hit_mask):
+            return(None)
+
+        ps = rays[hit_mask](ts[hit_mask])
+
+        hits = RayHits(
+            rays     = rays,
+            hit_mask = hit_mask,
+            ts       = ts,
+            ps       = ps,
+            ns       = self.norm.expand(ps.shape[0], 3),
+            face     = face[hit_mask]
+        )
+
+        return(hits)
@@ -3,17 +3,151 @@ from torch.nn.functional import normalize
 
 from utils.consts    import eps
 from utils.torch     import DmModule, ftype
-from utils.rand      import randOnSphere
+from utils.rand      import randOnSphere, randUniform
+from utils.profiler  import prof
+from utils.kernels   import kernel
 
 from raytracing.rays import RayBounces
 
+def materialClass(mat):
+    # NOTE: the class implementing the scatter kernel decides the table
+    for mat_class in type(mat).__mro__:
+        if 'scatter' in mat_class.__dict__:
+            return(mat_class)
+
+    raise Exception("Object has no material!")
+
+class MaterialTable(DmModule):
+    def __init__(self, mat_classes, class_ids, rows, tables, **kwargs):
+        self.mat_classes = mat_classes # Material classes with a scatter kernel
+        self.class_ids   = class_ids   # Class of every material id             [n,]
+        self.rows        = rows        # Row of every material id in its table  [n,]
+        self.tables      = tables      # Per-class dicts of parameter rows
+
+        super().__init__(device = class_ids.device, **kwargs)
+
+    @staticmethod
+    def pack(mats):
+        mat_classes = []
+        mat_groups  = []
+        class_ids   = []
+        rows        = []
+
+        for mat in mats:
+            mat_class = materialClass(mat)
+
+            if mat_class not in mat_classes:
+                mat_classes.append(mat_class)
+                mat_groups.append([])
+
+            class_id = mat_classes.index(mat_class)
+
+            class_ids.append(class_id)
+            rows.append(len(mat_groups[class_id]))
+            mat_groups[class_id].append(mat.getParams())
+
+        tables = [
+            {name: torch.cat([params[name] for params in group], dim = 0) for name in group[0]}
+            for group in mat_groups
+        ]
+
+        device = mats[0].device
+
+        return(MaterialTable(
+            mat_classes = mat_classes,
+            class_ids   = torch.tensor(class_ids, dtype = torch.long, device = device),
+            rows        = torch.tensor(rows, dtype = torch.long, device = device),
+            tables      = tables
+        ))
+
+    def to(self, device):
+        self.tables = [
+            {name: param.to(torch.device(device)) for name, param in table.items()}
+            for table in self.tables
+        ]
+
+        super().to(device)
+
+        return(self)
+
+    def gather(self, class_id, mat_ids):
+        rows = self.rows[mat_ids]
+
+        return({name: param[rows] for name, param in self.tables[class_id].items()})
+
+def _pixIds(hits):
+    # NOTE: pixels of the hit rays index the sample sequences of the bounce
+    return(hits.rays.pix_ids[hits.hit_mask] if hits.rays.pix_ids is not None else None)
+
+# Kernels ======================================================================
+# NOTE: random numbers are drawn outside, the kernels are pure tensor math
+@kernel
+def scatterDiffuse(ns, rands):
+    return(normalize(ns + rands * (1 - eps), dim = 1))
+
+@kernel
+def scatterShiny(dirs, ns):
+    return(dirs - 2 * torch.sum(dirs * ns, dim = 1, keepdim = True) * ns)
+
+@kernel
+def scatterMetal(dirs, ns, fuzz, rands):
+    ray_norm = -torch.sum(dirs * ns, dim = 1, keepdim = True)
+    ray_nout = torch.maximum(ray_norm, fuzz)
+    ray_corr = torch.sqrt((1 - torch.pow(ray_nout, 2)) / ((1 + eps) - torch.pow(ray_norm, 2)))
+
+    ray_dir  = ray_corr * (dirs + ray_norm * ns) + ns * ray_nout
+
+    rand_dir = rands * (fuzz - eps)  # NOTE: safeguard against 0, 0, 0 ray_rand
+
+    return(normalize(ray_dir + rand_dir, dim = 1))
+
+@kernel
+def glowAlbedo(dirs, ns, alb, glow_max, glow_min):
+    ray_norm = torch.sum(dirs * ns, dim = 1)
+    glow     = glow_min - ray_norm * (glow_max - glow_min)
+
+    return(alb * glow.view(-1, 1))
+
+@kernel
+def scatterGlass(dirs, ns, face, alb, eta, rands):
+    etas      = torch.where(face, 1 / eta, eta)
+    ns_face   = (1 - 2 * face.type(ns.dtype)).view(-1, 1) * ns
+
+    cos_theta = torch.sum(dirs * ns_face, dim = 1)
+    ray_perp  = etas.view(-1, 1) * (dirs - cos_theta.view(-1, 1) * ns_face)
+    ray_para  = torch.sqrt(torch.abs(1.0 - torch.sum(ray_perp * ray_perp, dim = 1))).view(-1, 1) * ns_face
+    refr_dir  = ray_perp + ray_para
+
+    sin_theta = torch.sqrt(1.0 - torch.pow(cos_theta, 2))
+
+    # Schlick's approx
+    r0 = torch.pow((1 - etas) / (1 + etas), 2)
+    refl = r0 + (1 - r0) * torch.pow((1 - cos_theta), 5)
+
+    refl_mask = torch.logical_or((etas * sin_theta) > 1.0, refl > rands)
+    refl_dir  = dirs - 2 * cos_theta.view(-1, 1) * ns_face
+
+    out_dirs  = torch.where(refl_mask.view(-1, 1), refl_dir, refr_dir)
+    alb       = torch.where(face.view(-1, 1), alb, torch.ones_like(alb))
+
+    return(out_dirs, alb)
+
+# ==============================================================================
 class Material(DmModule):
+    # NOTE: emissive materials are sampled as lights by next event estimation
+    emissive = False
+
     def __init__(self, albedo, **kwargs):
         self.alb = albedo.view(1, 3)
 
         super().__init__(**kwargs)
 
-    def bounceTo(self, hits, tracer):
+    def getParams(self):
+        # NOTE: single rows, they broadcast like the gathered rows of a table
+        return({'alb': self.alb})
+
+    @staticmethod
+    def scatterTo(hits, tracer, alb, **params):
         n_dir = torch.clamp_min(torch.einsum('ij,ij->i', tracer.dir_light, hits.ns), 0)
         col   = torch.lerp(tracer.col_ambnt, tracer.col_light, n_dir.view(-1, 1))
 
@@ -21,33 +155,44 @@ class Material(DmModule):
             hits     = hits,
             bnc_mask = n_dir > 0,
             out_dirs = tracer.dir_light.repeat(hits.ns.shape[0], 1),
-            alb      = self.alb * col
+            alb      = alb * col
         )
 
         return(bncs)
 
-class Diffuse(Material):
+    @prof.timed('bounce')
+    def bounceTo(self, hits, tracer):
+        return(self.scatterTo(hits, tracer, **self.getParams()))
+
+    @prof.timed('bounce')
     def bounce(self, hits):
-        out_dirs = normalize(hits.ns + randOnSphere(hits.ns.shape[0], self.device) * (1 - eps), dim = 1)
+        return(self.scatter(hits, **self.getParams()))
+
+class Diffuse(Material):
+    @staticmethod
+    def scatter(hits, alb):
+        out_dirs = scatterDiffuse(hits.ns, randOnSphere(hits.ns.shape[0], hits.ns.device, _pixIds(hits)))
 
         bncs = RayBounces(
             hits     = hits,
-            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = self.device),
+            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = hits.ns.device),
             out_dirs = out_dirs,
-            alb      = self.alb.repeat(hits.ns.shape[0], 1)
+            alb      = alb.expand(hits.ns.shape[0], 3),
+            diffuse  = True
         )
 
         return(bncs)
 
 class Shiny(Material):
-    def bounce(self, hits):
-        out_dirs = hits.rays.dirs[hits.hit_mask, :] - 2 * torch.einsum('ij,ij->i', hits.rays.dirs[hits.hit_mask, :], hits.ns).view(-1, 1) * hits.ns
+    @staticmethod
+    def scatter(hits, alb):
+        out_dirs = scatterShiny(hits.rays.dirs[hits.hit_mask, :], hits.ns)
 
         bncs = RayBounces(
             hits     = hits,
-            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = self.device),
+            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = hits.ns.device),
             out_dirs = out_dirs,
-            alb      = self.alb.repeat(hits.ns.shape[0], 1)
+            alb      = alb.expand(hits.ns.shape[0], 3)
         )
 
         return(bncs)
@@ -58,42 +203,49 @@ class Metal(Material):
 
         super().__init__(**kwargs)
 
-    def bounce(self, hits):
-        ray_norm = -torch.einsum("ij,ij->i", hits.rays.dirs[hits.hit_mask, :], hits.ns).view(-1, 1)
-        ray_nout = torch.clamp_min(ray_norm, self.fuzz)
-        ray_corr = torch.sqrt((1 - torch.pow(ray_nout, 2)) / ((1 + eps) - torch.pow(ray_norm, 2)))
-
-        ray_dir  = ray_corr * (hits.rays.dirs[hits.hit_mask, :] + ray_norm * hits.ns) + hits.ns * ray_nout
+    def getParams(self):
+        params = super().getParams()
+        params['fuzz'] = torch.full((1, 1), self.fuzz, dtype = ftype, device = self.device)
 
-        rand_dir = randOnSphere(hits.ns.shape[0], self.device) * (self.fuzz - eps)  # NOTE: safeguard against 0, 0, 0 ray_rand
+        return(params)
 
-        out_dirs = normalize(ray_dir + rand_dir, dim = 1)
+    @staticmethod
+    def scatter(hits, alb, fuzz):
+        rands    = randOnSphere(hits.ns.shape[0], hits.ns.device, _pixIds(hits))
+        out_dirs = scatterMetal(hits.rays.dirs[hits.hit_mask, :], hits.ns, fuzz, rands)
 
         bncs = RayBounces(
             hits     = hits,
-            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = self.device),
+            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = hits.ns.device),
             out_dirs = out_dirs,
-            alb      = self.alb.repeat(hits.ns.shape[0], 1)
+            alb      = alb.expand(hits.ns.shape[0], 3)
         )
 
         return(bncs)
 
 class Glowing(Material):
+    emissive = True
+
     def __init__(self, glow_max, glow_min, **kwargs):
         self.glow_max = glow_max * 255
         self.glow_min = glow_min * 255
 
         super().__init__(**kwargs)
 
-    def bounce(self, hits):
-        ray_norm = torch.einsum('ij,ij->i', hits.rays.dirs[hits.hit_mask, :], hits.ns)
-        glow     = self.glow_min - ray_norm * (self.glow_max - self.glow_min)
+    def getParams(self):
+        params = super().getParams()
+        params['glow_max'] = torch.full((1,), self.glow_max, dtype = ftype, device = self.device)
+        params['glow_min'] = torch.full((1,), self.glow_min, dtype = ftype, device = self.device)
+
+        return(params)
 
+    @staticmethod
+    def scatter(hits, alb, glow_max, glow_min):
         bncs = RayBounces(
             hits     = hits,
-            bnc_mask = torch.zeros((hits.ns.shape[0],), dtype = torch.bool, device = self.device),
-            out_dirs = torch.zeros((hits.ns.shape[0], 3), dtype = ftype, device = self.device),
-            alb      = self.alb * glow.view(-1, 1)
+            bnc_mask = torch.zeros((hits.ns.shape[0],), dtype = torch.bool, device = hits.ns.device),
+            out_dirs = torch.zeros((hits.ns.shape[0], 3), dtype = ftype, device = hits.ns.device),
+            alb      = glowAlbedo(hits.rays.dirs[hits.hit_mask, :], hits.ns, alb, glow_max, glow_min)
         )
 
         return(bncs)
@@ -104,33 +256,22 @@ class Glass(Material):
 
         super().__init__(**kwargs)
 
-    def bounce(self, hits):
-        etas      = torch.where(hits.face, 1 / self.eta, self.eta)
-        ns_face   = (1 - 2 * hits.face).view(-1, 1) * hits.ns
-
-        cos_theta = torch.einsum('ij,ij->i', hits.rays.dirs[hits.hit_mask, :], ns_face)
-        ray_perp  = etas.view(-1, 1) * (hits.rays.dirs[hits.hit_mask, :] - cos_theta.view(-1, 1) * ns_face)
-        ray_para  = torch.sqrt(torch.abs(1.0 - torch.einsum('ij,ij->i', ray_perp, ray_perp))).view(-1, 1) * ns_face
-        refr_dir  = ray_perp + ray_para
-
-        sin_theta = torch.sqrt(1.0 - torch.pow(cos_theta, 2))
+    def getParams(self):
+        params = super().getParams()
+        params['eta'] = torch.full((1,), self.eta, dtype = ftype, device = self.device)
 
-        # Schlick's approx
-        r0 = torch.pow((1 - etas) / (1 + etas), 2)
-        refl = r0 + (1 - r0) * pow((1 - cos_theta), 5)
+        return(params)
 
-        refl_mask = torch.logical_or((etas * sin_theta) > 1.0, refl > torch.rand_like(etas))
-        refl_dir  = hits.rays.dirs[hits.hit_mask, :] - 2 * cos_theta.view(-1, 1) * ns_face
-
-        out_dirs  = torch.where(refl_mask.view(-1, 1), refl_dir, refr_dir)
-
-        alb       = torch.where(hits.face.view(-1, 1), self.alb, torch.ones_like(self.alb))
+    @staticmethod
+    def scatter(hits, alb, eta):
+        rands         = randUniform(hits.ns.shape[0], hits.ns.device, _pixIds(hits))
+        out_dirs, alb = scatterGlass(hits.rays.dirs[hits.hit_mask, :], hits.ns, hits.face, alb, eta, rands)
 
         bncs = RayBounces(
             hits     = hits,
-            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = self.device),
+            bnc_mask = torch.ones((hits.ns.shape[0],), dtype = torch.bool, device = hits.ns.device),
             out_dirs = out_dirs,
             alb      = alb
         )
 
-        return(bncs)
\ No newline at end of file
+        return(bncs)
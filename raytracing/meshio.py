@@ -0,0 +1,29 @@
+import torch
+
+from utils.torch import ftype
+
+def loadOBJ(path, device = 'cpu'):
+    # Vertices and faces of a Wavefront OBJ file, everything else is skipped
+    # NOTE: polygons are split into triangle fans, texture and normal ids of
+    # the face corners are dropped, normals come from the winding
+    verts = []
+    faces = []
+
+    with open(path, 'r') as in_file:
+        for line in in_file:
+            if line.startswith('v '):
+                verts.append([float(val) for val in line.split()[1:4]])
+            elif line.startswith('f '):
+                # Ids start at 1, negative ids count back from the last vertex
+                ids = [int(corner.split('/')[0]) for corner in line.split()[1:]]
+                ids = [i - 1 if i > 0 else len(verts) + i for i in ids]
+
+                faces.extend([ids[0], ids[k], ids[k + 1]] for k in range(1, len(ids) - 1))
+
+    if len(verts) == 0 or len(faces) == 0:
+        raise Exception("Not a mesh file!")
+
+    return(
+        torch.tensor(verts, dtype = ftype, device = device),
+        torch.tensor(faces, dtype = torch.long, device = device)
+    )
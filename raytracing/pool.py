@@ -0,0 +1,156 @@
+import torch
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from queue           import Empty
+from pathlib         import Path
+
+from utils.torch        import ftype
+from utils.common       import Timer
+
+from raytracing.sceneio import loadScene
+
+def _renderWorker(tracer, scene, vport, accum_name, tasks, results, threads):
+    torch.set_num_threads(threads)
+
+    # The scene and its BVH are loaded once, then tiles are pulled until a None
+    # NOTE: scene files are mapped by every worker instead of being pickled
+    if isinstance(scene, (str, Path)):
+        scene = loadScene(scene)
+
+    if scene.flat_bvh is None:
+        scene.build()
+
+    scene.to(tracer.device)
+    vport.to(tracer.device)
+
+    # NOTE: every worker compiles its own kernels, the disk cache is shared
+    tracer.warmUp(scene, vport)
+
+    # Rays of the warm-up are not part of the render
+    if getattr(tracer, 'rr_saved', None) is not None:
+        tracer.rr_saved.zero_()
+
+    accum_shm = shared_memory.SharedMemory(name = accum_name)
+    accum     = torch.frombuffer(accum_shm.buf, dtype = ftype)[:(len(vport) * tracer.channels)].view(-1, tracer.channels)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        v, h, samples, first_sample = task
+        pix_ids = vport.getTile(v, h, tracer.tile_size)
+
+        tile_buffer, n_rays = tracer.traceTile(scene, vport, pix_ids, samples, first_sample)
+
+        # NOTE: tiles of a pass never overlap, no locking is needed
+        accum[pix_ids.cpu(), :] += tile_buffer.cpu()
+
+        # Russian roulette counts of the tile are sent back and restarted
+        rr_saved = None
+        if getattr(tracer, 'rr_saved', None) is not None:
+            rr_saved = tracer.rr_saved.cpu().clone()
+            tracer.rr_saved.zero_()
+
+        results.put((n_rays, rr_saved))
+
+    del accum
+    accum_shm.close()
+
+class RenderPool():
+    def __init__(self, workers = None, threads = None, pass_samples = None):
+        self.workers      = mp.cpu_count() if workers is None else workers
+        self.threads      = threads if threads is not None else max(1, torch.get_num_threads() // self.workers)
+        self.pass_samples = pass_samples
+
+    def _collect(self, tracer, procs, results, n_tasks):
+        n_rays = 0
+
+        while n_tasks > 0:
+            try:
+                task_rays, rr_saved = results.get(timeout = 1)
+
+                n_rays  += task_rays
+                n_tasks -= 1
+
+                if rr_saved is not None:
+                    tracer.rr_saved += rr_saved.to(tracer.rr_saved.device)
+            except Empty:
+                if not all(proc.is_alive() for proc in procs):
+                    raise Exception("A render worker died!")
+
+        return(n_rays)
+
+    def render(self, tracer, scene, vport):
+        # NOTE: passes cover every tile, the noisy pixels of a pass are not tracked
+        if getattr(tracer, 'adaptive', False):
+            raise Exception("Adaptive sampling is not supported by the render pool!")
+
+        ctx = mp.get_context('spawn')
+
+        # NOTE: the workers trace with copies of the tracer, their counts are summed here
+        if getattr(tracer, 'rr_saved', None) is not None:
+            tracer.rr_saved.zero_()
+
+        # NOTE: every buffer column of the tracer is accumulated, features included
+        accum_tmp = torch.zeros((len(vport), tracer.channels), dtype = ftype)
+        accum_shm = shared_memory.SharedMemory(create = True, size = accum_tmp.element_size() * accum_tmp.numel())
+        accum     = torch.frombuffer(accum_shm.buf, dtype = ftype)[:(len(vport) * tracer.channels)].view(-1, tracer.channels)
+        accum.copy_(accum_tmp)
+
+        tasks   = ctx.Queue()
+        results = ctx.Queue()
+        procs   = [
+            ctx.Process(
+                target = _renderWorker,
+                args   = (tracer, scene, vport, accum_shm.name, tasks, results, self.threads),
+                daemon = True
+            )
+            for _ in range(self.workers)
+        ]
+
+        for proc in procs:
+            proc.start()
+
+        try:
+            # Samples are rendered in passes over every tile, a pass is finished
+            # before the next one is queued so tiles never overlap
+            pass_samples = tracer.samples if self.pass_samples is None else self.pass_samples
+            corners      = vport.getTileCorners(tracer.tile_size)
+            samples      = 0
+
+            # NOTE: the tracer works on the shared buffer for snapshots
+            tracer.buffer = accum
+
+            while samples < tracer.samples and not vport.stopRequested():
+                n_samples = min(pass_samples, tracer.samples - samples)
+
+                with Timer() as t:
+                    for v, h in corners:
+                        tasks.put((v, h, n_samples, samples))
+
+                    n_rays = self._collect(tracer, procs, results, len(corners))
+
+                samples += n_samples
+                print(f'{samples:04}', f'{(n_rays / t.elap / 1e6):.04} MR/s', t, sep = " - ")
+
+                if tracer.progressive and samples < tracer.samples:
+                    tracer._dumpBuffer(vport, samples, final = False)
+        finally:
+            for _ in procs:
+                tasks.put(None)
+
+            for proc in procs:
+                proc.join()
+
+        if getattr(tracer, 'rr_depth', None) is not None:
+            print('Rays terminated per depth', tracer.rr_saved.tolist(), sep = " - ")
+
+        # Merge the accumulated samples into the viewport
+        tracer.buffer = accum.clone()
+        tracer._dumpBuffer(vport, max(samples, 1))
+
+        del accum
+        accum_shm.close()
+        accum_shm.unlink()
@@ -1,25 +1,94 @@
 import torch
 
-from utils.torch import ftype
+from utils.torch    import ftype
+from utils.profiler import prof
 
 class Rays():
-    def __init__(self, origins, directions):
-        self.orig   = origins
-        self.dirs   = directions
-        self.device = origins.device
+    def __init__(self, origins, directions, pix_ids = None):
+        self.orig    = origins
+        self.dirs    = directions
+        self.pix_ids = pix_ids # Pixel of every ray, indexes sample sequences [n,]
+        self.device  = origins.device
 
     def __len__(self):
         return(self.orig.shape[0])
 
     def __getitem__(self, ids):
-        return(Rays(
+        rays = Rays(
             origins    = self.orig[ids, :],
-            directions = self.dirs[ids, :]
-        ))
+            directions = self.dirs[ids, :],
+            pix_ids    = self.pix_ids[ids] if self.pix_ids is not None else None
+        )
+
+        if prof.enabled:
+            prof.count('mask_copy_bytes', 2 * rays.orig.numel() * rays.orig.element_size())
+
+        return(rays)
 
     def __call__(self, ts):
         return(self.orig + ts.view(-1, 1) * self.dirs)
 
+class RayArena():
+    # NOTE: buffers of the aggregators, sized once and reused at every depth
+    specs = {
+        'hit_mask':     ((), torch.bool),
+        'hit_ts':       ((), ftype),
+        'hit_prim_ids': ((), torch.long),
+        'hit_face':     ((), torch.bool),
+        'hit_sub_ids':  ((), torch.long),
+        'hit_ts_min':   ((), ftype),
+        'hit_pairs':    ((), torch.long),
+        'bnc_hit_mask': ((), torch.bool),
+        'bnc_ts':       ((), ftype),
+        'bnc_ps':       ((3,), ftype),
+        'bnc_face':     ((), torch.bool),
+        'bnc_ns':       ((3,), ftype),
+        'bnc_prim_ids': ((), torch.long),
+        'bnc_bnc_mask': ((), torch.bool),
+        'bnc_out_dirs': ((3,), ftype),
+        'bnc_alb':      ((3,), ftype),
+        'bnc_diffuse':  ((), torch.bool),
+        'path_thru':    ((3,), ftype),
+        'path_rads':    ((3,), ftype)
+    }
+
+    def __init__(self, n, device):
+        self.n      = n
+        self.device = torch.device(device)
+
+        self.buffers = {
+            name: torch.empty((n, *shape), dtype = dtype, device = device)
+            for name, (shape, dtype) in self.specs.items()
+        }
+
+        # Bounce rays and the survivors of their compaction alternate slots
+        self.slots = [
+            (
+                torch.empty((n, 3), dtype = ftype, device = device),
+                torch.empty((n, 3), dtype = ftype, device = device),
+                torch.empty((n,), dtype = torch.long, device = device)
+            )
+            for _ in range(2)
+        ]
+        self.slot = 0
+
+    def buffer(self, name, n, value):
+        return(self.buffers[name][:n].fill_(value))
+
+    def compact(self, orig, dirs, pix_ids, mask):
+        # In-place stream compaction of the masked rays into the next slot
+        # NOTE: the ids are the one allocation left, their count is data dependent
+        ids = torch.nonzero(mask).view(-1)
+
+        s_orig, s_dirs, s_pix_ids = self.slots[self.slot]
+        self.slot = 1 - self.slot
+
+        s_orig    = torch.index_select(orig, 0, ids, out = s_orig[:len(ids)])
+        s_dirs    = torch.index_select(dirs, 0, ids, out = s_dirs[:len(ids)])
+        s_pix_ids = torch.index_select(pix_ids, 0, ids, out = s_pix_ids[:len(ids)]) if pix_ids is not None else None
+
+        return(Rays(origins = s_orig, directions = s_dirs, pix_ids = s_pix_ids))
+
 class RayHits():
     def __init__(self, rays, hit_mask, ts, ns, ps, face):
         self.rays     = rays
@@ -30,26 +99,107 @@ class RayHits():
         self.face     = face # True if front face hit              [n,]
 
 class RayBounces():
-    def __init__(self, hits, bnc_mask, out_dirs, alb):
+    def __init__(self, hits, bnc_mask, out_dirs, alb, diffuse = False):
         self.hits     = hits
         self.bnc_mask = bnc_mask # Bounce mask                [n,]
         self.out_dirs = out_dirs # Scattered ray directions   [n, 3]
         self.alb      = alb      # Transferred albedo         [n, 3]
+        self.diffuse  = diffuse  # Cosine weighted scattering, lights can be sampled
+
+class RayHitAggr():
+    def __init__(self, rays, costs = False, arena = None):
+        self.rays  = rays
+        self.arena = arena
+
+        if arena is not None:
+            self.hit_mask = arena.buffer('hit_mask', len(rays), False)
+            self.ts       = arena.buffer('hit_ts', len(rays), torch.inf)
+            self.prim_ids = arena.buffer('hit_prim_ids', len(rays), -1)
+            self.face     = arena.buffer('hit_face', len(rays), False)
+            self.sub_ids  = arena.buffer('hit_sub_ids', len(rays), -1)
+        else:
+            self.hit_mask = torch.zeros((len(rays),), dtype = torch.bool, device = rays.device)
+            self.ts       = torch.full((len(rays),), torch.inf, dtype = ftype, device = rays.device)
+            self.prim_ids = torch.full((len(rays),), -1, dtype = torch.long, device = rays.device)
+            self.face     = torch.zeros((len(rays),), dtype = torch.bool, device = rays.device)
+            self.sub_ids  = torch.full((len(rays),), -1, dtype = torch.long, device = rays.device)
+
+        # NOTE: traversal costs per ray, only counted for diagnostics
+        self.nodes    = torch.zeros((len(rays),), dtype = torch.long, device = rays.device) if costs else None
+        self.prims    = torch.zeros((len(rays),), dtype = torch.long, device = rays.device) if costs else None
+
+    def count(self, ray_ids, prims = False):
+        counts = self.prims if prims else self.nodes
+        if counts is not None:
+            counts += torch.bincount(ray_ids, minlength = len(self.rays))
+
+    @prof.timed('hit_aggregate')
+    def aggregate(self, ray_ids, prim_ids, ts, face, sub_ids = None):
+        # NOTE: ray_ids may repeat, only the nearest closer pair of a ray is kept.
+        # The per-ray scratch tensors come from the arena, reduced in place
+        if self.arena is not None:
+            ts_min = self.arena.buffers['hit_ts_min'][:len(self.rays)].copy_(self.ts)
+            pairs  = self.arena.buffer('hit_pairs', len(self.rays), -1)
+        else:
+            ts_min = self.ts.clone()
+            pairs  = torch.full((len(self.rays),), -1, dtype = torch.long, device = self.rays.device)
+
+        ts_min.scatter_reduce_(0, ray_ids, ts, 'amin')
+        wins = torch.nonzero((ts == ts_min[ray_ids]) & (ts < self.ts[ray_ids])).view(-1)
+
+        # NOTE: the rays with a winner are gathered from the pairs, not a full-length mask
+        ts_ids = ray_ids[wins]
+        pairs.scatter_(0, ts_ids, wins)
+
+        ts_ids = torch.unique(ts_ids)
+        pairs  = pairs[ts_ids]
+
+        self.hit_mask[ts_ids] = True
+        self.ts[ts_ids]       = ts[pairs]
+        self.prim_ids[ts_ids] = prim_ids[pairs]
+        self.face[ts_ids]     = face[pairs]
+
+        # NOTE: prims inside instances, -1 for prims of the scene itself
+        if sub_ids is not None:
+            self.sub_ids[ts_ids] = sub_ids[pairs]
+
+        return(self)
 
 class RayBounceAggr():
-    def __init__(self, rays):
-        self.rays = rays
+    def __init__(self, rays, arena = None):
+        self.rays  = rays
+        self.arena = arena
+
+        if arena is not None:
+            self.hit_mask = arena.buffer('bnc_hit_mask', len(rays), False)
+            self.ts       = arena.buffer('bnc_ts', len(rays), torch.inf)
+            self.ps       = arena.buffer('bnc_ps', len(rays), 0)
+            self.face     = arena.buffer('bnc_face', len(rays), False)
+
+            self.ns       = arena.buffer('bnc_ns', len(rays), 0)
+            self.prim_ids = arena.buffer('bnc_prim_ids', len(rays), -1)
+
+            self.bnc_mask = arena.buffer('bnc_bnc_mask', len(rays), False)
+            self.out_dirs = arena.buffer('bnc_out_dirs', len(rays), 0)
+            self.alb      = arena.buffer('bnc_alb', len(rays), 0)
+            self.diffuse  = arena.buffer('bnc_diffuse', len(rays), False)
+            return
 
         self.hit_mask = torch.zeros((len(rays),), dtype = torch.bool, device = rays.device)
         self.ts       = torch.full((len(rays),), torch.inf, dtype = ftype, device = rays.device)
         self.ps       = torch.zeros((len(rays), 3), dtype = ftype, device = rays.device)
         self.face     = torch.zeros((len(rays),), dtype = torch.bool, device = rays.device)
 
+        self.ns       = torch.zeros((len(rays), 3), dtype = ftype, device = rays.device)
+        self.prim_ids = torch.full((len(rays),), -1, dtype = torch.long, device = rays.device)
+
         self.bnc_mask = torch.zeros((len(rays),), dtype = torch.bool, device = rays.device)
         self.out_dirs = torch.zeros((len(rays), 3), dtype = ftype, device = rays.device)
         self.alb      = torch.zeros((len(rays), 3), dtype = ftype, device = rays.device)
+        self.diffuse  = torch.zeros((len(rays),), dtype = torch.bool, device = rays.device)
 
-    def aggregate(self, bncs, ray_ids):
+    @prof.timed('bounce_aggregate')
+    def aggregate(self, bncs, ray_ids, prim_ids = None):
         ts_comp = bncs.hits.ts < self.ts[ray_ids]
         ts_hits = ts_comp[bncs.hits.hit_mask]
         ts_ids  = ray_ids[ts_comp]
@@ -58,17 +208,28 @@ class RayBounceAggr():
         self.ts[ts_ids]       = bncs.hits.ts[ts_comp]
         self.ps[ts_ids]       = bncs.hits.ps[ts_hits]
         self.face[ts_ids]     = bncs.hits.face[ts_hits]
+        self.ns[ts_ids]       = bncs.hits.ns[ts_hits]
+
+        # NOTE: only known to the flat engine, which shades prims
+        if prim_ids is not None:
+            self.prim_ids[ts_ids] = prim_ids[ts_comp]
 
         self.bnc_mask[ts_ids] = bncs.bnc_mask[ts_hits]
         self.out_dirs[ts_ids] = bncs.out_dirs[ts_hits]
         self.alb[ts_ids]      = bncs.alb[ts_hits]
+        self.diffuse[ts_ids]  = bncs.diffuse
 
         return(self)
 
     def generateRays(self):
+        # NOTE: arena rays are compacted into a reused slot, not allocated
+        if self.arena is not None:
+            return(self.arena.compact(self.ps, self.out_dirs, self.rays.pix_ids, self.bnc_mask))
+
         rays = Rays(
             origins    = self.ps[self.bnc_mask, :],
-            directions = self.out_dirs[self.bnc_mask, :]
+            directions = self.out_dirs[self.bnc_mask, :],
+            pix_ids    = self.rays.pix_ids[self.bnc_mask] if self.rays.pix_ids is not None else None
         )
 
         return(rays)
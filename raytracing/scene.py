@@ -1,12 +1,20 @@
 from math import inf
 import torch
 
-from utils.torch      import DmModule, ftype
-from utils.consts     import t_min
+from itertools import product
 
-from raytracing.rays  import RayBounceAggr
+from utils.torch          import DmModule, ftype
+from utils.consts         import t_min
+from utils.profiler       import prof
+
+from raytracing.rays      import Rays, RayHits, RayHitAggr, RayBounceAggr
+from raytracing.bvh       import FlatBVH, BinnedBuilder
+from raytracing.materials import MaterialTable
 
 class Object(DmModule):
+    # NOTE: types packed into a structure-of-arrays store for batched tests
+    store_type = None
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -35,6 +43,7 @@ class AlignedBox(DmModule):
             other
         ))
 
+    @prof.timed('box_tests')
     def intersect(self, rays):
         # TODO: Nans from 0/0!!!!
         t_0 = (self.mins - rays.orig) / rays.dirs
@@ -45,32 +54,222 @@ class AlignedBox(DmModule):
 
         return(torch.logical_and(t_smalls <= t_bigs, t_bigs >= t_min))
 
-# TODO: add addition operator and offset and rotation parameters, so that local
-# smaller scenes can be combined into the bigger scenes
+# Instancing ===================================================================
+def _rotate(rots, vecs):
+    # NOTE: one rotation per row, [k, 3, 3] x [k, 3]
+    return(torch.bmm(rots, vecs.unsqueeze(2)).squeeze(2))
+
+def _transformHits(hits, rots, offs):
+    # Hits of an instance moved into the world, distances are kept by rigid transforms
+    rays = Rays(
+        origins    = _rotate(rots, hits.rays.orig) + offs,
+        directions = _rotate(rots, hits.rays.dirs),
+        pix_ids    = hits.rays.pix_ids
+    )
+
+    return(RayHits(
+        rays     = rays,
+        hit_mask = hits.hit_mask,
+        ts       = hits.ts,
+        ps       = _rotate(rots, hits.ps) + offs,
+        ns       = _rotate(rots, hits.ns),
+        face     = hits.face
+    ))
+
+class InstanceStore(DmModule):
+    nested    = True
+    unbounded = False
+
+    def __init__(self, scenes, scene_ids, rots, offs, obj_ids, **kwargs):
+        self.scenes    = scenes    # Unique sub-scenes, each with its own BVH
+        self.scene_ids = scene_ids # Sub-scene of every instance             [n,]
+        self.rots      = rots      # Rotations from instance to world space  [n, 3, 3]
+        self.offs      = offs      # Offsets from instance to world space    [n, 3]
+        self.obj_ids   = obj_ids   # Prim ids in the scene                   [n,]
+
+        super().__init__(device = rots.device, **kwargs)
+
+    @staticmethod
+    def pack(instances, obj_ids, bins = 16, leaf_size = 4, cache = None):
+        scenes    = []
+        scene_ids = []
+
+        # NOTE: bottom level hierarchies are built once per sub-scene, not per instance
+        for inst in instances:
+            if not any(inst.scene is scene for scene in scenes):
+                scenes.append(inst.scene)
+
+                if inst.scene.flat_bvh is None:
+                    inst.scene.build(bins = bins, leaf_size = leaf_size, cache = cache)
+
+                # NOTE: hits keep one level of sub-prims, the instance prims, and
+                # instances are culled by the root box of their sub-scene
+                if any(store.nested or store.unbounded for store in inst.scene.stores):
+                    raise Exception("Instanced scenes cannot have nested stores or unbounded prims!")
+
+            scene_ids.append(next(i for i, scene in enumerate(scenes) if inst.scene is scene))
+
+        device = instances[0].device
+
+        return(InstanceStore(
+            scenes    = scenes,
+            scene_ids = torch.tensor(scene_ids, dtype = torch.long, device = device),
+            rots      = torch.stack([inst.rot for inst in instances], dim = 0),
+            offs      = torch.cat([inst.off for inst in instances], dim = 0),
+            obj_ids   = torch.tensor(obj_ids, dtype = torch.long, device = device)
+        ))
+
+    def to(self, device):
+        for scene in self.scenes:
+            scene.to(device)
+
+        super().to(device)
+
+        return(self)
+
+    def __len__(self):
+        return(self.rots.shape[0])
+
+    def bounds(self):
+        mins  = torch.stack([scene.flat_bvh.mins[0] for scene in self.scenes], dim = 0)[self.scene_ids]
+        maxes = torch.stack([scene.flat_bvh.maxes[0] for scene in self.scenes], dim = 0)[self.scene_ids]
+
+        # The 8 corners of the root boxes, moved into the world
+        sel     = torch.tensor(list(product([False, True], repeat = 3)), dtype = torch.bool, device = self.device)
+        corners = torch.where(sel.view(1, 8, 3), maxes.view(-1, 1, 3), mins.view(-1, 1, 3))
+        corners = torch.bmm(corners, self.rots.transpose(1, 2)) + self.offs.view(-1, 1, 3)
+
+        return(torch.min(corners, dim = 1).values, torch.max(corners, dim = 1).values)
+
+    def update(self, inst_ids, rot = None, off = None):
+        if rot is not None:
+            self.rots[inst_ids] = rot.view(-1, 3, 3)
+        if off is not None:
+            self.offs[inst_ids] = off.view(-1, 3)
+
+    def toLocal(self, orig, dirs, inst_ids):
+        rots_inv = self.rots[inst_ids].transpose(1, 2)
+
+        return(_rotate(rots_inv, orig - self.offs[inst_ids]), _rotate(rots_inv, dirs))
+
+    def intersect(self, orig, dirs, inst_ids):
+        # NOTE: one row per (ray, instance) pair, rays are traced in instance space
+        orig, dirs = self.toLocal(orig, dirs, inst_ids)
+
+        ts      = torch.full((len(inst_ids),), inf, dtype = ftype, device = self.device)
+        face    = torch.zeros((len(inst_ids),), dtype = torch.bool, device = self.device)
+        sub_ids = torch.full((len(inst_ids),), -1, dtype = torch.long, device = self.device)
+
+        # Pairs of every instance of a sub-scene go down its BVH at once
+        scene_ids = self.scene_ids[inst_ids]
+        for scene_id, scene in enumerate(self.scenes):
+            mask = scene_ids == scene_id
+            if torch.any(mask):
+                hit_aggr = scene.intersect(Rays(origins = orig[mask], directions = dirs[mask]))
+                ts[mask], face[mask], sub_ids[mask] = hit_aggr.ts, hit_aggr.face, hit_aggr.prim_ids
+
+        return(ts, face, sub_ids)
+
+    def shade(self, rays, ray_ids, prim_ids, inst_ids, sub_ids, ts, face, bncs_aggr, tracer = None):
+        orig, dirs = self.toLocal(rays.orig, rays.dirs, inst_ids)
+        local      = Rays(origins = orig, directions = dirs, pix_ids = rays.pix_ids)
+
+        scene_ids = self.scene_ids[inst_ids]
+        for scene_id, scene in enumerate(self.scenes):
+            ids = torch.nonzero(scene_ids == scene_id).view(-1)
+            if len(ids) > 0:
+                xform = (self.rots[inst_ids[ids]], self.offs[inst_ids[ids]], ray_ids[ids], prim_ids[ids])
+                scene._shadePrims(local, ids, sub_ids[ids], ts[ids], face[ids], bncs_aggr, tracer, xform)
+
+class Instance(DmModule):
+    # NOTE: packed like an object, the sub-scene is shared by all of its instances
+    store_type = InstanceStore
+
+    def __init__(self, scene, rotation = None, offset = None, **kwargs):
+        rotation = torch.eye(3, dtype = ftype) if rotation is None else rotation
+        offset   = torch.zeros([3], dtype = ftype) if offset is None else offset
+
+        # NOTE: only rigid transforms, distances along the rays stay the same
+        if not isinstance(scene, Scene) or \
+        rotation.shape != torch.Size([3, 3]) or \
+        offset.shape != torch.Size([3]) or \
+        not torch.allclose(rotation @ rotation.T, torch.eye(3, dtype = rotation.dtype), atol = 1e-5):
+            raise Exception("Invalid instance parameters!")
+
+        if len(scene.instances) > 0:
+            raise Exception("Instanced scenes cannot have instances!")
+
+        self.scene = scene
+        self.rot   = rotation.type(ftype)
+        self.off   = offset.type(ftype).view(1, 3)
+
+        super().__init__(**kwargs)
+
+    def to(self, device):
+        self.scene.to(device)
+
+        super().to(device)
+
+        return(self)
+
+    def update(self, rot = None, off = None):
+        if rot is not None:
+            self.rot = rot.view(3, 3).to(self.device)
+        if off is not None:
+            self.off = off.view(1, 3).to(self.device)
+
+# ==============================================================================
 class Scene(DmModule):
-    def __init__(self, **kwargs):
-        self.obj_list = []
-        self.bvh      = None
+    def __init__(self, traversal = 'flat', **kwargs):
+        if traversal not in ('flat', 'recursive'):
+            raise Exception("Invalid traversal engine!")
+
+        self.obj_list   = []
+        self.unbounded  = [] # Objects without bounds, kept out of the BVH
+        self.instances  = [] # Placed sub-scenes, prims after all the objects
+        self.bvh        = None
+        self.flat_bvh   = None
+        self.traversal  = traversal
+
+        self.stores     = []
+        self.prim_store = None # Store id of every object       [n,]
+        self.prim_local = None # Object id inside its store     [n,]
+        self.mats       = None
+
+        self.light_ids  = None # Emissive prims that lights are sampled from
+        self.unbnd_ids  = None # Unbounded prims, tested against every ray
+
+        self.build_params = ('binned', 16, 4)
+        self.sah_built    = None # SAH cost right after the last build
 
         super().__init__(**kwargs)
 
     def __add__(self, other):
-        if isinstance(other, Object):
+        if isinstance(other, Object) and other.store_type is not None and other.store_type.unbounded:
+            self.unbounded.append(other)
+        elif isinstance(other, Object):
             self.obj_list.append(other)
+        elif isinstance(other, Instance):
+            self.instances.append(other)
         elif isinstance(other, Scene):
-                self.obj_list += other.obj_list
+                self.obj_list  += other.obj_list
+                self.unbounded += other.unbounded
+                self.instances += other.instances
         else:
             raise Exception("Invalid type added to scene!")
 
         return(self)
 
     def to(self, device):
-        for obj in self.obj_list:
+        for obj in self._objects():
             obj.to(device)
         
         if self.bvh is not None:
             self.bvh.to(device)
 
+        for store in self.stores:
+            store.to(device)
+
         super().to(device)
 
         return(self)
@@ -111,7 +310,153 @@ class Scene(DmModule):
 
         return(left + right)
 
-    def build(self):
+    def _objects(self):
+        # NOTE: prim ids follow this order, materials only cover the objects
+        return(self.obj_list + self.unbounded + self.instances)
+
+    def _pack(self, cache = None):
+        store_types = []
+        obj_groups  = []
+        prim_store  = []
+        prim_local  = []
+
+        objs = self._objects()
+
+        for obj_id, obj in enumerate(objs):
+            if obj.store_type is None:
+                raise Exception("Object type cannot be packed into a store!")
+
+            if obj.store_type not in store_types:
+                store_types.append(obj.store_type)
+                obj_groups.append([])
+
+            store_id = store_types.index(obj.store_type)
+
+            prim_store.append(store_id)
+            prim_local.append(len(obj_groups[store_id]))
+            obj_groups[store_id].append(obj_id)
+
+        # NOTE: stores with hierarchies of their own build them like the scene
+        _, bins, leaf_size = self.build_params
+
+        self.stores = [
+            store_type.pack([objs[obj_id] for obj_id in obj_ids], obj_ids, bins = bins, leaf_size = leaf_size, cache = cache)
+            for store_type, obj_ids in zip(store_types, obj_groups)
+        ]
+
+        self.prim_store = torch.tensor(prim_store, dtype = torch.long, device = self.device)
+        self.prim_local = torch.tensor(prim_local, dtype = torch.long, device = self.device)
+
+        # NOTE: instances keep the materials of their sub-scenes
+        mat_objs = self.obj_list + self.unbounded
+
+        self.mats      = MaterialTable.pack(mat_objs) if len(mat_objs) > 0 else None
+        self.light_ids = None
+        self.unbnd_ids = None
+
+    def _bounds(self):
+        mins  = torch.empty((len(self.prim_store), 3), dtype = ftype, device = self.device)
+        maxes = torch.empty((len(self.prim_store), 3), dtype = ftype, device = self.device)
+
+        for store in self.stores:
+            mins[store.obj_ids], maxes[store.obj_ids] = store.bounds()
+
+        return(mins, maxes)
+
+    def unboundedIds(self):
+        if self.unbnd_ids is None:
+            unbnd = [store.obj_ids for store in self.stores if store.unbounded]
+
+            self.unbnd_ids = torch.cat(unbnd) if len(unbnd) > 0 else torch.zeros((0,), dtype = torch.long, device = self.device)
+
+        return(self.unbnd_ids)
+
+    def _boundedIds(self):
+        bounded = torch.ones((len(self.prim_store),), dtype = torch.bool, device = self.device)
+        bounded[self.unboundedIds()] = False
+
+        if not torch.any(bounded):
+            raise Exception("Cannot build a BVH without bounded objects!")
+
+        return(torch.nonzero(bounded).view(-1))
+
+    def build(self, builder = 'binned', bins = 16, leaf_size = 4, cache = None):
+        if builder not in ('binned', 'sweep'):
+            raise Exception("Invalid BVH builder!")
+
+        self.build_params = (builder, bins, leaf_size)
+
+        # NOTE: loaded scenes only have their stores, they are built from those
+        if len(self._objects()) > 0:
+            self._pack(cache)
+        elif len(self.stores) == 0:
+            raise Exception("Cannot build a BVH without objects!")
+
+        # Hierarchies of unchanged scenes are loaded instead of being rebuilt
+        flat_bvh = None
+        if cache is not None:
+            key      = cache.key(*self._bounds(), builder, bins, leaf_size)
+            flat_bvh = cache.get(key)
+
+        if flat_bvh is not None:
+            self.bvh      = None
+            self.flat_bvh = flat_bvh.to(self.device)
+        else:
+            self._buildFlat(builder, bins, leaf_size)
+
+            if cache is not None:
+                cache.put(key, self.flat_bvh)
+
+        # NOTE: refits are measured against the quality of a fresh build
+        self.sah_built = self.flat_bvh.sahCost()
+
+    def update(self, obj_ids, rebuild_ratio = 0.25, **params):
+        # NOTE: params are per object, e.g. cent [k, 3] and rad [k,] for spheres
+        obj_ids = torch.as_tensor(obj_ids, dtype = torch.long, device = self.device).view(-1)
+        params  = {name: torch.as_tensor(param, dtype = ftype, device = self.device) for name, param in params.items()}
+
+        obj_stores = self.prim_store[obj_ids]
+        for store_id, store in enumerate(self.stores):
+            mask = obj_stores == store_id
+            if torch.any(mask):
+                store.update(self.prim_local[obj_ids[mask]], **{name: param[mask] for name, param in params.items()})
+
+        # Objects are kept in sync for full rebuilds and the recursive engine
+        objs = self._objects()
+        if len(objs) > 0:
+            for i, obj_id in enumerate(obj_ids.tolist()):
+                objs[obj_id].update(**{name: param[i] for name, param in params.items()})
+
+        return(self.refit(obj_ids, rebuild_ratio))
+
+    def refit(self, obj_ids = None, rebuild_ratio = 0.25):
+        if self.sah_built is None:
+            self.sah_built = self.flat_bvh.sahCost()
+
+        self.bvh = None
+        self.flat_bvh.refit(*self._bounds(), obj_ids)
+
+        # Refit boxes grow and overlap, past the threshold the tree is rebuilt
+        if self.flat_bvh.sahCost() > self.sah_built * (1 + rebuild_ratio):
+            self.build(*self.build_params)
+            return(True)
+
+        return(False)
+
+    def _buildFlat(self, builder, bins, leaf_size):
+        if builder == 'binned':
+            # NOTE: the object tree of the recursive engine is only made on demand
+            self.bvh      = None
+            ids           = self._boundedIds()
+            mins, maxes   = self._bounds()
+
+            self.flat_bvh = BinnedBuilder(bins, leaf_size).build(mins[ids], maxes[ids])
+            self.flat_bvh.prim_ids = ids[self.flat_bvh.prim_ids]
+            return()
+
+        if len(self.obj_list) == 0 or len(self.instances) > 0:
+            raise Exception("The sweep builder needs the scene objects, without instances!")
+
         bv_list = [obj.genAlignedBox() for obj in self.obj_list]
         bv_ids  = torch.arange(len(bv_list), device = self.device)
 
@@ -131,10 +476,81 @@ class Scene(DmModule):
         )
 
         # Call the recursive algorithm
-        self.bvh = self._buildRecursive(bv_list, bv_ids, exts)
+        self.bvh      = self._buildRecursive(bv_list, bv_ids, exts)
+        self.flat_bvh = self._flatten(self.bvh)
+
+    def _flattenRecursive(self, bv, nodes, prim_ids, obj_ids):
+        node_id = len(nodes)
+        nodes.append([bv, -1, -1, 0, 0])
+
+        if bv.leaf:
+            nodes[node_id][3:] = [len(prim_ids), 1]
+            prim_ids.append(obj_ids[id(bv.left)])
+        else:
+            nodes[node_id][1] = self._flattenRecursive(bv.left, nodes, prim_ids, obj_ids)
+            nodes[node_id][2] = self._flattenRecursive(bv.right, nodes, prim_ids, obj_ids)
+
+        return(node_id)
+
+    def _flatten(self, bvh):
+        obj_ids  = {id(obj): i for i, obj in enumerate(self.obj_list)}
+        nodes    = []
+        prim_ids = []
+
+        self._flattenRecursive(bvh, nodes, prim_ids, obj_ids)
+
+        links = torch.tensor([node[1:] for node in nodes], dtype = torch.long, device = self.device)
+
+        return(FlatBVH(
+            mins     = torch.cat([node[0].mins for node in nodes], dim = 0),
+            maxes    = torch.cat([node[0].maxes for node in nodes], dim = 0),
+            left     = links[:, 0].contiguous(),
+            right    = links[:, 1].contiguous(),
+            first    = links[:, 2].contiguous(),
+            count    = links[:, 3].contiguous(),
+            prim_ids = torch.tensor(prim_ids, dtype = torch.long, device = self.device)
+        ))
+
+    def _unflattenRecursive(self, node_id, links, bv_list):
+        left, right, first, count = links[node_id]
+
+        if count > 0:
+            bv = bv_list[self.flat_bvh.prim_ids[first].item()]
+            for prim_id in self.flat_bvh.prim_ids[(first + 1):(first + count)].tolist():
+                bv = bv + bv_list[prim_id]
+
+            return(bv)
+
+        return(AlignedBox(
+            self.flat_bvh.maxes[node_id],
+            self.flat_bvh.mins[node_id],
+            self._unflattenRecursive(left, links, bv_list),
+            self._unflattenRecursive(right, links, bv_list)
+        ))
+
+    def _unflatten(self):
+        if len(self.obj_list) == 0 or len(self.instances) > 0:
+            raise Exception("The recursive engine needs the scene objects, without instances!")
+
+        bv_list = [obj.genAlignedBox() for obj in self.obj_list]
+        links   = torch.stack(
+            [
+                self.flat_bvh.left,
+                self.flat_bvh.right,
+                self.flat_bvh.first,
+                self.flat_bvh.count
+            ],
+            dim = 1
+        ).tolist()
+
+        return(self._unflattenRecursive(0, links, bv_list))
 
     def _traverseRecursive(self, bv, rays, ray_ids, bncs_aggr, tracer = None):
+        prof.count('nodes_visited', len(rays))
+
         if bv.leaf:
+            prof.count('prim_tests', len(rays))
+
             hits = bv.left.intersect(rays)
 
             if(hits is not None):
@@ -149,17 +565,253 @@ class Scene(DmModule):
             if torch.any(hit_mask_right):
                self._traverseRecursive(bv.right, rays[hit_mask_right], ray_ids[hit_mask_right], bncs_aggr, tracer)
 
-    def traverse(self, rays, tracer = None):
-        bncs_aggr = RayBounceAggr(rays)
+    @prof.timed('prim_tests')
+    def _intersectPrims(self, rays, ray_ids, prim_ids):
+        ts      = torch.empty((len(ray_ids),), dtype = ftype, device = self.device)
+        face    = torch.empty((len(ray_ids),), dtype = torch.bool, device = self.device)
+        sub_ids = None
+
+        prim_stores = self.prim_store[prim_ids]
+        for store_id, store in enumerate(self.stores):
+            mask = prim_stores == store_id
+            ids  = ray_ids[mask]
+
+            # NOTE: nested stores also return the prims hit inside them
+            if store.nested:
+                if sub_ids is None:
+                    sub_ids = torch.full((len(ray_ids),), -1, dtype = torch.long, device = self.device)
+
+                ts[mask], face[mask], sub_ids[mask] = store.intersect(rays.orig[ids], rays.dirs[ids], self.prim_local[prim_ids[mask]])
+            else:
+                ts[mask], face[mask] = store.intersect(rays.orig[ids], rays.dirs[ids], self.prim_local[prim_ids[mask]])
+
+        return(ts, face, sub_ids)
+
+    def _primMats(self, prim_ids):
+        mat_ids = torch.empty_like(prim_ids)
+
+        # NOTE: instance stores have no materials, their prims are shaded by the sub-scenes
+        prim_stores = self.prim_store[prim_ids]
+        for store_id, store in enumerate(self.stores):
+            mask = prim_stores == store_id
+            if torch.any(mask):
+                mat_ids[mask] = store.mat_ids[self.prim_local[prim_ids[mask]]]
+
+        return(mat_ids)
+
+    def _primHits(self, rays, prim_ids, ts, face, sub_ids = None):
+        ps = rays(ts)
+        ns = torch.empty_like(ps)
+
+        prim_stores = self.prim_store[prim_ids]
+        for store_id, store in enumerate(self.stores):
+            mask = prim_stores == store_id
+            if not torch.any(mask):
+                continue
+
+            if store.nested:
+                ns[mask] = store.normals(rays[mask], ps[mask], self.prim_local[prim_ids[mask]], sub_ids[mask])
+            else:
+                ns[mask] = store.normals(rays[mask], ps[mask], self.prim_local[prim_ids[mask]])
+
+        hits = RayHits(
+            rays     = rays,
+            hit_mask = torch.ones((len(rays),), dtype = torch.bool, device = self.device),
+            ts       = ts,
+            ps       = ps,
+            ns       = ns,
+            face     = face
+        )
+
+        return(hits)
+
+    def _intersectLeaves(self, rays, ray_ids, node_ids, hit_aggr):
+        ray_ids, prim_ids = self.flat_bvh.leafPrims(ray_ids, node_ids)
+        prof.count('prim_tests', len(ray_ids))
+        hit_aggr.count(ray_ids, prims = True)
+
+        ts, face, sub_ids = self._intersectPrims(rays, ray_ids, prim_ids)
+
+        hit_aggr.aggregate(ray_ids, prim_ids, ts, face, sub_ids)
+
+    def _intersectUnbounded(self, rays, hit_aggr):
+        # One analytic test per (ray, unbounded prim) pair, outside the BVH
+        unbnd_ids = self.unboundedIds()
+        ray_ids   = torch.arange(len(rays), dtype = torch.long, device = self.device).repeat(len(unbnd_ids))
+        prim_ids  = torch.repeat_interleave(unbnd_ids, len(rays))
+
+        prof.count('prim_tests', len(ray_ids))
+        hit_aggr.count(ray_ids, prims = True)
+
+        ts, face, sub_ids = self._intersectPrims(rays, ray_ids, prim_ids)
+
+        hit_aggr.aggregate(ray_ids, prim_ids, ts, face, sub_ids)
+
+    @prof.timed('intersect')
+    def intersect(self, rays, costs = False, arena = None):
+        hit_aggr = RayHitAggr(rays, costs, arena)
+
+        def visit(ray_ids):
+            prof.count('nodes_visited', len(ray_ids))
+            hit_aggr.count(ray_ids)
+
+        def leaves(ray_ids, node_ids):
+            self._intersectLeaves(rays, ray_ids, node_ids, hit_aggr)
+
+        # NOTE: unbounded prims go first, their hits cull the boxes behind them
+        if len(self.unboundedIds()) > 0:
+            self._intersectUnbounded(rays, hit_aggr)
+
+        self.flat_bvh.traverse(rays.orig, 1 / rays.dirs, hit_aggr.ts, leaves, visit = visit)
+
+        return(hit_aggr)
+
+    def lights(self):
+        # NOTE: only prims of stores that can sample their solid angle qualify
+        if self.light_ids is None and self.mats is None:
+            self.light_ids = torch.zeros((0,), dtype = torch.long, device = self.device)
+
+        if self.light_ids is None:
+            emissive = torch.tensor([mat_class.emissive for mat_class in self.mats.mat_classes], dtype = torch.bool, device = self.device)
+            lights   = [store.obj_ids[emissive[self.mats.class_ids[store.mat_ids]]] for store in self.stores if hasattr(store, 'sampleDirs')]
+
+            self.light_ids = torch.cat(lights) if len(lights) > 0 else torch.zeros((0,), dtype = torch.long, device = self.device)
+
+        return(self.light_ids)
+
+    def sampleLights(self, ps, prim_ids):
+        dirs   = torch.empty_like(ps)
+        angles = torch.empty((len(ps),), dtype = ftype, device = self.device)
+
+        prim_stores = self.prim_store[prim_ids]
+        for store_id, store in enumerate(self.stores):
+            mask = prim_stores == store_id
+            if torch.any(mask):
+                dirs[mask], angles[mask] = store.sampleDirs(ps[mask], self.prim_local[prim_ids[mask]])
+
+        return(dirs, angles)
+
+    def lightAngles(self, ps, prim_ids):
+        # Solid angles of the prims seen from ps, 0 for prims that are not lights
+        angles = torch.zeros((len(ps),), dtype = ftype, device = self.device)
+        lights = torch.zeros((len(self.prim_store),), dtype = torch.bool, device = self.device)
+        lights[self.lights()] = True
+
+        mask        = (prim_ids >= 0) & lights[prim_ids.clamp_min(0)]
+        prim_stores = self.prim_store[prim_ids.clamp_min(0)]
+        for store_id, store in enumerate(self.stores):
+            store_mask = mask & (prim_stores == store_id)
+            if torch.any(store_mask):
+                angles[store_mask] = store.solidAngles(ps[store_mask], self.prim_local[prim_ids[store_mask]])
+
+        return(angles)
+
+    def _shadePrims(self, rays, ray_ids, prim_ids, ts, face, bncs_aggr, tracer = None, xform = None, sub_ids = None):
+        # NOTE: rays are in the space of the scene, ts, face and sub_ids are per hit.
+        # Hits inside instances come with xform, the rotations and offsets to
+        # the world, and the world rays and prims they are aggregated into
+        mat_ids   = self._primMats(prim_ids)
+        class_ids = self.mats.class_ids[mat_ids]
+
+        # Every ray is shaded once, with one call per material class
+        for class_id in torch.unique(class_ids).tolist():
+            cls_mask    = class_ids == class_id
+            cls_ray_ids = ray_ids[cls_mask]
+            mat_class   = self.mats.mat_classes[class_id]
+            params      = self.mats.gather(class_id, mat_ids[cls_mask])
+
+            hits = self._primHits(
+                rays[cls_ray_ids],
+                prim_ids[cls_mask],
+                ts[cls_mask],
+                face[cls_mask],
+                sub_ids[cls_mask] if sub_ids is not None else None
+            )
+
+            agg_ray_ids  = cls_ray_ids
+            agg_prim_ids = prim_ids[cls_mask]
+            if xform is not None:
+                rots, offs, world_ray_ids, world_prim_ids = xform
+
+                hits         = _transformHits(hits, rots[cls_mask], offs[cls_mask])
+                agg_ray_ids  = world_ray_ids[cls_mask]
+                agg_prim_ids = world_prim_ids[cls_mask]
+
+            with prof.stage('bounce'):
+                bncs = mat_class.scatter(hits, **params) if tracer is None else mat_class.scatterTo(hits, tracer, **params)
+
+            bncs_aggr.aggregate(bncs, agg_ray_ids, agg_prim_ids)
+
+    @prof.timed('shade')
+    def shade(self, hit_aggr, tracer = None, arena = None):
+        bncs_aggr = RayBounceAggr(hit_aggr.rays, arena)
+
+        ray_ids  = torch.nonzero(hit_aggr.hit_mask).view(-1)
+        prim_ids = hit_aggr.prim_ids[ray_ids]
+
+        # Instances are shaded by their sub-scenes, the rest of the prims directly
+        prim_stores = self.prim_store[prim_ids]
+        for store_id, store in enumerate(self.stores):
+            if not isinstance(store, InstanceStore):
+                continue
+
+            mask     = prim_stores == store_id
+            ids      = ray_ids[mask]
+            ray_ids  = ray_ids[~mask]
+            prim_ids = prim_ids[~mask]
+
+            if len(ids) > 0:
+                inst_prim_ids = hit_aggr.prim_ids[ids]
+
+                store.shade(
+                    hit_aggr.rays[ids],
+                    ids,
+                    inst_prim_ids,
+                    self.prim_local[inst_prim_ids],
+                    hit_aggr.sub_ids[ids],
+                    hit_aggr.ts[ids],
+                    hit_aggr.face[ids],
+                    bncs_aggr,
+                    tracer
+                )
+
+            prim_stores = prim_stores[~mask]
+
+        if len(ray_ids) > 0:
+            self._shadePrims(
+                hit_aggr.rays,
+                ray_ids,
+                prim_ids,
+                hit_aggr.ts[ray_ids],
+                hit_aggr.face[ray_ids],
+                bncs_aggr,
+                tracer,
+                sub_ids = hit_aggr.sub_ids[ray_ids]
+            )
+
+        return(bncs_aggr)
+
+    @prof.timed('traverse')
+    def traverse(self, rays, tracer = None, arena = None):
+        # NOTE: with an arena the aggregators reuse its buffers, results are
+        # only valid until the next traversal with the same arena
+        if self.traversal == 'flat':
+            return(self.shade(self.intersect(rays, arena = arena), tracer, arena))
+
+        if self.bvh is None:
+            self.bvh = self._unflatten()
+
+        bncs_aggr = RayBounceAggr(rays, arena)
         ray_ids   = torch.arange(len(rays), dtype = torch.long, device = self.device)
 
         self._traverseRecursive(self.bvh, rays, ray_ids, bncs_aggr, tracer)
 
-        # for obj in self.obj_list:
-        #     hits = obj.intersect(rays)
+        # Unbounded objects are outside the tree, every ray is tested
+        for obj in self.unbounded:
+            hits = obj.intersect(rays)
 
-        #     if(hits is not None):
-        #         bncs = obj.bounce(hits) if tracer is None else obj.bounceTo(hits, tracer)
-        #         bncs_aggr.aggregate(bncs, ray_ids)
+            if(hits is not None):
+                bncs = obj.bounce(hits) if tracer is None else obj.bounceTo(hits, tracer)
+                bncs_aggr.aggregate(bncs, ray_ids)
         
         return(bncs_aggr)
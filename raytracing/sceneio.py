@@ -0,0 +1,154 @@
+import torch
+
+import json
+import struct
+import importlib
+from pathlib import Path
+
+from raytracing.scene     import Scene, InstanceStore
+from raytracing.bvh       import FlatBVH
+from raytracing.materials import MaterialTable
+
+# File layout:
+# magic | version | header length | JSON header | aligned raw arrays
+magic   = b'ORRS'
+version = 1
+align   = 64 # NOTE: every array starts aligned, so any dtype can view it
+
+def _className(cls):
+    return(f'{cls.__module__}:{cls.__qualname__}')
+
+def _classFromName(name):
+    module, qualname = name.split(':')
+
+    cls = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        cls = getattr(cls, attr)
+
+    return(cls)
+
+def _tensorFields(module):
+    # NOTE: stores and BVHs take their tensor attributes as constructor arguments
+    return({name: attr for name, attr in vars(module).items() if torch.is_tensor(attr)})
+
+class _Writer():
+    def __init__(self):
+        self.arrays = []
+        self.size   = 0
+
+    def add(self, tensor):
+        tensor = tensor.detach().cpu().contiguous()
+        offset = self.size
+
+        self.arrays.append(tensor)
+        self.size += -(-tensor.numel() * tensor.element_size() // align) * align
+
+        return({'dtype': str(tensor.dtype).split('.')[1], 'shape': list(tensor.shape), 'offset': offset})
+
+    def addFields(self, fields):
+        return({name: self.add(tensor) for name, tensor in fields.items()})
+
+    def write(self, path, header):
+        header = json.dumps(header).encode('utf-8')
+        header = header + b' ' * (-(len(magic) + 8 + len(header)) % align)
+
+        with open(path, 'wb') as out_file:
+            out_file.write(magic + struct.pack('<II', version, len(header)) + header)
+
+            for tensor in self.arrays:
+                data = tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() > 0 else b''
+                out_file.write(data + bytes(-len(data) % align))
+
+def saveScene(scene, path, bvh = True):
+    if len(scene.stores) == 0:
+        scene._pack()
+
+    # NOTE: sub-scenes are not part of the format, instanced scenes stay in memory
+    if any(isinstance(store, InstanceStore) for store in scene.stores):
+        raise Exception("Scenes with instances cannot be saved!")
+
+    writer = _Writer()
+    header = {
+        'stores': [
+            {'type': _className(type(store)), 'fields': writer.addFields(_tensorFields(store))}
+            for store in scene.stores
+        ],
+        'prim_store': writer.add(scene.prim_store),
+        'prim_local': writer.add(scene.prim_local),
+        'mats': {
+            'classes':   [_className(mat_class) for mat_class in scene.mats.mat_classes],
+            'class_ids': writer.add(scene.mats.class_ids),
+            'rows':      writer.add(scene.mats.rows),
+            'tables':    [writer.addFields(table) for table in scene.mats.tables]
+        },
+        'flat_bvh': writer.addFields(_tensorFields(scene.flat_bvh)) if bvh and scene.flat_bvh is not None else None
+    }
+
+    writer.write(path, header)
+
+def saveBVH(flat_bvh, path):
+    writer = _Writer()
+    writer.write(path, {'flat_bvh': writer.addFields(_tensorFields(flat_bvh))})
+
+class _Reader():
+    def __init__(self, path):
+        with open(path, 'rb') as in_file:
+            if in_file.read(len(magic)) != magic:
+                raise Exception("Not a scene file!")
+
+            file_version, header_len = struct.unpack('<II', in_file.read(8))
+            if file_version != version:
+                raise Exception("Unsupported scene file version!")
+
+            self.header = json.loads(in_file.read(header_len).decode('utf-8'))
+
+        # NOTE: a private mapping of the file, arrays are views into it until moved
+        start     = len(magic) + 8 + header_len
+        size      = Path(path).stat().st_size
+        self.data = torch.from_file(str(path), shared = False, size = size, dtype = torch.uint8)[start:]
+
+    def get(self, entry):
+        dtype  = getattr(torch, entry['dtype'])
+        nbytes = torch.Size(entry['shape']).numel() * torch.tensor([], dtype = dtype).element_size()
+
+        data = self.data[entry['offset']:(entry['offset'] + nbytes)]
+
+        return(data.view(dtype).view(entry['shape']))
+
+    def getFields(self, entries):
+        return({name: self.get(entry) for name, entry in entries.items()})
+
+def loadScene(path, traversal = 'flat'):
+    reader = _Reader(path)
+    header = reader.header
+
+    # NOTE: the scene only has the packed arrays, there is no object list
+    scene = Scene(traversal = traversal)
+
+    scene.stores = [
+        _classFromName(store['type'])(**reader.getFields(store['fields']))
+        for store in header['stores']
+    ]
+
+    scene.prim_store = reader.get(header['prim_store'])
+    scene.prim_local = reader.get(header['prim_local'])
+
+    scene.mats = MaterialTable(
+        mat_classes = [_classFromName(name) for name in header['mats']['classes']],
+        class_ids   = reader.get(header['mats']['class_ids']),
+        rows        = reader.get(header['mats']['rows']),
+        tables      = [reader.getFields(table) for table in header['mats']['tables']]
+    )
+
+    if header['flat_bvh'] is not None:
+        scene.flat_bvh = FlatBVH(**reader.getFields(header['flat_bvh']))
+
+    return(scene)
+
+def loadBVH(path):
+    reader = _Reader(path)
+
+    if reader.header.get('flat_bvh') is None:
+        raise Exception("The file has no BVH!")
+
+    return(FlatBVH(**reader.getFields(reader.header['flat_bvh'])))
@@ -1,10 +1,20 @@
 import torch
 from torch.nn.functional import normalize
 
-from utils.torch  import DmModule, ftype
-from utils.common import Timer
+from utils.torch    import DmModule, ftype
+from utils.consts   import pi
+from utils.common   import Timer
+from utils.profiler import prof
+from utils.kernels  import compileKernels, eagerKernels, eagerMode
+
+from utils.rand     import Sampler, setSampler
+
+from raytracing.rays import Rays, RayArena
 
 class RayTracer(DmModule):
+    # NOTE: buffer columns, radiance first, tracers may append per-pixel features
+    channels = 3
+
     def __init__(self, 
         col_sky     = torch.tensor([8, 22, 38],  dtype = ftype),
         col_horizon = torch.tensor([35, 58, 84], dtype = ftype),
@@ -12,14 +22,26 @@ class RayTracer(DmModule):
         # col_sky     = torch.tensor([93, 156, 222],  dtype = ftype),
         # col_horizon = torch.tensor([220, 226, 232], dtype = ftype),
         # col_ground  = torch.tensor([220, 226, 232], dtype = ftype),
+        samples     = 1,
+        tile_size   = 128,
+        progressive = False,
+        sampler     = None,
+        compiled    = None,
         **kwargs
     ):
         # TODO: parameter check!
-        self.col_sky   = col_sky
-        self.col_hrzn  = col_horizon
-        self.col_grnd  = col_ground
+        self.col_sky     = col_sky
+        self.col_hrzn    = col_horizon
+        self.col_grnd    = col_ground
+        self.samples     = samples
+        self.tile_size   = tile_size
+        self.progressive = progressive
+        self.sampler     = sampler if sampler is not None else Sampler()
+        self.compiled    = compiled # Backend of the fused kernels, None stays eager
 
-        self.buffer = None
+        self.buffer         = None
+        self.buffer_samples = 1    # Samples per pixel of the last dumped buffer
+        self.buffer_rads    = None # Mean radiance of the last dumped buffer, reused for HDR
 
         super().__init__(**kwargs)
 
@@ -32,14 +54,66 @@ class RayTracer(DmModule):
             torch.lerp(self.col_hrzn, self.col_grnd, rays_z)
         ))
 
+    def _startSample(self, sample):
+        # NOTE: the sampler is module state, set again in case of another tracer
+        setSampler(self.sampler)
+        self.sampler.startSample(sample)
+
+    def _timeTile(self, scene, vport, pix_ids):
+        # NOTE: the device is synced, async kernels are billed to their own tile
+        with Timer() as t:
+            self.traceTile(scene, vport, pix_ids)
+
+            if torch.device(self.device).type == 'cuda':
+                torch.cuda.synchronize()
+
+        return(t)
+
+    def warmUp(self, scene, vport, n_pix = 1024):
+        # NOTE: compiled kernels compile on their first call, kept out of the timings
+        if self.compiled is None or not compileKernels(self.compiled):
+            return
+
+        # Pixels spread over the frame, the kernels of a material only compile on its hits
+        n_pix   = min(n_pix, len(vport))
+        pix_ids = torch.arange(n_pix, dtype = torch.long, device = self.device) * (len(vport) // n_pix)
+
+        print(f'Kernels warmed up ({self.compiled})', self._timeTile(scene, vport, pix_ids), sep = " - ")
+
+        # Compiled kernels are only kept if they beat eager on the same pixels
+        t_comp = self._timeTile(scene, vport, pix_ids)
+
+        with eagerMode():
+            t_eager = self._timeTile(scene, vport, pix_ids)
+
+        if t_comp.elap >= t_eager.elap:
+            print('Compiled kernels are not faster than eager', f'{t_comp} vs {t_eager}', 'running eager', sep = " - ")
+            eagerKernels()
+            self.compiled = None
+
     def _initBuffer(self, vport):
-        self.buffer = torch.zeros((len(vport), 3), dtype = ftype, device = self.device)
+        self.buffer = torch.zeros((len(vport), self.channels), dtype = ftype, device = self.device)
+
+    def _radiance(self, vport, samples, final = True):
+        # Mean radiance of the accumulated samples [n, 3]
+        return(self.buffer[:, :3] / samples)
+
+    @prof.timed('dumpBuffer')
+    def _dumpBuffer(self, vport, samples = 1, final = True):
+        # NOTE: the accumulated buffer is left intact for progressive snapshots
+        self.buffer_samples = samples
+        self.buffer_rads    = self._radiance(vport, samples, final)
 
-    def _dumpBuffer(self, vport):
-        self.buffer = torch.sqrt(self.buffer / 255) * 255 # Gamma correction
-        self.buffer = torch.clamp_max(self.buffer, 255)   # Basic HDR to LDR conversion
+        buffer = torch.sqrt(self.buffer_rads / 255) * 255 # Gamma correction
+        buffer = torch.clamp_max(buffer, 255)             # Basic HDR to LDR conversion
 
-        vport.getBuffer().copy_(self.buffer.type(torch.uint8).view(vport.res.v, vport.res.h, 3).cpu())
+        vport.setBuffer(buffer.type(torch.uint8).view(vport.res.v, vport.res.h, 3).cpu())
+
+    def getHDR(self, vport):
+        # Linear radiance of the last dumped buffer, before gamma and clamping
+        rads = self.buffer_rads if self.buffer_rads is not None else self._radiance(vport, self.buffer_samples)
+
+        return((rads / 255).view(vport.res.v, vport.res.h, 3).cpu())
   
 # ==============================================================================
 class SimpleTracer(RayTracer):
@@ -56,73 +130,335 @@ class SimpleTracer(RayTracer):
 
         super().__init__(**kwargs)
 
+    @prof.timed('traceTile')
+    def traceTile(self, scene, vport, pix_ids, samples = 1, first_sample = 0):
+        tile_buffer = torch.zeros((len(pix_ids), 3), dtype = ftype, device = self.device)
+        n_rays      = 0
+
+        # NOTE: more than one sample jitters the rays for antialiasing
+        for sample in range(samples):
+            self._startSample(first_sample + sample)
+            bncs_aggr = scene.traverse(vport.getRays(rand = samples > 1, pix_ids = pix_ids), self)
+
+            tile_buffer[~bncs_aggr.hit_mask, :] += self._shadeNohits(bncs_aggr)
+            tile_buffer[bncs_aggr.hit_mask, :]  += bncs_aggr.alb[bncs_aggr.hit_mask, :]
+            n_rays += len(pix_ids)
+
+        return(tile_buffer, n_rays)
+
     def render(self, scene, vport):
         scene.to(self.device)
         vport.to(self.device)
 
+        self.warmUp(scene, vport)
         self._initBuffer(vport)
 
-        bncs_aggr = scene.traverse(vport.getRays(rand = False), self)
-
-        if not torch.any(bncs_aggr.hit_mask):
-            self.buffer = self._shadeNohits(bncs_aggr)
-            return()
-
-        self.buffer[~bncs_aggr.hit_mask, :] = self._shadeNohits(bncs_aggr)
-        self.buffer[bncs_aggr.hit_mask, :]  = bncs_aggr.alb[bncs_aggr.hit_mask, :]
+        for pix_ids in vport.getTiles(self.tile_size):
+            tile_buffer, _ = self.traceTile(scene, vport, pix_ids, self.samples)
+            self.buffer[pix_ids, :] = tile_buffer
 
-        self._dumpBuffer(vport)
+        self._dumpBuffer(vport, self.samples)
 
 # ==============================================================================
 class PathTracer(RayTracer):
     def __init__(self,
-        samples   = 100,
-        max_depth = 5,
+        samples           = 100,
+        max_depth         = 5,
+        adaptive          = False,
+        min_samples       = 8,
+        noise_level       = 2.0,
+        rr_depth          = None,
+        rr_min            = 0.05,
+        nee               = False,
+        denoiser          = None,
+        denoise_snapshots = False,
         **kwargs
     ):
         # TODO: parameter check!
-        self.samples   = samples
-        self.max_depth = max_depth
+        self.max_depth   = max_depth
+        self.adaptive    = adaptive
+        self.min_samples = min_samples
+        self.noise_level = noise_level # Noise threshold in displayed 8-bit levels
+        self.lum_weights = torch.tensor([0.2126, 0.7152, 0.0722], dtype = ftype)
+        self.rr_depth    = rr_depth    # First depth of Russian roulette, None disables it
+        self.rr_min      = rr_min      # Lowest survival probability
+        self.rr_saved    = torch.zeros((max_depth + 1,), dtype = torch.long)
+        self.nee         = nee         # Next event estimation toward emissive prims
+        self.arena       = None        # Reused ray buffers, sized by the largest tile
+        self.denoiser    = denoiser    # Filter of the dumped buffers, needs the first-hit features
+        self.denoise_snapshots = denoise_snapshots # Denoise every progressive pass, not only the last
 
-        super().__init__(**kwargs)
+        # NOTE: first-hit albedo, normal and depth follow the radiance columns
+        if denoiser is not None:
+            self.channels = 3 + 7
+
+        super().__init__(samples = samples, **kwargs)
+
+    def _misWeights(self, pdfs, pdfs_other):
+        # Power heuristic
+        return(torch.pow(pdfs, 2) / torch.clamp_min(torch.pow(pdfs, 2) + torch.pow(pdfs_other, 2), 1e-20))
+
+    def _sampleLights(self, scene, bncs_aggr, mask):
+        light_ids = scene.lights()
+
+        ps = bncs_aggr.ps[mask, :]
+        ns = bncs_aggr.ns[mask, :]
+
+        # One light per hit, picked uniformly, then a direction in its cone
+        picks        = light_ids[torch.randint(len(light_ids), (len(ps),), device = self.device)]
+        dirs, angles = scene.sampleLights(ps, picks)
+        cos_ns       = torch.clamp_min(torch.einsum('ij,ij->i', ns, dirs), 0)
+
+        # Shadow rays only count if they reach the light that was picked
+        hit_aggr = scene.intersect(Rays(origins = ps, directions = dirs))
+        hit_aggr.hit_mask &= (hit_aggr.prim_ids == picks) & (cos_ns > 0)
+
+        emit = scene.shade(hit_aggr).alb
+
+        pdfs_light = 1 / (len(light_ids) * torch.clamp_min(angles, 1e-20))
+        pdfs_bsdf  = cos_ns / pi
+        weights    = self._misWeights(pdfs_light, pdfs_bsdf) * pdfs_bsdf / pdfs_light
+
+        # NOTE: the diffuse BRDF is alb / pi, its cosine term is in pdfs_bsdf
+        return(bncs_aggr.alb[mask, :] * emit * weights.view(-1, 1), len(ps))
+
+    def _recordFeatures(self, bncs_aggr, feats):
+        # NOTE: depth 0 rays are in tile order, misses keep the sky as albedo
+        hits = bncs_aggr.hit_mask
+
+        feats[hits, 0:3]  += torch.clamp(bncs_aggr.alb[hits, :], 0, 1)
+        feats[~hits, 0:3] += self._shadeNohits(bncs_aggr) / 255
+        feats[hits, 3:6]  += bncs_aggr.ns[hits, :]
+        feats[hits, 6]    += bncs_aggr.ts[hits]
 
-    def _shadeRecursive(self, scene, depth, rays, pix_ids, samp_buffer):
+    def _shadeRecursive(self, scene, depth, rays, pix_ids, thru, rads, pdfs = None, feats = None):
+        # NOTE: pdfs of the diffuse bounces that made the rays, 0 if the bounce
+        # did not sample lights, they weight emitters hit by the rays
         if depth >= self.max_depth:
-            samp_buffer[pix_ids, :] = 0
             return(len(rays))
 
-        bncs_aggr = scene.traverse(rays)
+        if prof.enabled:
+            prof.count(f'rays_depth_{depth}', len(rays))
+
+        self.sampler.startBounce(depth)
+        bncs_aggr = scene.traverse(rays, arena = self.arena)
+
+        if feats is not None:
+            self._recordFeatures(bncs_aggr, feats)
+
+        rads[pix_ids[~bncs_aggr.hit_mask], :] += thru[pix_ids[~bncs_aggr.hit_mask], :] * self._shadeNohits(bncs_aggr)
 
         if not torch.any(bncs_aggr.hit_mask):
-            samp_buffer *= self._shadeNohits(bncs_aggr)
             return(len(rays))
 
-        samp_buffer[pix_ids[~bncs_aggr.hit_mask], :] *= self._shadeNohits(bncs_aggr)
-        samp_buffer[pix_ids[bncs_aggr.hit_mask], :]  *= bncs_aggr.alb[bncs_aggr.hit_mask, :]
+        # Emitters end their paths
+        emit_mask = bncs_aggr.hit_mask & ~bncs_aggr.bnc_mask
+        emit      = bncs_aggr.alb[emit_mask, :]
+
+        if pdfs is not None and torch.any(emit_mask):
+            pdfs_bsdf  = pdfs[emit_mask]
+            light_ids  = scene.lights()
+            angles     = scene.lightAngles(rays.orig[emit_mask, :], bncs_aggr.prim_ids[emit_mask])
+            pdfs_light = torch.where(angles > 0, 1 / (max(len(light_ids), 1) * torch.clamp_min(angles, 1e-20)), torch.zeros_like(angles))
+
+            weights = torch.where(pdfs_bsdf > 0, self._misWeights(pdfs_bsdf, pdfs_light), torch.ones_like(pdfs_bsdf))
+            emit    = emit * weights.view(-1, 1)
+
+        rads[pix_ids[emit_mask], :] += thru[pix_ids[emit_mask], :] * emit
+
+        n_rays = 0
+
+        # Lights are sampled from diffuse hits, before their albedo is applied
+        nee_mask = bncs_aggr.diffuse & bncs_aggr.bnc_mask
+        if self.nee and len(scene.lights()) > 0 and torch.any(nee_mask):
+            light, n_rays = self._sampleLights(scene, bncs_aggr, nee_mask)
+            rads[pix_ids[nee_mask], :] += thru[pix_ids[nee_mask], :] * light
+
+        thru[pix_ids[bncs_aggr.bnc_mask], :] *= bncs_aggr.alb[bncs_aggr.bnc_mask, :]
 
         rays_rand = bncs_aggr.generateRays()
-        n_rays = self._shadeRecursive(scene, depth + 1, rays_rand, pix_ids[bncs_aggr.bnc_mask], samp_buffer)
+        pix_ids   = pix_ids[bncs_aggr.bnc_mask]
+        pdfs      = None
+
+        if self.nee:
+            cos_ns = torch.clamp_min(torch.einsum('ij,ij->i', bncs_aggr.ns, bncs_aggr.out_dirs), 0)
+            pdfs   = torch.where(bncs_aggr.diffuse, cos_ns / pi, torch.zeros_like(cos_ns))[bncs_aggr.bnc_mask]
+
+        # Russian roulette on the path throughput, survivors are reweighted
+        if self.rr_depth is not None and depth + 1 >= self.rr_depth and depth + 1 < self.max_depth:
+            probs = torch.clamp(torch.max(thru[pix_ids, :], dim = 1).values, self.rr_min, 1)
+            alive = torch.rand_like(probs) < probs
+
+            thru[pix_ids[alive], :] /= probs[alive].view(-1, 1)
+            thru[pix_ids[~alive], :] = 0
+            self.rr_saved[depth + 1] += torch.sum(~alive)
 
-        return(len(rays) + n_rays) 
+            rays_rand = self.arena.compact(rays_rand.orig, rays_rand.dirs, rays_rand.pix_ids, alive)
+            pix_ids   = pix_ids[alive]
+            pdfs      = pdfs[alive] if pdfs is not None else None
+
+        n_rays += self._shadeRecursive(scene, depth + 1, rays_rand, pix_ids, thru, rads, pdfs)
+
+        return(len(rays) + n_rays)
+
+    def _radiance(self, vport, samples, final = True):
+        # NOTE: progressive snapshots are only denoised when asked for
+        if self.denoiser is None or not (final or self.denoise_snapshots):
+            return(super()._radiance(vport, samples))
+
+        # NOTE: features are averaged over the samples like the radiance
+        return(self.denoiser(self.buffer[:, :3] / samples, self.buffer[:, 3:] / samples, vport.res))
+
+    def _noisyPixels(self, counts, lum_sqs):
+        counts   = counts.view(-1)
+        means    = (self.buffer[:, :3] @ self.lum_weights) / counts
+        lum_vars = torch.clamp_min(lum_sqs / counts - torch.pow(means, 2), 0) * counts / torch.clamp_min(counts - 1, 1)
+
+        # Standard error of the mean, scaled by the slope of the gamma curve
+        errs = torch.sqrt(lum_vars / counts) * 0.5 * torch.sqrt(255 / torch.clamp_min(means, 1))
+
+        return((errs > self.noise_level) & (counts < self.samples))
+
+    @prof.timed('traceTile')
+    def traceTile(self, scene, vport, pix_ids, samples = 1, first_sample = 0):
+        # NOTE: light weights need the prims hit, only the flat engine has them
+        if self.nee and scene.traversal != 'flat':
+            raise Exception("Next event estimation needs the flat traversal engine!")
+
+        # Buffers are only allocated for the first tile, or a larger one
+        if self.arena is None or self.arena.n < len(pix_ids) or self.arena.device != torch.device(self.device):
+            self.arena = RayArena(len(pix_ids), self.device)
+
+        tile_ids    = torch.arange(len(pix_ids), dtype = torch.long, device = self.device)
+        thru        = self.arena.buffer('path_thru', len(pix_ids), 1)
+        rads        = self.arena.buffer('path_rads', len(pix_ids), 0)
+        tile_buffer = torch.zeros((len(pix_ids), self.channels), dtype = ftype, device = self.device)
+        feats       = tile_buffer[:, 3:] if self.denoiser is not None else None
+        n_rays      = 0
+
+        # NOTE: light is added to rads, weighted by the path throughput thru
+        for sample in range(samples):
+            self._startSample(first_sample + sample)
+            thru.fill_(1)
+            rads.zero_()
+            n_rays += self._shadeRecursive(scene, 0, vport.getRays(pix_ids = pix_ids), tile_ids, thru, rads, feats = feats)
+            tile_buffer[:, :3] += rads
+
+        return(tile_buffer, n_rays)
 
     def render(self, scene, vport):
         scene.to(self.device)
         vport.to(self.device)
 
-        self._initBuffer(vport)        
+        self.warmUp(scene, vport)
+        self._initBuffer(vport)
+
+        self.rr_saved.zero_()
 
-        pix_ids     = torch.arange(len(vport), dtype = torch.long, device = self.device)
-        samp_buffer = torch.ones((len(vport), 3), dtype = ftype, device = self.device)
+        # NOTE: sample counts and luminance moments are kept per pixel
+        counts  = torch.zeros((len(vport), 1), dtype = ftype, device = self.device)
+        lum_sqs = torch.zeros((len(vport),), dtype = ftype, device = self.device)
+        active  = torch.ones((len(vport),), dtype = torch.bool, device = self.device)
 
-        for sample in range(self.samples):
+        samples = 0
+        while samples < self.samples and not vport.stopRequested():
             with Timer() as t:
-                rays = vport.getRays()
+                n_rays = 0
+
+                for pix_ids in vport.getTiles(self.tile_size):
+                    pix_ids = pix_ids[active[pix_ids]]
+                    if len(pix_ids) == 0:
+                        continue
+
+                    tile_buffer, tile_rays = self.traceTile(scene, vport, pix_ids, 1, samples)
+
+                    self.buffer[pix_ids, :] += tile_buffer
+                    n_rays += tile_rays
+
+                    if self.adaptive:
+                        lum_sqs[pix_ids] += torch.pow(tile_buffer[:, :3] @ self.lum_weights, 2)
+
+                counts[active] += 1
+
+            samples += 1
+            print(f'{samples:04}', f'{(n_rays / t.elap / 1e6):.04} MR/s', t, f'{active.sum().item()} pixels', sep = " - ")
+
+            # After the warm-up only pixels above the noise threshold are traced
+            if self.adaptive and samples >= self.min_samples:
+                active = self._noisyPixels(counts, lum_sqs)
+
+                if not torch.any(active):
+                    break
+
+            # Snapshot of every finished pass, until the render is stopped
+            if self.progressive and samples < self.samples:
+                self._dumpBuffer(vport, counts, final = False)
+
+        if self.rr_depth is not None:
+            print('Rays terminated per depth', self.rr_saved.tolist(), sep = " - ")
+
+        self._dumpBuffer(vport, torch.clamp_min(counts, 1))
+
+# ==============================================================================
+class HeatmapTracer(RayTracer):
+    def __init__(self,
+        mode    = 'nodes',
+        scale   = None,
+        palette = torch.tensor([[0, 0, 4], [87, 16, 110], [188, 55, 84], [249, 142, 9], [252, 255, 164]], dtype = ftype),
+        **kwargs
+    ):
+        if mode not in ('nodes', 'prims'):
+            raise Exception("Invalid heatmap mode!")
+
+        self.mode    = mode
+        self.scale   = scale   # Cost at the top of the palette, None uses the frame maximum
+        self.palette = palette # Colors from the lowest to the highest cost  [k, 3]
+
+        super().__init__(**kwargs)
+
+    def traceTile(self, scene, vport, pix_ids, samples = 1, first_sample = 0):
+        # NOTE: the buffer holds BVH nodes visited and prim tests, not colors
+        tile_buffer = torch.zeros((len(pix_ids), 3), dtype = ftype, device = self.device)
+
+        for sample in range(samples):
+            self._startSample(first_sample + sample)
+            hit_aggr = scene.intersect(vport.getRays(rand = samples > 1, pix_ids = pix_ids), costs = True)
+
+            tile_buffer[:, 0] += hit_aggr.nodes
+            tile_buffer[:, 1] += hit_aggr.prims
+
+        return(tile_buffer, len(pix_ids) * samples)
+
+    def render(self, scene, vport):
+        scene.to(self.device)
+        vport.to(self.device)
+
+        self.warmUp(scene, vport)
+        self._initBuffer(vport)
+
+        for pix_ids in vport.getTiles(self.tile_size):
+            tile_buffer, _ = self.traceTile(scene, vport, pix_ids, self.samples)
+            self.buffer[pix_ids, :] = tile_buffer
+
+        costs = self.buffer[:, :2] / self.samples
+        print(
+            f'Nodes per ray {costs[:, 0].mean().item():.1f} (max {costs[:, 0].max().item():.0f})',
+            f'Prim tests per ray {costs[:, 1].mean().item():.1f} (max {costs[:, 1].max().item():.0f})',
+            sep = " - "
+        )
+
+        self._dumpBuffer(vport, self.samples)
+
+    def _dumpBuffer(self, vport, samples = 1, final = True):
+        self.buffer_samples = samples
+        self.buffer_rads    = None
 
-                samp_buffer.fill_(1)
-                n_rays = self._shadeRecursive(scene, 0, rays, pix_ids, samp_buffer)
-                self.buffer += samp_buffer
+        costs  = self.buffer[:, 0 if self.mode == 'nodes' else 1].view(-1, 1) / samples
+        scale  = torch.max(costs) if self.scale is None else self.scale
 
-            print(f'{(sample + 1):04}', f'{(n_rays / t.elap / 1e6):.04} MR/s', t, sep = " - ")
+        # Piecewise linear color ramp over the palette
+        levels = torch.clamp(costs / max(float(scale), 1), 0, 1) * (len(self.palette) - 1)
+        lows   = torch.clamp_max(torch.floor(levels).long(), len(self.palette) - 2).view(-1)
+        buffer = torch.lerp(self.palette[lows], self.palette[lows + 1], levels - lows.view(-1, 1))
 
-        self.buffer /= self.samples
-        self._dumpBuffer(vport)
\ No newline at end of file
+        vport.setBuffer(buffer.type(torch.uint8).view(vport.res.v, vport.res.h, 3).cpu())
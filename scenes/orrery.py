@@ -0,0 +1,202 @@
+import torch
+
+import random
+from math import sqrt, floor, cos, sin
+
+from utils.torch            import ftype
+from utils.consts           import pi
+
+from raytracing.scene       import Scene, Instance
+from raytracing.meshio      import loadOBJ
+import raytracing.geometry  as geom
+import raytracing.materials as mat
+
+class Ground(geom.Plane, mat.Metal):
+    def __init__(self):
+        super().__init__(
+            point  = torch.tensor([0, 0, 0], dtype = ftype),
+            normal = torch.tensor([0, 0, 1], dtype = ftype),
+            albedo = torch.tensor([0.35, 0.78, 0.52], dtype = ftype),
+            fuzz   = 0.7
+        )
+
+class Sun(geom.Sphere, mat.Shiny):
+    def __init__(self):
+        super().__init__(
+            center = torch.tensor([-4.5, 0, 2], dtype = ftype),
+            radius = 2,
+            albedo = torch.tensor([0.9, 0.7, 0.0], dtype = ftype)
+        )
+
+class Earth(geom.Sphere, mat.Glass):
+    def __init__(self):
+        super().__init__(
+            center = torch.tensor([0, 0, 2], dtype = ftype),
+            radius = 2,
+            albedo = torch.tensor([0.2, 0.5, 0.8], dtype = ftype),
+            eta    = 1.5
+        )
+
+class Moon(geom.Sphere, mat.Metal):
+    def __init__(self):
+        super().__init__(
+            center = torch.tensor([4.5, 0, 2], dtype = ftype),
+            radius = 2,
+            albedo = torch.tensor([0.3, 0.3, 0.3], dtype = ftype),
+            fuzz   = 0.2
+        )
+
+class RandDiffuse(geom.Sphere, mat.Diffuse):
+    def __init__(self, center):
+        super().__init__(
+            center   = center,
+            radius   = 0.5,
+            albedo   = torch.rand([3], dtype = ftype)
+        )
+
+class RandShiny(geom.Sphere, mat.Shiny):
+    def __init__(self, center):
+        super().__init__(
+            center   = center,
+            radius   = 0.5,
+            albedo   = torch.rand([3], dtype = ftype)
+        )
+
+class RandGlowing(geom.Sphere, mat.Glowing):
+    def __init__(self, center):
+        super().__init__(
+            center   = center,
+            radius   = 0.5,
+            albedo   = torch.rand([3], dtype = ftype),
+            glow_min = 1.2,
+            glow_max = 3.0
+        )
+
+class RandGlass(geom.Sphere, mat.Glass):
+    def __init__(self, center):
+        super().__init__(
+            center   = center,
+            radius   = 0.5,
+            albedo   = torch.rand([3], dtype = ftype),
+            eta      = 1.5
+        )
+
+class Asteroid(geom.Sphere, mat.Diffuse):
+    def __init__(self, center, radius):
+        super().__init__(
+            center   = center,
+            radius   = radius,
+            albedo   = torch.full([3], 0.25, dtype = ftype) + torch.rand([3], dtype = ftype) * 0.1
+        )
+
+class Statue(geom.TriangleMesh, mat.Diffuse):
+    def __init__(self, path, center, size):
+        verts, faces = loadOBJ(path)
+
+        # Fitted into a box of the given size, standing on the ground at center
+        mins  = torch.min(verts, dim = 0).values
+        maxes = torch.max(verts, dim = 0).values
+        verts = (verts - (mins + maxes) / 2) * (size / torch.max(maxes - mins).item())
+        verts = verts + center - torch.tensor([0, 0, torch.min(verts[:, 2]).item()], dtype = ftype)
+
+        super().__init__(
+            vertices = verts,
+            faces    = faces,
+            albedo   = torch.tensor([0.8, 0.8, 0.8], dtype = ftype)
+        )
+
+# ==============================================================================
+class _Grid():
+    # NOTE: spatial hash of the small spheres, keeps placement linear in n
+    def __init__(self, cell):
+        self.cell  = cell
+        self.cells = {}
+
+    def _key(self, x, y):
+        return((floor(x / self.cell), floor(y / self.cell)))
+
+    def free(self, x, y, rad):
+        kx, ky = self._key(x, y)
+
+        for i in range(kx - 1, kx + 2):
+            for j in range(ky - 1, ky + 2):
+                for ox, oy, orad in self.cells.get((i, j), []):
+                    if (ox - x) ** 2 + (oy - y) ** 2 < (orad + rad) ** 2:
+                        return(False)
+
+        return(True)
+
+    def add(self, x, y, rad):
+        self.cells.setdefault(self._key(x, y), []).append((x, y, rad))
+
+def asteroidCluster(n_rocks = 32, size = 1.5, rng = random):
+    # NOTE: the sub-scene is built once, then shared by every instance of it
+    cluster = Scene()
+
+    for _ in range(n_rocks):
+        cent = torch.tensor([rng.uniform(-size, size), rng.uniform(-size, size), rng.uniform(0, size / 2)], dtype = ftype)
+        cluster += Asteroid(cent, rng.uniform(0.05, 0.2))
+
+    return(cluster)
+
+def asteroidBelt(scene, n_clusters = 24, rad_belt = 14, rng = random):
+    cluster = asteroidCluster(rng = rng)
+
+    # Copies of the cluster around the disc, each turned around the z axis
+    for i in range(n_clusters):
+        theta = 2 * pi * i / n_clusters
+        turn  = rng.random() * 2 * pi
+
+        rot = torch.tensor([
+            [cos(turn), -sin(turn), 0],
+            [sin(turn),  cos(turn), 0],
+            [0,          0,         1]
+        ], dtype = ftype)
+
+        scene += Instance(cluster, rotation = rot, offset = torch.tensor([cos(theta) * rad_belt, sin(theta) * rad_belt, 0], dtype = ftype))
+
+    return(scene)
+
+def orreryScene(n_rand = 80, n_belt = 0, mesh_path = None, seed = None, **kwargs):
+    if seed is not None:
+        torch.manual_seed(seed)
+
+    rng    = random.Random(seed)
+    bodies = [Sun(), Earth(), Moon()]
+    scene  = Scene(**kwargs)
+
+    for body in bodies:
+        scene += body
+
+    # The disc grows with the object count, density matches the 80 sphere layout
+    rad_disc = 10 * sqrt(max(n_rand, 80) / 80)
+    grid     = _Grid(cell = 1.0)
+    types    = [RandDiffuse, RandShiny, RandGlowing, RandGlass]
+
+    for i in range(n_rand):
+        while True:
+            r     = rad_disc * sqrt(rng.random())
+            theta = rng.random() * 2 * pi
+            x, y  = cos(theta) * r, sin(theta) * r
+
+            if not grid.free(x, y, 0.5):
+                continue
+
+            if any((body.cent[0, 0].item() - x) ** 2 + (body.cent[0, 1].item() - y) ** 2 < (body.rad + 0.5) ** 2 for body in bodies):
+                continue
+
+            scene += types[i % len(types)](torch.tensor([x, y, 0.5], dtype = ftype))
+            grid.add(x, y, 0.5)
+            break
+
+    # NOTE: the statue stands in front of the bodies, small spheres may overlap it
+    if mesh_path is not None:
+        scene += Statue(mesh_path, torch.tensor([0, -4.5, 0], dtype = ftype), 3)
+
+    scene += Ground()
+
+    # NOTE: instanced scenes are not saved into scene files
+    if n_belt > 0:
+        asteroidBelt(scene, n_clusters = n_belt, rad_belt = rad_disc + 3, rng = rng)
+
+    return(scene)
@@ -0,0 +1,9 @@
+import pytest
+
+# NOTE: run from the repository root with python -m pytest tests. Torch is only
+# imported by the fixtures, so the modules can still skip where it is missing
+@pytest.fixture
+def scene():
+    helpers = pytest.importorskip('tests.helpers')
+
+    return(helpers.buildScene())
@@ -0,0 +1,82 @@
+import torch
+
+from utils.torch        import ftype
+
+from raytracing.rays    import Rays
+from raytracing.sceneio import _tensorFields
+
+from scenes.orrery      import orreryScene
+
+# NOTE: shared by the test modules, every scene and ray batch has a fixed seed
+seed   = 1234
+n_rand = 12
+
+def buildScene(cache = None, **kwargs):
+    scene = orreryScene(n_rand = n_rand, seed = seed, **kwargs)
+    scene.build(cache = cache)
+
+    return(scene)
+
+def makeRays(n = 512, seed = seed):
+    # Rays from around the default camera towards the orrery disc and the ground
+    gen  = torch.Generator().manual_seed(seed)
+    orig = torch.tensor([10.0, -10.0, 3.0], dtype = ftype) + torch.rand((n, 3), generator = gen, dtype = ftype) - 0.5
+    trgs = (torch.rand((n, 3), generator = gen, dtype = ftype) - 0.5) * torch.tensor([20.0, 20.0, 6.0], dtype = ftype)
+
+    dirs = trgs - orig
+    dirs = dirs / torch.norm(dirs, dim = 1, keepdim = True)
+
+    return(Rays(origins = orig, directions = dirs))
+
+def bruteForce(scene, rays):
+    # Every ray against every prim, the reference the hierarchies must match
+    n_prims  = len(scene.prim_store)
+    ray_ids  = torch.arange(len(rays), dtype = torch.long).repeat(n_prims)
+    prim_ids = torch.repeat_interleave(torch.arange(n_prims, dtype = torch.long), len(rays))
+
+    ts, _, _ = scene._intersectPrims(rays, ray_ids, prim_ids)
+    ts, ids  = torch.min(ts.view(n_prims, len(rays)), dim = 0)
+
+    return(ids.masked_fill(~torch.isfinite(ts), -1), ts)
+
+def checkBoxes(scene):
+    bvh         = scene.flat_bvh
+    mins, maxes = scene._bounds()
+
+    # Every bounded prim sits in exactly one leaf
+    assert torch.equal(torch.sort(bvh.prim_ids).values, scene._boundedIds())
+
+    for node_id in range(len(bvh)):
+        if bvh.count[node_id] > 0:
+            first = int(bvh.first[node_id])
+            prims = bvh.prim_ids[first:(first + int(bvh.count[node_id]))]
+            c_mins, c_maxes = mins[prims], maxes[prims]
+        else:
+            kids = torch.stack([bvh.left[node_id], bvh.right[node_id]])
+            c_mins, c_maxes = bvh.mins[kids], bvh.maxes[kids]
+
+        assert torch.all(bvh.mins[node_id] <= c_mins)
+        assert torch.all(bvh.maxes[node_id] >= c_maxes)
+
+def checkHits(scene, rays, prim_ids, ts):
+    hit_aggr = scene.intersect(rays)
+
+    assert torch.equal(hit_aggr.hit_mask, prim_ids >= 0)
+    assert torch.equal(hit_aggr.prim_ids, prim_ids)
+    assert torch.allclose(hit_aggr.ts[hit_aggr.hit_mask], ts[prim_ids >= 0])
+
+def assertFieldsEqual(module_a, module_b):
+    fields_a = _tensorFields(module_a)
+    fields_b = _tensorFields(module_b)
+
+    assert fields_a.keys() == fields_b.keys()
+    for name, field in fields_a.items():
+        assert field.dtype == fields_b[name].dtype
+        assert torch.equal(field, fields_b[name])
+
+def assertHitsEqual(scene_a, scene_b, rays):
+    hits_a = scene_a.intersect(rays)
+    hits_b = scene_b.intersect(rays)
+
+    assert torch.equal(hits_a.prim_ids, hits_b.prim_ids)
+    assert torch.equal(hits_a.ts, hits_b.ts)
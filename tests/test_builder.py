@@ -0,0 +1,44 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from tests.helpers import makeRays, bruteForce, checkBoxes, checkHits
+
+@pytest.mark.parametrize('builder', ['binned', 'sweep'])
+def test_builders(scene, builder):
+    rays = makeRays()
+    ref  = bruteForce(scene, rays)
+
+    scene.build(builder = builder, bins = 8, leaf_size = 2)
+
+    checkBoxes(scene)
+    checkHits(scene, rays, *ref)
+
+def test_binned_matches_sweep(scene):
+    rays = makeRays()
+
+    scene.build(builder = 'binned')
+    binned = scene.intersect(rays)
+
+    scene.build(builder = 'sweep')
+    sweep = scene.intersect(rays)
+
+    assert torch.equal(binned.prim_ids, sweep.prim_ids)
+    assert torch.allclose(binned.ts, sweep.ts)
+
+@pytest.mark.parametrize('leaf_size', [1, 2, 4])
+def test_leaf_size(scene, leaf_size):
+    # NOTE: the orrery spheres never share centroids, every leaf can be split
+    scene.build(leaf_size = leaf_size)
+
+    leaves = scene.flat_bvh.count[scene.flat_bvh.count > 0]
+
+    assert torch.all(leaves <= leaf_size)
+    assert len(scene.flat_bvh) <= 2 * len(scene.flat_bvh.prim_ids) - 1
+
+def test_invalid_parameters(scene):
+    with pytest.raises(Exception, match = 'Invalid BVH builder parameters!'):
+        scene.build(bins = 1)
+
+    with pytest.raises(Exception, match = 'Invalid BVH builder parameters!'):
+        scene.build(leaf_size = 0)
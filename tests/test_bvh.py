@@ -0,0 +1,27 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from tests.helpers import buildScene, makeRays, bruteForce, checkHits
+
+def test_flat_matches_brute_force(scene):
+    rays = makeRays()
+
+    checkHits(scene, rays, *bruteForce(scene, rays))
+
+def test_flat_matches_recursive(scene):
+    rays = makeRays()
+
+    rec_scene = buildScene(traversal = 'recursive')
+
+    hit_aggr  = scene.intersect(rays)
+    bncs_aggr = rec_scene.traverse(rays)
+
+    assert torch.equal(hit_aggr.hit_mask, bncs_aggr.hit_mask)
+    assert torch.allclose(hit_aggr.ts[hit_aggr.hit_mask], bncs_aggr.ts[bncs_aggr.hit_mask])
+
+    # The recursive engine does not know prim ids, the flat ones must give its hits
+    ray_ids  = torch.nonzero(hit_aggr.hit_mask).view(-1)
+    ts, _, _ = scene._intersectPrims(rays, ray_ids, hit_aggr.prim_ids[ray_ids])
+
+    assert torch.allclose(ts, bncs_aggr.ts[ray_ids])
@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from raytracing.cache import BVHCache
+
+from tests.helpers    import buildScene, makeRays, assertFieldsEqual, assertHitsEqual
+
+def test_cache_hit_miss(scene, tmp_path):
+    cache = BVHCache(tmp_path / 'bvh_cache')
+
+    first = buildScene(cache = cache)
+
+    assert cache.stats() == {'hits': 0, 'misses': 1, 'evictions': 0}
+    assert len(cache._entries()) == 1
+
+    # The same prim bounds and parameters load the stored tree
+    second = buildScene(cache = cache)
+
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+    assertFieldsEqual(first.flat_bvh, second.flat_bvh)
+    assertFieldsEqual(scene.flat_bvh, second.flat_bvh)
+    assertHitsEqual(scene, second, makeRays())
+
+    # Other build parameters are a different key
+    second.build(leaf_size = 2, cache = cache)
+
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 0}
+    assert len(cache._entries()) == 2
+
+def test_cache_eviction(tmp_path):
+    # NOTE: a budget below one entry keeps only the newest tree
+    cache = BVHCache(tmp_path / 'bvh_cache', max_bytes = 1)
+
+    first = buildScene(cache = cache)
+    first.build(leaf_size = 2, cache = cache)
+
+    assert cache.stats() == {'hits': 0, 'misses': 2, 'evictions': 1}
+    assert len(cache._entries()) == 1
+
+    # The newest tree stays and is loaded
+    first.build(leaf_size = 2, cache = cache)
+
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 1}
+
+    cache.clear()
+    assert cache.size() == 0
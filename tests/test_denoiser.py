@@ -0,0 +1,77 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch.nn.functional import pad
+
+from utils.torch         import ftype
+from utils.common        import Resolution
+
+from raytracing.denoiser import Denoiser
+
+from tests.helpers       import seed
+
+def reference(den, cols, feats, res):
+    # Direct form of the filter, every weight factor of every tap computed on its own
+    def padded(img, size):
+        return(pad(img.permute(2, 0, 1).unsqueeze(0), (size,) * 4, mode = 'replicate').squeeze(0).permute(1, 2, 0))
+
+    cols   = cols.view(res.v, res.h, 3)
+    guides = feats.view(res.v, res.h, 7)
+
+    for it in range(den.iterations):
+        step  = 2 ** it
+        tones = torch.sqrt(torch.clamp_min(cols, 0) / 255)
+
+        cols_pad   = padded(torch.cat([cols, tones], dim = 2), 2 * step)
+        guides_pad = padded(guides, 2 * step)
+
+        acc  = torch.zeros_like(cols)
+        wsum = torch.zeros((res.v, res.h, 1), dtype = ftype)
+
+        for i, tap_v in enumerate(den.taps):
+            for j, tap_h in enumerate(den.taps):
+                cols_q   = cols_pad[(i * step):(i * step + res.v), (j * step):(j * step + res.h), :]
+                guides_q = guides_pad[(i * step):(i * step + res.v), (j * step):(j * step + res.h), :]
+
+                d_col = torch.sum(torch.pow(tones - cols_q[:, :, 3:6], 2), dim = 2, keepdim = True)
+                d_alb = torch.sum(torch.pow(guides[:, :, 0:3] - guides_q[:, :, 0:3], 2), dim = 2, keepdim = True)
+                d_nrm = torch.sum(torch.pow(guides[:, :, 3:6] - guides_q[:, :, 3:6], 2), dim = 2, keepdim = True)
+                d_dpt = torch.pow(
+                    (guides[:, :, 6:7] - guides_q[:, :, 6:7]) / torch.clamp_min(torch.maximum(guides[:, :, 6:7], guides_q[:, :, 6:7]), 1e-6), 2
+                )
+
+                ws = tap_v * tap_h * \
+                    torch.exp(-d_col / (den.sigma_col * 2 ** -it) ** 2) * \
+                    torch.exp(-d_alb / den.sigma_alb ** 2) * \
+                    torch.exp(-d_nrm / den.sigma_nrm ** 2) * \
+                    torch.exp(-d_dpt / den.sigma_dpt ** 2)
+
+                acc  += ws * cols_q[:, :, 0:3]
+                wsum += ws
+
+        cols = acc / wsum
+
+    return(cols.view(-1, 3))
+
+@pytest.mark.parametrize('iterations', [1, 3, 5])
+def test_matches_reference(iterations):
+    res = Resolution(24)
+    gen = torch.Generator().manual_seed(seed)
+
+    # Noisy colors over a few flat patches of albedo, normals and depth
+    cols  = torch.rand((res.v * res.h, 3), generator = gen, dtype = ftype) * 255
+    feats = torch.rand((res.v * res.h, 7), generator = gen, dtype = ftype)
+    feats = torch.where(torch.rand((res.v * res.h, 1), generator = gen, dtype = ftype) < 0.5, feats, feats.roll(1, dims = 0))
+
+    den = Denoiser(iterations = iterations)
+
+    assert torch.allclose(den(cols, feats, res), reference(den, cols, feats, res), rtol = 1e-4, atol = 1e-3)
+
+def test_flat_image():
+    # Constant colors and guides are left as they are
+    res   = Resolution(16)
+    cols  = torch.full((res.v * res.h, 3), 100.0, dtype = ftype)
+    feats = torch.full((res.v * res.h, 7), 0.5, dtype = ftype)
+
+    assert torch.allclose(Denoiser()(cols, feats, res), cols)
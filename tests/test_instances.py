@@ -0,0 +1,121 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from copy import deepcopy
+from math import cos, sin, pi
+
+from utils.torch         import ftype
+from utils.common        import Resolution
+from utils.rand          import Sampler, SobolSampler, setSampler
+
+from raytracing.rays     import Rays
+from raytracing.scene    import InstanceStore
+from raytracing.tracer   import SimpleTracer, PathTracer
+
+from interfaces.viewport import Viewport
+
+from scenes.orrery       import orreryScene
+
+from tests.helpers       import seed, n_rand, buildScene, makeRays
+
+n_belt = 4
+
+def flattened(scene):
+    # The same scene with every instanced sphere copied into the world
+    flat = orreryScene(n_rand = n_rand, seed = seed)
+
+    for inst in scene.instances:
+        for obj in inst.scene.obj_list:
+            rock = deepcopy(obj)
+            rock.update(cent = inst.rot @ obj.cent.view(3) + inst.off.view(3))
+            flat += rock
+
+    flat.build()
+
+    return(flat)
+
+def beltRays(n = 512):
+    # Rays from the default camera towards the ring of the belt
+    gen   = torch.Generator().manual_seed(seed)
+    theta = torch.rand((n,), generator = gen, dtype = ftype) * 2 * pi
+    rads  = 13 + (torch.rand((n,), generator = gen, dtype = ftype) - 0.5) * 4
+    trgs  = torch.stack([torch.cos(theta) * rads, torch.sin(theta) * rads, torch.rand((n,), generator = gen, dtype = ftype)], dim = 1)
+
+    orig = torch.tensor([10.0, -10.0, 3.0], dtype = ftype).repeat(n, 1)
+    dirs = trgs - orig
+    dirs = dirs / torch.norm(dirs, dim = 1, keepdim = True)
+
+    return(Rays(origins = orig, directions = dirs))
+
+def instanceHits(scene, hit_aggr):
+    inst_store = next(i for i, store in enumerate(scene.stores) if isinstance(store, InstanceStore))
+
+    return(hit_aggr.hit_mask & (scene.prim_store[hit_aggr.prim_ids.clamp_min(0)] == inst_store))
+
+@pytest.fixture
+def belt_scene():
+    return(buildScene(n_belt = n_belt))
+
+@pytest.fixture
+def pixel_sampler():
+    # NOTE: scattering draws from the pixel of the ray, not from the shading order
+    sampler = SobolSampler()
+    sampler.startSample(0)
+    setSampler(sampler)
+
+    yield(sampler)
+
+    setSampler(Sampler())
+
+@pytest.mark.parametrize('make_rays', [makeRays, beltRays])
+def test_matches_flattened(belt_scene, pixel_sampler, make_rays):
+    rays = make_rays()
+    flat = flattened(belt_scene)
+
+    rays.pix_ids = torch.arange(len(rays), dtype = torch.long)
+
+    # NOTE: the belt has to be hit for the comparison to cover instances
+    if make_rays is beltRays:
+        assert torch.any(instanceHits(belt_scene, belt_scene.intersect(rays)))
+
+    inst_bncs = belt_scene.traverse(rays)
+    flat_bncs = flat.traverse(rays)
+
+    hits = inst_bncs.hit_mask
+    assert torch.equal(hits, flat_bncs.hit_mask)
+    assert torch.equal(inst_bncs.face[hits], flat_bncs.face[hits])
+
+    # Instance hits go through a rigid transform, only float level differences
+    assert torch.allclose(inst_bncs.alb[hits], flat_bncs.alb[hits], atol = 1e-4)
+    assert torch.allclose(inst_bncs.ts[hits], flat_bncs.ts[hits], atol = 1e-4)
+    assert torch.allclose(inst_bncs.ps[hits], flat_bncs.ps[hits], atol = 1e-4)
+    assert torch.allclose(inst_bncs.ns[hits], flat_bncs.ns[hits], atol = 1e-4)
+
+def test_moved_instance(belt_scene):
+    rays = beltRays()
+
+    # A turned and shifted instance matches a flattened copy after the refit
+    turn = 0.3
+    rot  = torch.tensor([[cos(turn), -sin(turn), 0], [sin(turn), cos(turn), 0], [0, 0, 1]], dtype = ftype)
+    off  = belt_scene.instances[0].off.view(3) + torch.tensor([0.5, -0.5, 0.0], dtype = ftype)
+
+    inst_id = len(belt_scene.obj_list) + len(belt_scene.unbounded)
+    belt_scene.update([inst_id], rebuild_ratio = float('inf'), rot = rot.view(1, 3, 3), off = off.view(1, 3))
+
+    inst_hits = belt_scene.intersect(rays)
+    flat_hits = flattened(belt_scene).intersect(rays)
+
+    assert torch.equal(inst_hits.hit_mask, flat_hits.hit_mask)
+    assert torch.allclose(inst_hits.ts[inst_hits.hit_mask], flat_hits.ts[flat_hits.hit_mask], atol = 1e-4)
+
+@pytest.mark.parametrize('tracer', [SimpleTracer(), PathTracer(samples = 1, max_depth = 2), PathTracer(samples = 1, max_depth = 2, nee = True)])
+def test_render(belt_scene, tracer):
+    vport = Viewport(Resolution(36))
+
+    # NOTE: the camera sees part of the belt, its instances are shaded
+    assert torch.any(instanceHits(belt_scene, belt_scene.intersect(vport.getRays(rand = False))))
+
+    tracer.render(belt_scene, vport)
+
+    assert vport.getVersion() == 1
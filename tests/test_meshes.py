@@ -0,0 +1,118 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils.common        import Resolution
+
+from raytracing.geometry import MeshStore, intersectTriangles
+from raytracing.meshio   import loadOBJ
+from raytracing.tracer   import SimpleTracer
+
+from interfaces.viewport import Viewport
+
+from tests.helpers       import buildScene, makeRays, bruteForce, checkBoxes, checkHits
+
+# A unit cube of quads, counter-clockwise seen from outside
+# NOTE: the last face counts its vertices back from the end
+cube_obj = """
+# cube
+v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+v 0 0 1
+v 1 0 1
+v 1 1 1
+v 0 1 1
+vt 0 0
+f 1/1 4/1 3/1 2/1
+f 5 6 7 8
+f 1 2 6 5
+f 2 3 7 6
+f 3 4 8 7
+f -4 -1 -5 -8
+"""
+
+@pytest.fixture
+def cube_path(tmp_path):
+    path = tmp_path / 'cube.obj'
+    path.write_text(cube_obj)
+
+    return(path)
+
+@pytest.fixture
+def mesh_scene(cube_path):
+    return(buildScene(mesh_path = cube_path))
+
+def meshStore(scene):
+    return(next(store for store in scene.stores if isinstance(store, MeshStore)))
+
+def test_load_obj(cube_path, tmp_path):
+    verts, faces = loadOBJ(cube_path)
+
+    # Quads are split into fans of two triangles
+    assert verts.shape == (8, 3)
+    assert faces.shape == (12, 3)
+    assert faces.tolist()[-2:] == [[4, 7, 3], [4, 3, 0]]
+
+    (tmp_path / 'empty.obj').write_text('# nothing\n')
+    with pytest.raises(Exception, match = 'Not a mesh file!'):
+        loadOBJ(tmp_path / 'empty.obj')
+
+def test_matches_brute_force(mesh_scene):
+    rays  = makeRays()
+    store = meshStore(mesh_scene)
+
+    checkBoxes(mesh_scene)
+    checkHits(mesh_scene, rays, *bruteForce(mesh_scene, rays))
+
+    # Triangles hit inside the mesh, against every triangle of it
+    hit_aggr = mesh_scene.intersect(rays)
+    ray_ids  = torch.nonzero(hit_aggr.hit_mask & (mesh_scene.prim_store[hit_aggr.prim_ids.clamp_min(0)] == mesh_scene.stores.index(store))).view(-1)
+
+    assert len(ray_ids) > 0
+
+    tri_ids = torch.arange(len(store.faces), dtype = torch.long)
+    ts, _   = intersectTriangles(
+        *store._triVerts(tri_ids.repeat(len(ray_ids))),
+        torch.repeat_interleave(rays.orig[ray_ids], len(tri_ids), dim = 0),
+        torch.repeat_interleave(rays.dirs[ray_ids], len(tri_ids), dim = 0)
+    )
+    ts, tris = torch.min(ts.view(len(ray_ids), len(tri_ids)), dim = 1)
+
+    assert torch.equal(hit_aggr.sub_ids[ray_ids], tris)
+    assert torch.allclose(hit_aggr.ts[ray_ids], ts)
+
+def test_matches_recursive(mesh_scene, cube_path):
+    rays = makeRays()
+
+    hit_aggr  = mesh_scene.intersect(rays)
+    bncs_aggr = buildScene(mesh_path = cube_path, traversal = 'recursive').traverse(rays)
+
+    assert torch.equal(hit_aggr.hit_mask, bncs_aggr.hit_mask)
+    assert torch.allclose(hit_aggr.ts[hit_aggr.hit_mask], bncs_aggr.ts[bncs_aggr.hit_mask])
+
+def test_bvh_reuse(mesh_scene):
+    statue = mesh_scene.obj_list[-1]
+    bvh    = statue.bvh
+
+    # The triangle hierarchy is only built again for other parameters
+    mesh_scene.build()
+    assert statue.bvh is bvh
+
+    mesh_scene.build(leaf_size = 2)
+    assert statue.bvh is not bvh
+    assert torch.all(statue.bvh.count <= 2)
+
+def test_update(mesh_scene):
+    mesh_id = len(mesh_scene.obj_list) - 1
+
+    with pytest.raises(Exception, match = 'Meshes cannot be updated'):
+        mesh_scene.update([mesh_id], cent = torch.zeros((1, 3)))
+
+def test_render(mesh_scene):
+    vport = Viewport(Resolution(36))
+
+    SimpleTracer().render(mesh_scene, vport)
+
+    assert vport.getVersion() == 1
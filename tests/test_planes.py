@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils.torch      import ftype
+
+from raytracing.rays  import Rays
+from raytracing.scene import Scene
+
+from scenes.orrery    import Ground
+
+from tests.helpers    import seed, makeRays, bruteForce, checkHits
+
+def downRays(n = 256, height = 5.0):
+    # Rays straight down onto the ground, far outside the disc
+    gen   = torch.Generator().manual_seed(seed)
+    xys   = (torch.rand((n, 2), generator = gen, dtype = ftype) - 0.5) * 20 + 40
+    orig  = torch.cat([xys, torch.full((n, 1), height, dtype = ftype)], dim = 1)
+    dirs  = torch.tensor([[0.0, 0.0, -1.0]], dtype = ftype).repeat(n, 1)
+
+    return(Rays(origins = orig, directions = dirs))
+
+def groundId(scene):
+    # NOTE: unbounded prims follow the objects of the BVH
+    return(len(scene.obj_list))
+
+def test_outside_bvh(scene):
+    ground_id = groundId(scene)
+
+    assert scene.unboundedIds().tolist() == [ground_id]
+    assert not torch.any(scene.flat_bvh.prim_ids == ground_id)
+    assert torch.all(torch.isfinite(scene.flat_bvh.mins)) and torch.all(torch.isfinite(scene.flat_bvh.maxes))
+
+def test_ground_hits(scene):
+    rays     = downRays()
+    hit_aggr = scene.intersect(rays)
+
+    assert torch.all(hit_aggr.prim_ids == groundId(scene))
+    assert torch.allclose(hit_aggr.ts, torch.full_like(hit_aggr.ts, 5.0))
+    assert torch.all(hit_aggr.face)
+
+    # Rays going up or along the ground never meet it
+    rays.dirs = -rays.dirs
+    assert not torch.any(scene.intersect(rays).hit_mask)
+
+    rays.dirs = torch.tensor([[1.0, 0.0, 0.0]], dtype = ftype).repeat(len(rays), 1)
+    assert not torch.any(scene.intersect(rays).hit_mask)
+
+def test_update(scene):
+    ground_id = groundId(scene)
+
+    # Moving the ground leaves the BVH alone, the hits follow it
+    assert not scene.update([ground_id], point = torch.tensor([[0.0, 0.0, -1.0]], dtype = ftype))
+
+    hit_aggr = scene.intersect(downRays())
+    assert torch.allclose(hit_aggr.ts, torch.full_like(hit_aggr.ts, 6.0))
+
+    rays = makeRays()
+    checkHits(scene, rays, *bruteForce(scene, rays))
+
+def test_only_planes():
+    scene = Scene()
+    scene += Ground()
+
+    with pytest.raises(Exception, match = 'Cannot build a BVH without bounded objects!'):
+        scene.build()
@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils.torch   import ftype
+
+from tests.helpers import seed, n_rand, makeRays, bruteForce, checkBoxes, checkHits
+
+def test_refit_matches_rebuild(scene):
+    rays = makeRays()
+
+    # Random spheres are shifted around the disc, the big bodies stay
+    gen     = torch.Generator().manual_seed(seed)
+    obj_ids = torch.arange(3, 3 + n_rand, dtype = torch.long)
+    cents   = scene.stores[0].cents[scene.prim_local[obj_ids]] + (torch.rand((n_rand, 3), generator = gen, dtype = ftype) - 0.5) * 2
+
+    assert not scene.update(obj_ids, rebuild_ratio = float('inf'), cent = cents)
+
+    checkBoxes(scene)
+
+    ref = bruteForce(scene, rays)
+    checkHits(scene, rays, *ref)
+
+    # Objects are kept in sync, a fresh build sees the same spheres
+    scene.build(*scene.build_params)
+
+    checkBoxes(scene)
+    checkHits(scene, rays, *ref)
+
+def test_refit_rebuilds(scene):
+    rays = makeRays()
+
+    # Shuffled centers leave the old tree grouping spheres far apart
+    gen     = torch.Generator().manual_seed(seed)
+    obj_ids = torch.arange(3, 3 + n_rand, dtype = torch.long)
+    cents   = scene.stores[0].cents[scene.prim_local[obj_ids]][torch.randperm(n_rand, generator = gen)]
+
+    assert scene.update(obj_ids, rebuild_ratio = 0.0, cent = cents)
+    assert scene.flat_bvh.sahCost() == pytest.approx(scene.sah_built)
+
+    checkBoxes(scene)
+    checkHits(scene, rays, *bruteForce(scene, rays))
@@ -0,0 +1,63 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import struct
+
+from raytracing.sceneio import saveScene, loadScene, magic, version
+
+from tests.helpers      import buildScene, makeRays, assertFieldsEqual, assertHitsEqual
+
+def test_round_trip(scene, tmp_path):
+    saveScene(scene, tmp_path / 'scene.orrs')
+    loaded = loadScene(tmp_path / 'scene.orrs')
+
+    assert [type(store) for store in loaded.stores] == [type(store) for store in scene.stores]
+    for store, loaded_store in zip(scene.stores, loaded.stores):
+        assertFieldsEqual(store, loaded_store)
+
+    assert torch.equal(loaded.prim_store, scene.prim_store)
+    assert torch.equal(loaded.prim_local, scene.prim_local)
+
+    assert loaded.mats.mat_classes == scene.mats.mat_classes
+    assert torch.equal(loaded.mats.class_ids, scene.mats.class_ids)
+    assert torch.equal(loaded.mats.rows, scene.mats.rows)
+    for table, loaded_table in zip(scene.mats.tables, loaded.mats.tables):
+        assert table.keys() == loaded_table.keys()
+        assert all(torch.equal(table[name], loaded_table[name]) for name in table)
+
+    assertFieldsEqual(scene.flat_bvh, loaded.flat_bvh)
+    assertHitsEqual(scene, loaded, makeRays())
+
+def test_round_trip_without_bvh(scene, tmp_path):
+    saveScene(scene, tmp_path / 'scene.orrs', bvh = False)
+    loaded = loadScene(tmp_path / 'scene.orrs')
+
+    assert loaded.flat_bvh is None
+
+    # Loaded scenes are built from their stores, the tree must not change
+    loaded.build()
+
+    assertFieldsEqual(scene.flat_bvh, loaded.flat_bvh)
+    assertHitsEqual(scene, loaded, makeRays())
+
+def test_invalid_files(scene, tmp_path):
+    (tmp_path / 'other.orrs').write_bytes(b'NOPE' + bytes(16))
+
+    with pytest.raises(Exception, match = 'Not a scene file!'):
+        loadScene(tmp_path / 'other.orrs')
+
+    # Files of another format version are refused, not misread
+    saveScene(scene, tmp_path / 'scene.orrs')
+    data = bytearray((tmp_path / 'scene.orrs').read_bytes())
+    data[len(magic):(len(magic) + 4)] = struct.pack('<I', version + 1)
+    (tmp_path / 'scene.orrs').write_bytes(bytes(data))
+
+    with pytest.raises(Exception, match = 'Unsupported scene file version!'):
+        loadScene(tmp_path / 'scene.orrs')
+
+def test_instances_not_saved(tmp_path):
+    scene = buildScene(n_belt = 2)
+
+    with pytest.raises(Exception, match = 'Scenes with instances cannot be saved!'):
+        saveScene(scene, tmp_path / 'scene.orrs')
@@ -0,0 +1,81 @@
+import torch
+
+import os
+from contextlib import contextmanager
+from functools  import update_wrapper
+from pathlib    import Path
+
+# Kernels ======================================================================
+# Elementwise chains of the intersections and bounces, written as pure tensor
+# functions so they can be compiled into fused kernels. Eager by default
+class Kernel():
+    def __init__(self, func):
+        self.eager    = func
+        self.compiled = None
+
+        update_wrapper(self, func)
+
+    def __call__(self, *args):
+        if self.compiled is not None and _active:
+            try:
+                return(self.compiled(*args))
+            except Exception as err:
+                # NOTE: a kernel that fails to compile stays eager for good
+                print(f'Kernel {self.eager.__name__} falls back to eager', err, sep = " - ")
+                self.compiled = None
+
+        return(self.eager(*args))
+
+_kernels  = []
+_compiled = None
+_active   = True # NOTE: compiled kernels can be paused, e.g. to time eager runs
+
+def kernel(func):
+    _kernels.append(Kernel(func))
+
+    return(_kernels[-1])
+
+def compileKernels(backend = 'inductor', cache_dir = './kernel_cache'):
+    global _compiled
+
+    if _compiled == backend:
+        return(True)
+
+    # Compiled artifacts are kept on disk, later launches skip the compiler
+    if cache_dir is not None and backend == 'inductor':
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(Path(cache_dir).resolve()))
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+    # NOTE: TorchScript is not offered, it cannot script kernels that read the
+    # module constants t_min, inf and eps
+    try:
+        for kern in _kernels:
+            # NOTE: dynamic shapes, ray counts change with every call
+            kern.compiled = torch.compile(kern.eager, backend = backend, dynamic = True)
+    except Exception as err:
+        print('Kernel compilation failed, running eager', err, sep = " - ")
+        eagerKernels()
+        return(False)
+
+    _compiled = backend
+
+    return(True)
+
+def eagerKernels():
+    global _compiled
+
+    for kern in _kernels:
+        kern.compiled = None
+
+    _compiled = None
+
+@contextmanager
+def eagerMode():
+    # Compiled kernels are kept, but every call inside runs eager
+    global _active
+
+    _active = False
+    try:
+        yield
+    finally:
+        _active = True
@@ -0,0 +1,132 @@
+import torch
+
+import os
+import json
+import time
+import threading
+from functools import wraps
+
+class _NullStage():
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        pass
+
+class _Stage():
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return(self)
+
+    def __exit__(self, *args):
+        # NOTE: without a sync, async device work is billed to a later stage
+        if self.prof.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        self.prof._record(self.name, self.start, time.perf_counter())
+
+class Profiler():
+    def __init__(self, enabled = False, sync = False, trace = True):
+        self.enabled = enabled # Switched off, stages and counters cost one check
+        self.sync    = sync    # Synchronize the device at the end of stages
+        self.trace   = trace   # Keep every stage call for Chrome traces
+
+        self._null = _NullStage()
+        self.reset()
+
+    def reset(self):
+        self.stages   = {}
+        self.counters = {}
+        self.events   = []
+        self.origin   = time.perf_counter()
+
+    def _record(self, name, start, end):
+        total, calls = self.stages.get(name, (0.0, 0))
+        self.stages[name] = (total + end - start, calls + 1)
+
+        if self.trace:
+            self.events.append((name, start, end, threading.get_ident()))
+
+    def stage(self, name):
+        if not self.enabled:
+            return(self._null)
+
+        return(_Stage(self, name))
+
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return(func(*args, **kwargs))
+
+                with _Stage(self, name):
+                    return(func(*args, **kwargs))
+
+            return(wrapper)
+
+        return(decorator)
+
+    def count(self, name, value = 1):
+        # NOTE: tensor values are summed lazily, they only sync in the report
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        stages = {
+            name: {
+                'total_s': total,
+                'calls':   calls,
+                'mean_s':  total / calls
+            }
+            for name, (total, calls) in sorted(self.stages.items(), key = lambda item: -item[1][0])
+        }
+
+        counters = {name: int(value) for name, value in sorted(self.counters.items())}
+
+        return({'stages': stages, 'counters': counters})
+
+    def dumpReport(self, path):
+        with open(path, 'w') as out_file:
+            json.dump(self.report(), out_file, indent = 4)
+
+    def dumpChromeTrace(self, path):
+        pid    = os.getpid()
+        events = [
+            {
+                'name': name,
+                'ph':   'X',
+                'ts':   (start - self.origin) * 1e6,
+                'dur':  (end - start) * 1e6,
+                'pid':  pid,
+                'tid':  tid
+            }
+            for name, start, end, tid in self.events
+        ]
+
+        # Counters show up as a single sample at the end of the trace
+        end = (time.perf_counter() - self.origin) * 1e6
+        for name, value in self.report()['counters'].items():
+            events.append({'name': name, 'ph': 'C', 'ts': end, 'pid': pid, 'args': {name: value}})
+
+        with open(path, 'w') as out_file:
+            json.dump({'traceEvents': events}, out_file)
+
+    def __str__(self):
+        report = self.report()
+        lines  = [f'{"stage":<24}{"total":>12}{"calls":>10}{"mean":>14}']
+
+        for name, stage in report['stages'].items():
+            lines.append(f'{name:<24}{stage["total_s"]:>11.3f}s{stage["calls"]:>10}{stage["mean_s"] * 1e3:>12.3f}ms')
+
+        for name, value in report['counters'].items():
+            lines.append(f'{name:<24}{value:>12}')
+
+        return('\n'.join(lines))
+
+# NOTE: shared instance, every instrumented module reports here
+prof = Profiler()
@@ -4,17 +4,163 @@ from torch.nn.functional import normalize
 from utils.consts import pi
 from utils.torch  import ftype
 
-def randOnSphere(n, device):
-    return(normalize(torch.randn((n, 3), dtype = ftype, device = device), dim = 1))
+# Samplers =====================================================================
+# Points are indexed by (pixel, sample, dimension). Dimensions are laid out per
+# depth, so every pixel uses the same dimensions for the same decision in every
+# sample: 0-1 lens, 2-3 pixel jitter, then 4 for every bounce
+dims_camera = 4
+dims_bounce = 4
 
-def randInCircle(n, device):
-    r     = torch.sqrt(torch.rand((n, 1), dtype = ftype, device = device))
-    theta = torch.rand((n, 1), dtype = ftype, device = device) * (2 * pi)
+def _hash(x):
+    # NOTE: 32 bit integer mixing in int64, products never overflow
+    x = x & 0xFFFFFFFF
+    x = (((x >> 16) ^ x) * 0x45d9f3b) & 0xFFFFFFFF
+    x = (((x >> 16) ^ x) * 0x45d9f3b) & 0xFFFFFFFF
+
+    return((x >> 16) ^ x)
+
+class Sampler():
+    # NOTE: the plain pseudo-random sampler, the others override _sequence
+    quasi = False
+
+    def __init__(self, max_samples = 1024, max_dims = 32):
+        self.max_samples = max_samples
+        self.max_dims    = max_dims
+        self.table       = None # Precomputed points [max_samples, max_dims]
+
+        self.sample = 0
+        self.base   = 0
+
+    def precompute(self):
+        if self.quasi:
+            self.table = self._sequence(self.max_samples, self.max_dims)
+
+        return(self)
+
+    def startSample(self, sample):
+        self.sample = sample
+        self.base   = 0
+
+    def startBounce(self, depth):
+        self.base = dims_camera + depth * dims_bounce
+
+    def _shifts(self, ids, dim, dims):
+        # Cranley-Patterson rotation with a hashed offset per pixel and dimension
+        dim_ids = torch.arange(dim, dim + dims, dtype = torch.long, device = ids.device).view(1, -1)
+
+        return(_hash(_hash(ids.view(-1, 1)) + dim_ids * 0x9E3779B9).type(ftype) / 2 ** 32)
+
+    def uniform(self, n, dims, device, ids = None, offset = 0):
+        dim = self.base + offset
+
+        # NOTE: rays without pixel ids and dimensions past the table are random
+        if ids is None or dim + dims > self.max_dims or not self.quasi:
+            return(torch.rand((n, dims), dtype = ftype, device = device))
+
+        if self.table is None:
+            self.precompute()
+
+        if self.table.device != torch.device(device):
+            self.table = self.table.to(device)
+
+        pts = self.table[self.sample % self.max_samples, dim:(dim + dims)].view(1, dims)
+
+        return(torch.frac(pts + self._shifts(ids, dim, dims)))
+
+class SobolSampler(Sampler):
+    quasi = True
+
+    def _sequence(self, n, dims):
+        return(torch.quasirandom.SobolEngine(dimension = dims, scramble = False).draw(n).type(ftype))
+
+class HaltonSampler(Sampler):
+    quasi = True
+
+    def _sequence(self, n, dims):
+        # Radical inverses of the sample ids, one prime base per dimension
+        primes = []
+        cand   = 2
+        while len(primes) < dims:
+            if all(cand % prime != 0 for prime in primes):
+                primes.append(cand)
+            cand += 1
+
+        ids   = torch.arange(n, dtype = torch.long).view(-1, 1).repeat(1, dims)
+        bases = torch.tensor(primes, dtype = torch.long).view(1, -1)
+        table = torch.zeros((n, dims), dtype = torch.float64)
+        scale = torch.ones((1, dims), dtype = torch.float64) / bases
+
+        while torch.any(ids > 0):
+            table += (ids % bases) * scale
+            ids    = ids // bases
+            scale /= bases
+
+        return(table.type(ftype))
+
+class BlueNoiseSampler(Sampler):
+    # NOTE: pixel offsets follow the R2 sequence over the screen, neighbouring
+    # pixels get well spread offsets, which pushes the error to high frequencies
+    quasi = True
+
+    def __init__(self, width, **kwargs):
+        self.width = width
+
+        super().__init__(**kwargs)
+
+    def _sequence(self, n, dims):
+        # Kronecker sequence over the samples with the generalized golden ratio
+        phi    = 2.0
+        for _ in range(32):
+            phi = pow(1 + phi, 1 / (dims + 1))
+
+        alphas = torch.pow(1 / torch.tensor(phi, dtype = torch.float64), torch.arange(1, dims + 1, dtype = torch.float64))
+        table  = torch.arange(n, dtype = torch.float64).view(-1, 1) * alphas.view(1, -1)
+
+        return(torch.frac(table).type(ftype))
+
+    def _shifts(self, ids, dim, dims):
+        xs = (ids % self.width).type(torch.float64).view(-1, 1)
+        ys = (ids // self.width).type(torch.float64).view(-1, 1)
+
+        # NOTE: 1.3247... is the plastic number, every dimension is decorrelated
+        dim_ids = torch.arange(dim, dim + dims, dtype = torch.long, device = ids.device)
+        offsets = (_hash(dim_ids).type(torch.float64) / 2 ** 32).view(1, -1)
+
+        return(torch.frac(xs * 0.7548776662466927 + ys * 0.5698402909980532 + offsets).type(ftype))
+
+# NOTE: the active sampler, tracers set their own before tracing
+_sampler = Sampler()
+
+def setSampler(sampler):
+    global _sampler
+    _sampler = sampler
+
+def getSampler():
+    return(_sampler)
+
+# Distributions ================================================================
+def randUniform(n, device, ids = None, offset = 0):
+    return(_sampler.uniform(n, 1, device, ids, offset).view(-1))
+
+def randOnSphere(n, device, ids = None, offset = 0):
+    if ids is None:
+        return(normalize(torch.randn((n, 3), dtype = ftype, device = device), dim = 1))
+
+    us    = _sampler.uniform(n, 2, device, ids, offset)
+    zs    = 1 - 2 * us[:, 0:1]
+    rs    = torch.sqrt(torch.clamp_min(1 - torch.pow(zs, 2), 0))
+    theta = us[:, 1:2] * (2 * pi)
+
+    return(torch.cat([rs * torch.cos(theta), rs * torch.sin(theta), zs], dim = 1))
+
+def randInCircle(n, device, ids = None, offset = 0):
+    us    = _sampler.uniform(n, 2, device, ids, offset)
+    r     = torch.sqrt(us[:, 0:1])
+    theta = us[:, 1:2] * (2 * pi)
 
     return(torch.cos(theta) * r, torch.sin(theta) * r)
 
-def randInSquare(n, device):
-    return(
-        torch.rand((n, 1), dtype = ftype, device = device) - 0.5,
-        torch.rand((n, 1), dtype = ftype, device = device) - 0.5
-    )
\ No newline at end of file
+def randInSquare(n, device, ids = None, offset = 0):
+    us = _sampler.uniform(n, 2, device, ids, offset)
+
+    return(us[:, 0:1] - 0.5, us[:, 1:2] - 0.5)